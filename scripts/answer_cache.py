@@ -0,0 +1,243 @@
+# answer_cache.py
+"""
+Semantic answer cache in front of SLMResponseGenerator.
+
+An answer is reused when a new question is close enough to a cached one
+(cosine similarity of the query embeddings above a threshold) AND the
+generator would see exactly the same documents (by content) as context AND the question
+names the same filters and numbers (see query_key): "net income 2023" and
+"net income 2024" embed almost identically and often retrieve the same
+chunks. Entries belong to one index version and are dropped when the index
+is rebuilt. The cache is shared across sessions, so it is locked.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from instrumentation import record_cache
+from embedding_store import text_hash
+from query_filters import extract_filters
+from structured_lookup import TICKER_PATTERN
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def context_doc_ids(context_docs):
+    """
+    The set of content hashes of the documents in the generator's context.
+    Row ids are not used: update_bundle renumbers rows, and a shard's rows
+    overlap the other shards'. Chunk texts name their ticker.
+    """
+    return frozenset(text_hash(doc["text"]) for doc in context_docs)
+
+def query_key(query):
+    """
+    What a question asks for that its embedding may blur: its year,
+    statement and parameter-family filters (query_filters.extract_filters),
+    the numbers and the upper-case words (tickers) it contains.
+    """
+    filters = extract_filters(query)
+    return (
+        tuple(sorted((kind, tuple(sorted(values))) for kind, values in filters.items())),
+        tuple(sorted(set(NUMBER_PATTERN.findall(query)))),
+        tuple(sorted(set(TICKER_PATTERN.findall(query))))
+    )
+
+def build_warmup_questions(financial_records, template="What is the {parameter} for {year}?"):
+    """
+    One question per (finance_parameter, year) pair found in the records
+    (e.g. financial_store.load_records output or bundle metadata), in first-seen order.
+    """
+    questions = []
+    seen = set()
+    for record in financial_records:
+        key = (record["finance_parameter"], record["year"])
+        if key not in seen:
+            seen.add(key)
+            questions.append(template.format(parameter=key[0], year=key[1]))
+    return questions
+
+
+class SemanticAnswerCache:
+    """
+    Answers grouped by key (the context doc-id set and the query_key of
+    the question); within a group, lookups compare the query embedding
+    against all cached embeddings in one matrix product. Groups are evicted
+    least-recently-used once max_size answers are stored. All methods are
+    thread-safe.
+    """
+    def __init__(self, threshold=0.95, max_size=1024, index_version=None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.index_version = index_version
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._groups = OrderedDict()  # key -> (embeddings matrix, answers)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def set_index_version(self, index_version):
+        """
+        Drops every entry if the index version changed.
+        """
+        with self._lock:
+            if index_version != self.index_version:
+                self._clear()
+                self.index_version = index_version
+
+    def lookup(self, query_embedding, key):
+        """
+        Returns the cached answer for a similar query with the same key,
+        or None.
+        """
+        query_embedding = _unit(query_embedding)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None:
+                embeddings, answers = group
+                similarities = embeddings @ query_embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._groups.move_to_end(key)
+                    self.hits += 1
+                    record_cache("answer", True)
+                    return answers[best]
+            self.misses += 1
+        record_cache("answer", False)
+        return None
+
+    def store(self, query_embedding, key, answer):
+        embedding = _unit(query_embedding)[None, :]
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                self._groups[key] = (embedding, [answer])
+            else:
+                embeddings, answers = group
+                self._groups[key] = (np.vstack([embeddings, embedding]), answers + [answer])
+            self._groups.move_to_end(key)
+            self._size += 1
+            while self._size > self.max_size and len(self._groups) > 1:
+                _, (_, answers) = self._groups.popitem(last=False)
+                self._size -= len(answers)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._groups.clear()
+        self._size = 0
+        self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self._size,
+                "max_size": self.max_size,
+                "index_version": self.index_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class CachedResponseGenerator:
+    """
+    Drop-in wrapper around SLMResponseGenerator: generate_response returns
+    a cached answer when one applies and only calls the model otherwise.
+    `encoder` embeds the query (the cached dense encoder used for retrieval,
+    so this is normally a cache hit too). Answers are keyed on the docs the
+    generator's context_docs() says it will use (for generators without it,
+    the top context_size docs) and on the query_key of the question.
+    """
+    def __init__(self, generator, encoder, cache, context_size=3):
+        self.generator = generator
+        self.encoder = encoder
+        self.cache = cache
+        self.context_size = context_size
+        self.last_cache_hit = False
+        self.last_cache_hits = []
+
+    def _key(self, query, retrieved_docs):
+        context_docs = getattr(self.generator, "context_docs", None)
+        if context_docs is None:
+            doc_ids = context_doc_ids(retrieved_docs[:self.context_size])
+        else:
+            doc_ids = context_doc_ids(context_docs(query, retrieved_docs))
+        return doc_ids, query_key(query)
+
+    def generate_response(self, query, retrieved_docs, **kwargs):
+        query_embedding = self.encoder.encode([query], convert_to_numpy=True)[0]
+        key = self._key(query, retrieved_docs)
+        answer = self.cache.lookup(query_embedding, key)
+        self.last_cache_hit = answer is not None
+        if answer is None:
+            answer = self.generator.generate_response(query, retrieved_docs, **kwargs)
+            self.cache.store(query_embedding, key, answer)
+        return answer
+
+    def generate_stream(self, query, retrieved_docs, **kwargs):
+        """
+        Streaming generate_response: a cached answer is yielded at once,
+        otherwise the generator's stream is passed through and the full
+        answer is cached when it ends.
+        """
+        query_embedding = self.encoder.encode([query], convert_to_numpy=True)[0]
+        key = self._key(query, retrieved_docs)
+        answer = self.cache.lookup(query_embedding, key)
+        self.last_cache_hit = answer is not None
+        if answer is not None:
+            yield answer
+            return
+        pieces = []
+        for piece in self.generator.generate_stream(query, retrieved_docs, **kwargs):
+            pieces.append(piece)
+            yield piece
+        self.cache.store(query_embedding, key, "".join(pieces).strip())
+
+    def generate_batch(self, queries, retrieved_docs_list, **kwargs):
+        """
+        generate_response for many queries: cached answers are looked up
+        per query and only the misses go through one generator.generate_batch
+        call. last_cache_hits records which queries were cache hits.
+        """
+        query_embeddings = self.encoder.encode(list(queries), convert_to_numpy=True)
+        keys = [self._key(q, docs) for q, docs in zip(queries, retrieved_docs_list)]
+        answers = [self.cache.lookup(e, key) for e, key in zip(query_embeddings, keys)]
+        self.last_cache_hits = [answer is not None for answer in answers]
+        missing = [i for i, answer in enumerate(answers) if answer is None]
+        if missing:
+            generated = self.generator.generate_batch(
+                [queries[i] for i in missing], [retrieved_docs_list[i] for i in missing], **kwargs
+            )
+            for i, answer in zip(missing, generated):
+                answers[i] = answer
+                self.cache.store(query_embeddings[i], keys[i], answer)
+        return answers
+
+    def stats(self):
+        # Statistics of the wrapped generator (prompt assembly, encoder cache)
+        return self.generator.stats()
+
+    def warm_cache(self, questions, retrieve_batch):
+        """
+        Answers `questions` ahead of time so later lookups hit the cache.
+        retrieve_batch maps a list of questions to their re-ranked docs.
+        Returns the number of questions that needed the model.
+        """
+        pairs = [(q, docs) for q, docs in zip(questions, retrieve_batch(questions)) if docs]
+        if not pairs:
+            return 0
+        self.generate_batch([q for q, _ in pairs], [docs for _, docs in pairs])
+        return self.last_cache_hits.count(False)
@@ -1,56 +1,220 @@
 # app.py
 
 import streamlit as st
-import json
-import faiss
-from sentence_transformers import SentenceTransformer
-import numpy as np
 import os
 
 # Our modules:
-from embedding import chunk_data, load_index
-from retrieval import build_bm25_index, hybrid_search
-from re_ranking import ReRanker
-from slm_generation import SLMResponseGenerator
-from guardrails import is_financial_question
+from embedding import model_fingerprint
+from index_bundle import load_bundle, current_build_id, BundleVersionError
+from retrieval import hybrid_search, hybrid_search_batch
+from answer_cache import SemanticAnswerCache, CachedResponseGenerator, build_warmup_questions
+from structured_lookup import StructuredLookup
+from guardrails import GuardrailEngine
 from finance_keywords import FINANCE_KEYWORDS
-
-@st.cache_data
-def load_financial_data(json_path):
-    with open(json_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+from instrumentation import trace, profiler_from_env
+from model_registry import REGISTRY
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DENSE_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+RERANKER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+GENERATOR_MODEL_NAME = "google/flan-t5-base"  # or "google/flan-t5-small"
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_PATH = os.path.join(BASE_DIR, "embeddings", "query_embeddings.sqlite")
+ANSWER_CACHE_THRESHOLD = 0.95
+# Number of "What is the <parameter> for <year>?" questions to answer at
+# startup so the answer cache starts warm (0 disables warm-up)
+ANSWER_CACHE_WARMUP = int(os.environ.get("ANSWER_CACHE_WARMUP", "0"))
+# All three models load under the inference profile named by $INFERENCE_PROFILE
+# (default fp32; e.g. cpu_int8 for CPU-only hosts, see inference_profile.py)
+# Set SLOW_REQUEST_MS to keep a cProfile of questions slower than that (see instrumentation.py)
+SLOW_REQUEST_PROFILER = profiler_from_env()
+
+# Models load once per process through the model registry (model_registry.py);
+# the cross-encoder and T5 load on a background thread while the page renders
+
+def load_dense_model(model_name=DENSE_MODEL_NAME):
+    # Query embeddings are cached in memory and on disk (see query_cache.py)
+    return REGISTRY.get("dense", model_name, cache_size=QUERY_CACHE_SIZE, cache_path=QUERY_CACHE_PATH)
+
+def preload_models():
+    REGISTRY.preload([("reranker", RERANKER_MODEL_NAME, {}), ("generator", GENERATOR_MODEL_NAME, {})])
+
+def wait_for_model(kind, name, label):
+    # Blocks (with a spinner) until a preloaded model is ready
+    entry = REGISTRY.load(kind, name)
+    if entry.ready:
+        return entry.model
+    with st.spinner(f"Loading the {label}..."):
+        return entry.wait()
+
+def load_reranker():
+    return wait_for_model("reranker", RERANKER_MODEL_NAME, "re-ranker")
+
+def load_generator(dense_model, answer_cache):
+    generator = wait_for_model("generator", GENERATOR_MODEL_NAME, "answer generator")
+    return CachedResponseGenerator(generator, dense_model, answer_cache)
+
+def show_model_stats():
+    with st.sidebar.expander("Models"):
+        for model in REGISTRY.stats():
+            load = f"{model['load_seconds']:.1f} s" if model["load_seconds"] is not None else "-"
+            weights = f"{model['weights_mb']:.0f} MB" if model["weights_mb"] is not None else "-"
+            rss = f", RSS +{model['rss_mb']:.0f} MB" if model["rss_mb"] is not None else ""
+            st.write(f"**{model['kind']}** {model['name']}: {model['status']}, "
+                     f"loaded in {load}, weights {weights}{rss}")
+
+@st.cache_resource(max_entries=1)
+def load_index_bundle(bundle_dir, build_id, model_name=DENSE_MODEL_NAME):
+    """
+    Memory-maps the prebuilt bundle (FAISS + texts + metadata + BM25)
+    written by embedding.py, refusing it if the embedding model changed.
+    Keyed on the current build_id, so an updated bundle is picked up.
+    """
+    fingerprint = model_fingerprint(load_dense_model(model_name), model_name)
+    return load_bundle(bundle_dir, model_name, fingerprint)
 
 @st.cache_resource
-def load_dense_model(model_name="sentence-transformers/all-MiniLM-L6-v2"):
-    return SentenceTransformer(model_name)
+def load_answer_cache():
+    return SemanticAnswerCache(ANSWER_CACHE_THRESHOLD)
 
 @st.cache_resource
-def load_faiss_index(index_path):
-    return load_index(index_path)
+def load_guardrails():
+    # All keyword lists compiled once into a single pattern
+    return GuardrailEngine(FINANCE_KEYWORDS)
+
+@st.cache_resource(max_entries=1)
+def load_structured_lookup(index_version, _metadata):
+    # Keyed on the index version; the metadata itself is not hashed
+    return StructuredLookup(_metadata, FINANCE_KEYWORDS)
+
+def show_trace(query_trace):
+    # Where the time went, per pipeline stage (see instrumentation.py)
+    with st.expander(f"Timings ({query_trace.seconds * 1000:.0f} ms)"):
+        st.table({
+            "stage": list(query_trace.stages),
+            "ms": [f"{seconds * 1000:.1f}" for seconds in query_trace.stages.values()]
+        })
+        if query_trace.counts:
+            st.write(dict(query_trace.counts))
+        if query_trace.profile_path:
+            st.caption(f"Slow request profile: {query_trace.profile_path}")
+
+def answer_question(question, bundle, dense_model, guardrails, lookup, answer_cache, ticker=None):
+    """
+    Steps 1-6 for one question, rendering the answer as it goes. The
+    re-ranker and generator are only waited for when the question needs them.
+    With a ticker, retrieval only searches that company's chunks.
+    """
+    # 1) Check if it's a (harmless) financial question, in one pass
+    verdict = guardrails.classify(question)
+    if verdict["harmful"]:
+        st.error("This query cannot be answered.")
+        return
+    if not verdict["financial"]:
+        st.error("Please ask a finance question.")
+        return
+
+    # 2) Point queries ("Total Revenue 2023") are answered straight from
+    #    the (ticker, year, parameter) index, skipping every model stage
+    cell = lookup.resolve(question, ticker)
+    if cell is not None:
+        st.subheader("Final Answer")
+        st.write(f"{cell['finance_parameter']} ({cell['year']}): {cell['value']}")
+        st.caption("Answered by: structured lookup")
+        st.markdown("---")
+        st.write("**Source Snippet**")
+        st.write(cell["text"])
+        return
+
+    # 3) Perform retrieval
+    partitions = bundle.partitions.pin(ticker={ticker}) if ticker else bundle.partitions
+    retrieved_docs = hybrid_search(
+        question, 
+        bundle.bm25, 
+        bundle.chunk_texts, 
+        bundle.faiss_index, 
+        bundle.metadata, 
+        dense_model,
+        id_map=bundle.id_map,
+        partitions=partitions
+    )
+
+    # 4) Re-rank
+    reranked_docs = load_reranker().rerank(question, retrieved_docs)
+    
+    if len(reranked_docs) == 0:
+        st.write("No relevant documents found.")
+        return
+
+    # 5) Show the top snippet right away; the answer streams in above it
+    top_doc = reranked_docs[0]
+    answer_area = st.container()
+    st.markdown("---")
+    st.write("**Top Retrieved Snippet**")
+    st.write(top_doc["text"])
+    st.write(f"Re-rank Score: {top_doc['re_rank_score']:.2f}")
+
+    # 6) Generate final answer, rendering the text as it is decoded
+    slm = load_generator(dense_model, answer_cache)
+    with answer_area:
+        st.subheader("Final Answer")
+        final_answer = st.write_stream(slm.generate_stream(question, reranked_docs))
+        if slm.last_cache_hit:
+            st.caption("Answered by: answer cache")
+        else:
+            st.caption("Answered by: retrieval + generation (streamed)")
+
+        # Assume top_doc is a list of retrieved documents and we want to check the first one.
+        top_docA = reranked_docs[0]
+        if str(top_docA['metadata']['value']) not in final_answer:
+            st.write("Additional Context:")
+            st.write(top_docA['metadata']['finance_parameter'], " ", top_docA['metadata']['year'] ,":",top_docA['metadata']['value'])
+
+        st.write(f"**Confidence Score**: {top_doc['score']:.2f}")
 
 def main():
     st.title("Financial QA Demo-Apple")
 
-    # Paths (adjust to your environment)
-        # Define base directory
-    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    
     # Paths (platform-independent)
-    json_path = os.path.join(BASE_DIR,"data", "processed" ,"financial_data.json")
-    index_path = os.path.join(BASE_DIR,"embeddings" , "financial_data.index")
+    bundle_dir = os.path.join(BASE_DIR,"embeddings" , "financial_bundle")
     
-     # Load data
-    financial_data = load_financial_data(json_path)
-    chunks = chunk_data(financial_data)
-    chunk_texts = [c[0] for c in chunks]
-    metadata = [c[1] for c in chunks]
-
-    # Build or load indexes/models
-    bm25 = build_bm25_index(chunks)
+    # Load the prebuilt index bundle (run embedding.py to create it)
+    try:
+        bundle = load_index_bundle(bundle_dir, current_build_id(bundle_dir))
+    except FileNotFoundError:
+        st.error(f"No index bundle found at {bundle_dir}. Run embedding.py first.")
+        return
+    except BundleVersionError as e:
+        st.error(f"Index bundle is stale: {e}")
+        return
+    chunk_texts = bundle.chunk_texts
+    metadata = bundle.metadata
+    bm25 = bundle.bm25
+    faiss_index = bundle.faiss_index
+    id_map = bundle.id_map
     dense_model = load_dense_model()
-    faiss_index = load_faiss_index(index_path)
-    reranker = ReRanker()
-    slm = SLMResponseGenerator(model_name="google/flan-t5-base")  # or "google/flan-t5-small"
+    guardrails = load_guardrails()
+    lookup = load_structured_lookup(bundle.version, metadata)
+    answer_cache = load_answer_cache()
+    # A rebuilt or updated bundle (new build id) starts a fresh answer cache
+    answer_cache.set_index_version(bundle.version)
+    preload_models()
+    show_model_stats()
+
+    # A bundle over several companies answers for the one picked here
+    ticker = None
+    if len(bundle.partitions.tickers) > 1:
+        ticker = st.sidebar.selectbox("Company", bundle.partitions.tickers)
+
+    if ANSWER_CACHE_WARMUP and len(answer_cache) == 0:
+        questions = build_warmup_questions(metadata)[:ANSWER_CACHE_WARMUP]
+        reranker = load_reranker()
+        slm = load_generator(dense_model, answer_cache)
+        with st.spinner(f"Warming the answer cache with {len(questions)} questions..."):
+            slm.warm_cache(questions, lambda qs: reranker.rerank_batch(
+                qs, hybrid_search_batch(qs, bm25, chunk_texts, faiss_index, metadata, dense_model,
+                                    id_map=id_map, partitions=bundle.partitions)
+            ))
 
     user_query = st.text_input("Enter your financial question here", "")
     if st.button("Search"):
@@ -59,52 +223,9 @@ def main():
             st.warning("Please enter a query.")
             return
 
-        # 1) Check if it's a financial question
-        if not is_financial_question(question, FINANCE_KEYWORDS):
-            st.error("Please ask a finance question.")
-            return
-
-        # 2) Perform retrieval
-        retrieved_docs = hybrid_search(
-            question, 
-            bm25, 
-            chunk_texts, 
-            faiss_index, 
-            metadata, 
-            dense_model
-        )
-
-        # 3) Re-rank
-        reranked_docs = reranker.rerank(question, retrieved_docs)
-        
-        if len(reranked_docs) == 0:
-            st.write("No relevant documents found.")
-            return
-
-        # 4) Generate final answer
-        final_answer = slm.generate_response(question, reranked_docs)
-
-        # Assume top_doc is a list of retrieved documents and we want to check the first one.
-        top_docA = reranked_docs[0]
-        print(top_docA)
-        if str(top_docA['metadata']['value']) not in final_answer:
-            st.write("Additional Context:")
-            st.write(top_docA['metadata']['finance_parameter'], " ", top_docA['metadata']['year'] ,":",top_docA['metadata']['value'])
-
-        # 5) Display
-        st.subheader("Final Answer")
-        st.write(final_answer)
-
-        # Show top doc’s confidence
-        top_doc = reranked_docs[0]
-        confidence = top_doc.get("confidence", 0.0)
-        st.write(f"**Confidence Score**: {top_doc['score']:.2f}")
-
-        # (Optional) Show top snippet
-        st.markdown("---")
-        st.write("**Top Retrieved Snippet**")
-        st.write(top_doc["text"])
-        st.write(f"Re-rank Score: {top_doc['re_rank_score']:.2f}")
+        with trace("app", question, SLOW_REQUEST_PROFILER) as query_trace:
+            answer_question(question, bundle, dense_model, guardrails, lookup, answer_cache, ticker)
+        show_trace(query_trace)
 
 if __name__ == "__main__":
     main()
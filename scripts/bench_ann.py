@@ -0,0 +1,143 @@
+# bench_ann.py
+"""
+Recall/latency/memory report for the FAISS index types in embedding.make_index.
+
+For each configuration it reports recall@k against the exact flat index,
+mean query latency, and the serialized index size (a proxy for resident
+memory), so an index type can be picked from data rather than guesswork.
+Configurations with a rescore_factor re-score their shortlist exactly
+against float32 vectors (embedding.RescoredIndex); those vectors are
+memory-mapped from disk when served, so they are not counted in the size.
+
+Vectors come from either the chunked processed records encoded with the
+embedding model, or (offline) a synthetic clustered corpus of any size.
+
+Usage:
+    python bench_ann.py                       # encode the real corpus
+    python bench_ann.py --synthetic 200000    # no model needed
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+
+from embedding import chunk_data, index_from_embeddings, search_parameters, RescoredIndex
+from financial_store import load_records
+
+# (label, build parameters, search parameters)
+DEFAULT_CONFIGS = [
+    ("flat", {"index_type": "flat"}, {}),
+    ("sq_fp16", {"index_type": "sq_fp16"}, {}),
+    ("sq8", {"index_type": "sq8"}, {}),
+    ("sq8 rescore4", {"index_type": "sq8", "rescore_factor": 4}, {}),
+    ("hnsw32 ef16", {"index_type": "hnsw", "hnsw_m": 32}, {"ef_search": 16}),
+    ("hnsw32 ef64", {"index_type": "hnsw", "hnsw_m": 32}, {"ef_search": 64}),
+    ("ivf_flat np1", {"index_type": "ivf_flat"}, {"nprobe": 1}),
+    ("ivf_flat np8", {"index_type": "ivf_flat"}, {"nprobe": 8}),
+    ("ivf_flat np32", {"index_type": "ivf_flat"}, {"nprobe": 32}),
+    ("ivf_pq16 np8", {"index_type": "ivf_pq", "pq_m": 16}, {"nprobe": 8}),
+    ("ivf_pq16 np32", {"index_type": "ivf_pq", "pq_m": 16}, {"nprobe": 32}),
+    ("ivf_pq16 np32 rescore4", {"index_type": "ivf_pq", "pq_m": 16, "rescore_factor": 4}, {"nprobe": 32}),
+]
+
+QUERIES = [
+    "What is the total revenue for 2023?",
+    "Net income 2024",
+    "cash flow from operating activities in 2023",
+    "How much was spent on research and development?",
+    "total debt and long term debt 2024",
+    "free cash flow 2023 and 2024",
+    "gross profit",
+    "diluted EPS for 2024",
+]
+
+def synthetic_vectors(num_vectors, num_queries, dim=384, num_clusters=256, seed=0):
+    """
+    Gaussian clusters, so IVF/HNSW see structure similar to real embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+
+    def draw(n):
+        labels = rng.integers(num_clusters, size=n)
+        return centers[labels] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+
+    return draw(num_vectors), draw(num_queries)
+
+def encoded_vectors(model_name, repeat_queries):
+    from sentence_transformers import SentenceTransformer
+
+    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    store_dir = os.path.join(BASE_DIR, "data", "processed", "financial_data")
+    records = load_records(store_dir)
+    model = SentenceTransformer(model_name)
+    texts = [c[0] for c in chunk_data(records)]
+    return (model.encode(texts, convert_to_numpy=True),
+            model.encode(QUERIES * repeat_queries, convert_to_numpy=True))
+
+def evaluate(embeddings, queries, configs=DEFAULT_CONFIGS, k=10):
+    """
+    Builds each configuration over `embeddings` and returns one row per
+    configuration: recall@k vs exact search, ms/query, index bytes, build s.
+    """
+    queries = np.array(queries, dtype=np.float32, order="C")
+    faiss.normalize_L2(queries)
+    exact, _ = index_from_embeddings(embeddings.copy(), "flat")
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    built = {}
+    for label, build_params, search_params in configs:
+        build_params = dict(build_params)
+        rescore_factor = build_params.pop("rescore_factor", None)
+        key = json.dumps(build_params, sort_keys=True)
+        if key not in built:
+            start = time.perf_counter()
+            index, vectors = index_from_embeddings(embeddings.copy(), **build_params)
+            built[key] = (index, vectors, time.perf_counter() - start)
+        index, vectors, build_time = built[key]
+        searcher = RescoredIndex(index, vectors, factor=rescore_factor) if rescore_factor else index
+
+        params = search_parameters(index, **search_params)
+        start = time.perf_counter()
+        _, found = searcher.search(queries, k, params=params)
+        latency = (time.perf_counter() - start) / len(queries)
+
+        recall = np.mean([
+            len(set(f[f >= 0]) & set(t)) / len(t) for f, t in zip(found, truth)
+        ])
+        rows.append({
+            "config": label,
+            "recall": recall,
+            "latency_ms": latency * 1000,
+            "index_bytes": faiss.serialize_index(index).nbytes,
+            "build_s": build_time
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="use N synthetic vectors instead of the encoded corpus")
+    parser.add_argument("--queries", type=int, default=1000, help="synthetic query count")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        embeddings, queries = synthetic_vectors(args.synthetic, args.queries)
+    else:
+        embeddings, queries = encoded_vectors(args.model, repeat_queries=10)
+    k = min(args.top_k, len(embeddings))
+    print(f"{len(embeddings)} vectors of dim {embeddings.shape[1]}, {len(queries)} queries, k={k}")
+
+    print(f"{'config':<24}{'recall@k':>10}{'ms/query':>10}{'index MB':>10}{'build s':>9}")
+    for row in evaluate(embeddings, queries, k=k):
+        print(f"{row['config']:<24}{row['recall']:>10.3f}{row['latency_ms']:>10.3f}"
+              f"{row['index_bytes'] / 2**20:>10.2f}{row['build_s']:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# bench_bm25.py
+"""
+Compares the sparse BM25 engine (bm25.SparseBM25) against rank_bm25.BM25Okapi:
+checks that both return the same top-k rankings for the same tokens, and
+times query scoring + top-k selection for each.
+
+The corpus is the chunked processed record store, optionally replicated
+`--scale` times (as if for more tickers) to show how both scale.
+
+Usage:
+    python bench_bm25.py --scale 100 --top-k 5
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25 import SparseBM25, tokenize
+from embedding import chunk_data
+from financial_store import load_records
+
+QUERIES = [
+    "What is the total revenue for 2023?",
+    "Net income 2024",
+    "cash flow from operating activities in 2023",
+    "How much was spent on research and development?",
+    "total debt and long term debt 2024",
+    "free cash flow 2023 and 2024",
+    "gross profit",
+    "diluted EPS for 2024",
+]
+
+def build_corpus(records, scale):
+    """
+    Chunk texts for `records`, replicated `scale` times with a distinct
+    ticker prefix per copy.
+    """
+    texts = [c[0] for c in chunk_data(records)]
+    if scale == 1:
+        return texts
+    return [f"Ticker: T{copy}, {text}" for copy in range(scale) for text in texts]
+
+def okapi_top_k(bm25, query_tokens, top_k):
+    """
+    What retrieval.hybrid_search used to do: score everything, sort everything.
+    """
+    scores = bm25.get_scores(query_tokens)
+    ranked = sorted(zip(range(len(scores)), scores), key=lambda x: x[1], reverse=True)
+    return ranked[:top_k]
+
+def time_per_query(fn, queries, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in queries:
+            fn(q)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=int, default=1, help="corpus replication factor")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    store_dir = os.path.join(BASE_DIR, "data", "processed", "financial_data")
+    records = load_records(store_dir)
+
+    texts = build_corpus(records, args.scale)
+    tokenized_corpus = [tokenize(t) for t in texts]
+    tokenized_queries = [tokenize(q) for q in QUERIES]
+    print(f"Corpus: {len(texts)} chunks, {len(QUERIES)} queries, top_k={args.top_k}")
+
+    start = time.perf_counter()
+    okapi = BM25Okapi(tokenized_corpus)
+    okapi_build = time.perf_counter() - start
+    start = time.perf_counter()
+    sparse = SparseBM25.from_corpus(tokenized_corpus)
+    sparse_build = time.perf_counter() - start
+
+    # Same rankings: identical doc ids in the same order, scores equal to
+    # floating point tolerance.
+    mismatches = 0
+    for query, tokens in zip(QUERIES, tokenized_queries):
+        expected = okapi_top_k(okapi, tokens, args.top_k)
+        doc_ids, scores = sparse.top_k(tokens, args.top_k)
+        same_ids = [d for d, _ in expected] == doc_ids.tolist()
+        same_scores = np.allclose([s for _, s in expected], scores, rtol=1e-9, atol=1e-12)
+        if not (same_ids and same_scores):
+            mismatches += 1
+            print(f"MISMATCH for {query!r}: {expected} vs {list(zip(doc_ids, scores))}")
+    print(f"Rankings identical for {len(QUERIES) - mismatches}/{len(QUERIES)} queries")
+
+    okapi_time = time_per_query(lambda t: okapi_top_k(okapi, t, args.top_k), tokenized_queries, args.repeat)
+    sparse_time = time_per_query(lambda t: sparse.top_k(t, args.top_k), tokenized_queries, args.repeat)
+
+    print(f"{'engine':<12}{'build (s)':>12}{'query (ms)':>14}")
+    print(f"{'BM25Okapi':<12}{okapi_build:>12.3f}{okapi_time * 1000:>14.3f}")
+    print(f"{'SparseBM25':<12}{sparse_build:>12.3f}{sparse_time * 1000:>14.3f}")
+    print(f"Query speedup: {okapi_time / sparse_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# bench_guardrails.py
+"""
+Compares guardrails.GuardrailEngine against the per-keyword functions
+is_financial_question and reject_harmful_query: checks that both make the
+same accept/reject decisions on a query set and times each.
+
+Queries are built from the finance parameters of the processed records, the
+keyword lists themselves, harmful phrases and off-topic questions, so every
+keyword list is exercised.
+
+Usage:
+    python bench_guardrails.py --repeat 5
+"""
+
+import os
+import time
+import argparse
+
+import guardrails
+from guardrails import GuardrailEngine, is_financial_question, reject_harmful_query, HARMFUL_KEYWORDS, PROHIBITED_TOPICS
+from finance_keywords import FINANCE_KEYWORDS
+from financial_store import load_records
+
+OFF_TOPIC = [
+    "What is the weather like today?",
+    "Who won the football match yesterday?",
+    "Tell me a joke about cats",
+    "How do I bake sourdough bread?",
+    "Whatever happened to the old theatre?",
+    "Is the cashier open on Sunday?",
+    "Revenues of cashflows",
+]
+
+def build_queries(records, keywords_dict):
+    queries = [f"What is the {r['finance_parameter']} for {r['year']}?" for r in records]
+    for keywords in keywords_dict.values():
+        queries += [f"Tell me about the {kw} this year" for kw in keywords]
+        queries += [kw.upper() for kw in keywords]
+    queries += [f"How do I {kw} the bank and take its revenue?" for kw in HARMFUL_KEYWORDS + PROHIBITED_TOPICS]
+    queries += OFF_TOPIC
+    return queries
+
+def time_per_query(fn, queries, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in queries:
+            fn(q)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    store_dir = os.path.join(BASE_DIR, "data", "processed", "financial_data")
+    records = load_records(store_dir)
+
+    # The app passes finance_keywords.FINANCE_KEYWORDS; guardrails has its own default
+    for name, keywords_dict in [("finance_keywords", FINANCE_KEYWORDS),
+                                ("guardrails", guardrails.FINANCE_KEYWORDS)]:
+        queries = build_queries(records, keywords_dict)
+        engine = GuardrailEngine(keywords_dict)
+
+        def reference(q):
+            return is_financial_question(q, keywords_dict), reject_harmful_query(q)
+
+        def compiled(q):
+            result = engine.classify(q)
+            return result["financial"], result["harmful"]
+
+        mismatches = [q for q in queries if reference(q) != compiled(q)]
+        for q in mismatches:
+            print(f"MISMATCH {q!r}: reference={reference(q)} engine={compiled(q)}")
+
+        batch = engine.classify_batch(queries)
+        accepted = sum(r["financial"] and not r["harmful"] for r in batch)
+        reference_time = time_per_query(reference, queries, args.repeat)
+        engine_time = time_per_query(engine.classify, queries, args.repeat)
+
+        print(f"[{name}] {len(queries)} queries, {accepted} accepted, "
+              f"identical decisions for {len(queries) - len(mismatches)}/{len(queries)}")
+        print(f"  per-keyword functions: {reference_time * 1e6:8.1f} us/query")
+        print(f"  GuardrailEngine:       {engine_time * 1e6:8.1f} us/query "
+              f"({reference_time / engine_time:.1f}x faster)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+# bench_pipeline.py
+"""
+End-to-end benchmark: replays golden queries through the app.py pipeline.
+
+Each query runs guardrails -> hybrid_search -> ReRanker.rerank ->
+generate_response (the structured lookup is skipped, it would answer the
+point questions before retrieval). The report gives, per corpus scale:
+    latency     p50/p95/p99 per stage: the instrumented stages of
+                instrumentation.py plus retrieve/rerank/generate/total
+    QPS         queries per second of the sequential replay
+    quality     recall@1, recall@k and MRR of the retrieval order and of
+                the re-ranked order, and the share of answers that contain
+                a relevant value
+
+The golden set maps each query to its relevant chunks by (parameter, year):
+a few hand-written questions (GOLDEN_QUERIES) plus template questions over
+random (parameter, year) pairs of the records. A query counts as recalled
+at k when any relevant chunk is in its top k.
+
+--models stub (the default) runs offline and deterministically: a
+feature-hashing bi-encoder, a token-overlap cross-encoder and an extractive
+generator stand in for the three models, so the retrieval, filtering and
+merge code is measured as is. --models real loads the actual models.
+
+--scales grows the corpus with synthetic tickers (10 = the records plus 9
+jittered copies). Chunk texts do not name the ticker, so every ticker's
+chunk for the (parameter, year) is relevant.
+
+Usage:
+    python bench_pipeline.py
+    python bench_pipeline.py --scales 1 10 100 1000 --out bench_pipeline.json
+    python bench_pipeline.py --models real --profile cpu_int8
+"""
+
+import os
+import json
+import time
+import zlib
+import argparse
+import tempfile
+import numpy as np
+
+from bm25 import tokenize
+from embedding import chunk_data, build_bundle
+from index_bundle import load_bundle
+from financial_store import load_records
+from retrieval import hybrid_search
+from re_ranking import ReRanker
+from guardrails import GuardrailEngine
+from finance_keywords import FINANCE_KEYWORDS
+from structured_lookup import stem_word
+from instrumentation import STAGES, trace, stage
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PIPELINE_STAGES = ("retrieve", "rerank", "generate")
+
+# Hand-written questions: (query, finance_parameter, year or None for any year)
+GOLDEN_QUERIES = [
+    ("How much was spent on research and development in 2024?", "Research And Development", 2024),
+    ("What were the capital expenditures in 2023?", "Capital Expenditure", 2023),
+    ("free cash flow 2023", "Free Cash Flow", 2023),
+    ("total debt 2024", "Total Debt", 2024),
+    ("diluted EPS for 2024", "Diluted EPS", 2024),
+    ("net income 2024", "Net Income", 2024),
+    ("cash and cash equivalents at the end of 2023", "Cash And Cash Equivalents", 2023),
+    ("gross profit", "Gross Profit", None),
+]
+
+QUESTION_TEMPLATES = [
+    "What is the {parameter} for {year}?",
+    "{parameter} {year}",
+    "How much was the {parameter_lower} in {year}?",
+    "Show the {parameter_lower} reported for {year}",
+]
+
+
+def _terms(text):
+    return [stem_word(t) for t in tokenize(text)]
+
+class StubEncoder:
+    """
+    Offline stand-in for the SentenceTransformer: signed feature hashing of
+    the stemmed unigrams and bigrams, L2-normalized.
+    """
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, sentences, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            terms = _terms(text)
+            for feature in terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                embeddings[i, h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, 1e-12)
+        return embeddings[0] if single else embeddings
+
+class StubCrossEncoder:
+    """
+    Offline stand-in for the cross-encoder: cosine overlap of the stemmed
+    query and document terms.
+    """
+    def predict(self, pairs, batch_size=None, **kwargs):
+        scores = []
+        for query, text in pairs:
+            q, d = set(_terms(query)), set(_terms(text))
+            scores.append(len(q & d) / np.sqrt(max(len(q) * len(d), 1)))
+        return np.array(scores, dtype=np.float32)
+
+class StubGenerator:
+    """
+    Offline stand-in for SLMResponseGenerator: answers with the top document.
+    """
+    def generate_response(self, query, retrieved_docs, max_length=512):
+        meta = retrieved_docs[0]["metadata"]
+        return f"{meta['finance_parameter']} ({meta['year']}): {meta['value']}"
+
+
+def load_models(args):
+    """
+    (dense model, its name, ReRanker, generator) for --models.
+    """
+    if args.models == "stub":
+        reranker = ReRanker("stub-overlap", cache_size=0, cross_encoder=StubCrossEncoder())
+        return StubEncoder(), "stub-hashing-384", reranker, StubGenerator()
+    from retrieval import load_dense_model
+    from slm_generation import SLMResponseGenerator
+
+    # Caches off: every query pays for its model calls
+    dense_model = load_dense_model(args.model, cache_size=0, profile=args.profile)
+    reranker = ReRanker(args.reranker, cache_size=0, profile=args.profile)
+    generator = SLMResponseGenerator(args.generator, profile=args.profile, encoder_cache_size=0)
+    return dense_model, args.model, reranker, generator
+
+def read_records(path):
+    """
+    Records from financial_data.json or a financial_store directory.
+    """
+    if os.path.isdir(path):
+        return list(load_records(path))
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def scale_records(records, factor, seed=0):
+    """
+    `records` plus factor - 1 synthetic tickers (SYN0001, ...) with the same
+    parameters and years and values jittered by a lognormal factor.
+    """
+    rng = np.random.default_rng(seed)
+    values = np.array([r["value"] for r in records], dtype=np.float64)
+    scaled = list(records)
+    for i in range(1, factor):
+        jittered = np.round(values * rng.lognormal(0.0, 0.2, len(values)), -3)
+        ticker = f"SYN{i:04d}"
+        scaled.extend(dict(r, ticker=ticker, value=float(v)) for r, v in zip(records, jittered))
+    return scaled
+
+def golden_set(records, num_generated=64, seed=0):
+    """
+    [(query, parameter, year)]: GOLDEN_QUERIES whose parameter is in the
+    records, then num_generated template questions over random
+    (parameter, year) pairs.
+    """
+    pairs = sorted({(r["finance_parameter"], r["year"]) for r in records})
+    parameters = {p for p, _ in pairs}
+    golden = [g for g in GOLDEN_QUERIES if g[1] in parameters]
+    rng = np.random.default_rng(seed)
+    for i in rng.choice(len(pairs), size=min(num_generated, len(pairs)), replace=False):
+        parameter, year = pairs[i]
+        template = QUESTION_TEMPLATES[rng.integers(len(QUESTION_TEMPLATES))]
+        golden.append((template.format(parameter=parameter, parameter_lower=parameter.lower(), year=year),
+                       parameter, year))
+    return golden
+
+def relevant_rows(metadata, golden):
+    """
+    Set of bundle rows relevant to each golden query, by (parameter, year).
+    """
+    years = np.asarray(metadata.years)
+    parameter_codes = np.asarray(metadata.parameter_codes)
+    codes = {p: i for i, p in enumerate(metadata.parameters)}
+    relevant = []
+    for _, parameter, year in golden:
+        mask = parameter_codes == codes.get(parameter, -1)
+        if year is not None:
+            mask &= years == year
+        relevant.append(set(np.flatnonzero(mask).tolist()))
+    return relevant
+
+def _first_relevant_rank(docs, relevant):
+    for rank, doc in enumerate(docs, 1):
+        if doc["doc_id"] in relevant:
+            return rank
+    return None
+
+def quality(ranked_lists, relevant, k):
+    """
+    recall@1, recall@k and MRR (first relevant doc) over the queries.
+    """
+    ranks = [_first_relevant_rank(docs[:k], rel) for docs, rel in zip(ranked_lists, relevant)]
+    return {
+        "recall@1": float(np.mean([r == 1 for r in ranks])),
+        f"recall@{k}": float(np.mean([r is not None for r in ranks])),
+        "mrr": float(np.mean([1.0 / r if r else 0.0 for r in ranks]))
+    }
+
+def replay(bundle, dense_model, reranker, generator, golden, top_k=5, repeat=1):
+    """
+    Runs the golden queries `repeat` times. Returns the traces (one per
+    query run), the retrieved and re-ranked lists and the answers of the
+    first pass, and the wall time of the replay.
+    """
+    guardrails = GuardrailEngine(FINANCE_KEYWORDS)
+    traces, retrieved, reranked, answers = [], [], [], []
+    start = time.perf_counter()
+    for run in range(repeat):
+        for query, _, _ in golden:
+            with trace("bench", query) as t:
+                guardrails.classify(query)
+                with stage("retrieve"):
+                    docs = hybrid_search(query, bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                                         bundle.metadata, dense_model, top_k=top_k,
+                                         id_map=bundle.id_map, partitions=bundle.partitions)
+                with stage("rerank"):
+                    ranked = reranker.rerank(query, [dict(d) for d in docs])
+                with stage("generate"):
+                    answer = generator.generate_response(query, ranked) if ranked else ""
+            traces.append(t)
+            if run == 0:
+                retrieved.append(docs)
+                reranked.append(ranked)
+                answers.append(answer)
+    return traces, retrieved, reranked, answers, time.perf_counter() - start
+
+def latency_table(traces):
+    """
+    {stage: {"p50", "p95", "p99"}} in ms, for the stages the traces recorded.
+    """
+    table = {}
+    for name in STAGES + PIPELINE_STAGES + ("total",):
+        values = [t.seconds if name == "total" else t.stages.get(name) for t in traces]
+        values = [v * 1000 for v in values if v is not None]
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            table[name] = {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+    return table
+
+def run_scale(records, factor, models, golden, args):
+    dense_model, model_name, reranker, generator = models
+    with tempfile.TemporaryDirectory() as tmp:
+        bundle_dir = os.path.join(tmp, "bundle")
+        scaled = scale_records(records, factor, args.seed)
+        start = time.perf_counter()
+        build_bundle(chunk_data(scaled), bundle_dir, dense_model, model_name,
+                     {"index_type": args.index_type})
+        build_seconds = time.perf_counter() - start
+        bundle = load_bundle(bundle_dir)
+
+        # One untimed query so lazy setup (partitions, first model call) is not measured
+        replay(bundle, dense_model, reranker, generator, golden[:1], args.top_k)
+        traces, retrieved, reranked, answers, seconds = replay(
+            bundle, dense_model, reranker, generator, golden, args.top_k, args.repeat
+        )
+        relevant = relevant_rows(bundle.metadata, golden)
+        values = [{str(bundle.metadata[row]["value"]) for row in rel} for rel in relevant]
+        result = {
+            "scale": factor,
+            "chunks": len(bundle.chunk_texts),
+            "build_seconds": build_seconds,
+            "queries": len(traces),
+            "qps": len(traces) / seconds,
+            "latency_ms": latency_table(traces),
+            "retrieval": quality(retrieved, relevant, args.top_k),
+            "rerank": quality(reranked, relevant, args.top_k),
+            "answer_hit": float(np.mean([any(v in a for v in vals) for a, vals in zip(answers, values)]))
+        }
+    return result
+
+def print_result(result, k):
+    print(f"\nscale {result['scale']}x: {result['chunks']} chunks (built in {result['build_seconds']:.1f} s), "
+          f"{result['queries']} queries, {result['qps']:.1f} QPS")
+    print(f"{'stage':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in result["latency_ms"].items():
+        print(f"{name:<16}{row['p50']:>10.2f}{row['p95']:>10.2f}{row['p99']:>10.2f}")
+    for label in ("retrieval", "rerank"):
+        q = result[label]
+        print(f"{label:<10} recall@1 {q['recall@1']:.3f}  recall@{k} {q[f'recall@{k}']:.3f}  MRR {q['mrr']:.3f}")
+    print(f"answers containing a relevant value: {result['answer_hit']:.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--data", default=os.path.join(BASE_DIR, "data", "processed", "financial_data.json"),
+                        help="financial_data.json or a financial_store directory")
+    parser.add_argument("--models", choices=["stub", "real"], default="stub")
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    parser.add_argument("--generator", default="google/flan-t5-base")
+    parser.add_argument("--profile", default=None, help="inference profile for --models real")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="corpus sizes as multiples of the record tickers")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--golden", type=int, default=64, help="template questions in the golden set")
+    parser.add_argument("--repeat", type=int, default=1, help="passes over the golden queries")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="also write the results as JSON")
+    args = parser.parse_args()
+
+    records = read_records(args.data)
+    golden = golden_set(records, args.golden, args.seed)
+    models = load_models(args)
+    print(f"{len(records)} records, {len(golden)} golden queries, models: {args.models}")
+
+    results = []
+    for factor in args.scales:
+        results.append(run_scale(records, factor, models, golden, args))
+        print_result(results[-1], args.top_k)
+
+    print(f"\n{'scale':>6}{'chunks':>10}{'retrieve p50':>14}{'rerank p50':>12}{'generate p50':>14}"
+          f"{'QPS':>9}{'R@' + str(args.top_k):>7}{'MRR':>7}")
+    for r in results:
+        lat = r["latency_ms"]
+        print(f"{r['scale']:>6}{r['chunks']:>10}{lat['retrieve']['p50']:>14.2f}{lat['rerank']['p50']:>12.2f}"
+              f"{lat['generate']['p50']:>14.2f}{r['qps']:>9.1f}{r['rerank'][f'recall@{args.top_k}']:>7.3f}"
+              f"{r['rerank']['mrr']:>7.3f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
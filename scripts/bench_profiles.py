@@ -0,0 +1,138 @@
+# bench_profiles.py
+"""
+Latency/accuracy report for the inference profiles in inference_profile.py.
+
+Every profile loads the three models (bi-encoder, cross-encoder, T5) and
+runs a fixed query set against the index bundle. Each stage is compared
+with the first profile (the baseline, fp32 by default) on the same inputs:
+    retrieval   hybrid_search with the profile's query encoder: top-k
+                overlap with the baseline results and query-embedding cosine
+    rerank      the baseline candidates re-scored: top-1 agreement
+    generate    answers from the baseline re-ranked docs: exact match rate
+Latencies are milliseconds per query with caches disabled; model MB is the
+size of the three models' weights (int8 weights count one byte).
+
+Thread settings are process-wide and torch's inter-op thread count can only
+be set once, so the first profile's inter-op setting holds for all of them.
+
+Usage:
+    python bench_profiles.py
+    python bench_profiles.py --profiles fp32 cpu_int8 --generator google/flan-t5-small
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+
+from bench_ann import QUERIES
+from embedding import model_fingerprint
+from index_bundle import load_bundle
+from retrieval import hybrid_search, load_dense_model
+from re_ranking import ReRanker
+from slm_generation import SLMResponseGenerator
+from inference_profile import PROFILES, get_profile
+from model_registry import model_megabytes
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def _timed(fn, items):
+    """
+    [fn(item) for item in items] and the mean ms per item.
+    """
+    start = time.perf_counter()
+    results = [fn(item) for item in items]
+    return results, (time.perf_counter() - start) * 1000 / len(items)
+
+def run_profile(profile, bundle, queries, args, baseline=None):
+    """
+    Runs `queries` through the three models loaded under `profile`.
+    Returns (report row, outputs); outputs of the baseline run are the
+    inputs of the later stages for every other profile.
+    """
+    profile = get_profile(profile)
+    dense_model = load_dense_model(args.model, profile=profile)
+    reranker = ReRanker(args.reranker, cache_size=0, profile=profile)
+    generator = SLMResponseGenerator(args.generator, profile=profile, encoder_cache_size=0)
+
+    # One warm-up call per model, outside the timings
+    warm = hybrid_search("warm-up query", bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                         bundle.metadata, dense_model, top_k=args.top_k, id_map=bundle.id_map)
+    reranker.rerank("warm-up query", warm)
+    generator.generate_batch(["warm-up query"], [warm])
+
+    candidates, retrieve_ms = _timed(
+        lambda q: hybrid_search(q, bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                                bundle.metadata, dense_model, top_k=args.top_k,
+                                id_map=bundle.id_map),
+        queries
+    )
+    source = baseline or {"candidates": candidates}
+    reranked, rerank_ms = _timed(
+        lambda i: reranker.rerank(queries[i], [dict(d) for d in source["candidates"][i]]),
+        range(len(queries))
+    )
+    source = baseline or {"reranked": reranked}
+    answers, generate_ms = _timed(
+        lambda i: generator.generate_batch([queries[i]], [source["reranked"][i]])[0],
+        range(len(queries))
+    )
+    embeddings = dense_model.encode(queries)
+
+    row = {
+        "profile": profile.name,
+        "retrieve_ms": retrieve_ms,
+        "rerank_ms": rerank_ms,
+        "generate_ms": generate_ms,
+        "model_mb": sum(model_megabytes(m) for m in
+                        (dense_model.model, reranker.cross_encoder, generator.model)),
+        "overlap": 1.0,
+        "cosine": 1.0,
+        "top1": 1.0,
+        "exact": 1.0
+    }
+    if baseline is not None:
+        row["overlap"] = np.mean([
+            len({d["doc_id"] for d in c} & {d["doc_id"] for d in b}) / max(len(b), 1)
+            for c, b in zip(candidates, baseline["candidates"])
+        ])
+        row["cosine"] = np.mean(np.sum(
+            embeddings * baseline["embeddings"], axis=1
+        ) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(baseline["embeddings"], axis=1)))
+        row["top1"] = np.mean([
+            r[0]["doc_id"] == b[0]["doc_id"] for r, b in zip(reranked, baseline["reranked"]) if b
+        ])
+        row["exact"] = np.mean([a == b for a, b in zip(answers, baseline["answers"])])
+    outputs = {"candidates": candidates, "reranked": reranked, "answers": answers,
+               "embeddings": embeddings}
+    return row, outputs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--profiles", nargs="+", choices=sorted(PROFILES),
+                        default=["fp32", "cpu_fp32", "cpu_int8"],
+                        help="profiles to compare; the first one is the baseline")
+    parser.add_argument("--bundle", default=os.path.join(BASE_DIR, "embeddings", "financial_bundle"))
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    parser.add_argument("--generator", default="google/flan-t5-base")
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    fingerprint = model_fingerprint(load_dense_model(args.model, profile="fp32"), args.model)
+    bundle = load_bundle(args.bundle, args.model, fingerprint)
+    queries = list(QUERIES)
+    print(f"{len(queries)} queries, k={args.top_k}, baseline: {args.profiles[0]}")
+
+    print(f"{'profile':<10}{'retr ms':>9}{'rerank ms':>11}{'gen ms':>9}{'model MB':>10}"
+          f"{'overlap':>9}{'cosine':>9}{'top1':>7}{'exact':>7}")
+    baseline = None
+    for name in args.profiles:
+        row, outputs = run_profile(name, bundle, queries, args, baseline)
+        baseline = baseline or outputs
+        print(f"{row['profile']:<10}{row['retrieve_ms']:>9.1f}{row['rerank_ms']:>11.1f}"
+              f"{row['generate_ms']:>9.1f}{row['model_mb']:>10.1f}{row['overlap']:>9.3f}"
+              f"{row['cosine']:>9.4f}{row['top1']:>7.2f}{row['exact']:>7.2f}")
+
+if __name__ == "__main__":
+    main()
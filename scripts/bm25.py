@@ -0,0 +1,276 @@
+# bm25.py
+"""
+Vectorized BM25 (Okapi variant) backed by a sparse term-document matrix.
+
+The per-(term, doc) BM25 weights are precomputed into a CSR matrix with one
+row per term, so scoring a query is a single sparse vector-matrix product that
+only touches the rows of the query terms. Top-k selection uses argpartition
+instead of sorting the whole corpus.
+
+Scores follow rank_bm25.BM25Okapi exactly (same idf, epsilon floor and length
+normalization), so rankings match it for the same tokens.
+"""
+
+import re
+import math
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Bump whenever tokenize() changes, so indexes built with the old
+# tokenization are rebuilt.
+TOKENIZATION_VERSION = 1
+
+# Lowercase alphanumeric tokens; decimals such as "383285000000.0" stay whole
+# and trailing punctuation ("2023?", "2023,") is dropped.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+def tokenize(text):
+    """
+    Splits text into lowercase word/number tokens.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SparseBM25:
+    """
+    BM25Okapi over a corpus that can be updated with add_documents and
+    remove_documents.
+
+    The corpus statistics are kept as document-major CSR arrays
+    (indptr/indices/tf, one row per document) so they can be saved and
+    memory-mapped as-is; the term-major weight matrix is derived from them.
+    """
+    def __init__(self, vocab, idf, doc_len, indptr, indices, tf,
+                 k1=1.5, b=0.75, epsilon=0.25):
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.doc_len = np.asarray(doc_len)
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.tf = np.asarray(tf)
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.corpus_size = len(self.doc_len)
+        # An empty corpus (or one emptied by remove_documents) scores nothing
+        self.avgdl = float(self.doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0
+        self.weights = self._build_weights()
+
+    @classmethod
+    def from_corpus(cls, tokenized_corpus, k1=1.5, b=0.75, epsilon=0.25):
+        """
+        Builds the index from a list of token lists, like BM25Okapi(corpus).
+        """
+        term_ids = {}
+        indptr = [0]
+        indices = []
+        tf = []
+        doc_len = []
+        for document in tokenized_corpus:
+            frequencies = {}
+            for word in document:
+                frequencies[word] = frequencies.get(word, 0) + 1
+            for word, count in frequencies.items():
+                indices.append(term_ids.setdefault(word, len(term_ids)))
+                tf.append(count)
+            indptr.append(len(indices))
+            doc_len.append(len(document))
+
+        indices = np.asarray(indices, dtype=np.int32)
+        doc_freq = np.bincount(indices, minlength=len(term_ids))
+        idf = cls.compute_idf(doc_freq, len(doc_len), epsilon)
+        return cls(
+            list(term_ids), idf,
+            np.asarray(doc_len, dtype=np.int32),
+            np.asarray(indptr, dtype=np.int64),
+            indices,
+            np.asarray(tf, dtype=np.int32),
+            k1=k1, b=b, epsilon=epsilon
+        )
+
+    @staticmethod
+    def compute_idf(doc_freq, corpus_size, epsilon=0.25):
+        """
+        BM25Okapi idf: log(N - n + 0.5) - log(n + 0.5), with negative values
+        floored to epsilon * average idf. Computed term by term in vocabulary
+        order, as rank_bm25 does, so the values match it bit for bit.
+        """
+        idf = [math.log(corpus_size - n + 0.5) - math.log(n + 0.5) for n in doc_freq.tolist()]
+        average_idf = sum(idf) / len(idf) if idf else 0.0
+        idf = np.asarray(idf, dtype=np.float64)
+        idf[idf < 0] = epsilon * average_idf
+        return idf
+
+    def remove_documents(self, rows):
+        """
+        Drops the documents at positions `rows`; later documents move up.
+        """
+        keep = np.ones(self.corpus_size, dtype=bool)
+        keep[np.asarray(rows, dtype=np.int64)] = False
+        counts = np.diff(self.indptr)
+        keep_entries = np.repeat(keep, counts)
+        self.indices = self.indices[keep_entries]
+        self.tf = self.tf[keep_entries]
+        self.doc_len = self.doc_len[keep]
+        self.indptr = np.concatenate([[0], np.cumsum(counts[keep])]).astype(np.int64)
+        self._refresh()
+
+    def add_documents(self, tokenized_docs):
+        """
+        Appends tokenized documents; only they are counted, the existing
+        corpus statistics are reused.
+        """
+        indices = []
+        tf = []
+        doc_len = []
+        counts = []
+        for document in tokenized_docs:
+            frequencies = {}
+            for word in document:
+                frequencies[word] = frequencies.get(word, 0) + 1
+            for word, count in frequencies.items():
+                term_id = self.term_ids.get(word)
+                if term_id is None:
+                    term_id = self.term_ids[word] = len(self.vocab)
+                    self.vocab.append(word)
+                indices.append(term_id)
+                tf.append(count)
+            counts.append(len(frequencies))
+            doc_len.append(len(document))
+        self.indices = np.concatenate([self.indices, np.asarray(indices, dtype=np.int32)])
+        self.tf = np.concatenate([self.tf, np.asarray(tf, dtype=np.int32)])
+        self.doc_len = np.concatenate([self.doc_len, np.asarray(doc_len, dtype=np.int32)])
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(counts)]).astype(np.int64)
+        self._refresh()
+
+    def _refresh(self):
+        """
+        Re-derives idf, avgdl and the weight matrix after the corpus changed.
+        Terms no document uses any more are dropped from the vocabulary so
+        the idf floor matches an index built from scratch. This is a few
+        vectorized passes over the stored arrays; nothing is re-tokenized.
+        """
+        doc_freq = np.bincount(self.indices, minlength=len(self.vocab))
+        alive = doc_freq > 0
+        if not alive.all():
+            new_ids = np.cumsum(alive) - 1
+            self.indices = new_ids[self.indices].astype(np.int32)
+            self.vocab = [term for term, used in zip(self.vocab, alive) if used]
+            doc_freq = doc_freq[alive]
+        self.term_ids = {term: i for i, term in enumerate(self.vocab)}
+        self.corpus_size = len(self.doc_len)
+        # An empty corpus (or one emptied by remove_documents) scores nothing
+        self.avgdl = float(self.doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0
+        self.idf = self.compute_idf(doc_freq, self.corpus_size, self.epsilon)
+        self.weights = self._build_weights()
+
+    def _build_weights(self):
+        """
+        Term-major CSR matrix of BM25 weights, shape (num_terms, num_docs).
+        """
+        counts = np.diff(self.indptr)
+        doc_ids = np.repeat(np.arange(self.corpus_size), counts)
+        tf = self.tf.astype(np.float64)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_ids] / self.avgdl)
+        weights = self.idf[self.indices] * (tf * (self.k1 + 1) / (tf + norm))
+        doc_term = csr_matrix(
+            (weights, self.indices, self.indptr),
+            shape=(self.corpus_size, len(self.vocab))
+        )
+        return doc_term.T.tocsr()
+
+    def _query_matrix(self, queries):
+        """
+        Sparse (num_queries, num_terms) matrix of query term counts.
+        Unknown terms are dropped; repeated terms count once per occurrence.
+        """
+        rows, cols = [], []
+        for row, tokens in enumerate(queries):
+            for token in tokens:
+                term_id = self.term_ids.get(token)
+                if term_id is not None:
+                    rows.append(row)
+                    cols.append(term_id)
+        data = np.ones(len(rows), dtype=np.float64)
+        # Duplicate (row, col) entries are summed by the constructor
+        return csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.vocab)))
+
+    def get_scores(self, query):
+        """
+        BM25 score of every document for a tokenized query.
+        """
+        return (self._query_matrix([query]) @ self.weights).toarray().ravel()
+
+    def get_scores_batch(self, queries):
+        """
+        BM25 scores for many tokenized queries at once, as a dense
+        (num_queries, num_docs) array: one sparse matrix-matrix product.
+        """
+        return (self._query_matrix(queries) @ self.weights).toarray()
+
+    def get_scores_subset(self, query, rows):
+        """
+        BM25 scores of the documents in `rows` only, in that order. Only the
+        weights of the query terms in those documents are read, so the cost
+        scales with the subset rather than the corpus.
+        """
+        query_matrix = self._query_matrix([query])
+        rows = np.asarray(rows, dtype=np.int64)
+        if query_matrix.nnz == 0 or len(rows) == 0:
+            return np.zeros(len(rows))
+        subset = self.weights[query_matrix.indices][:, rows]
+        return np.asarray(subset.T @ query_matrix.data).ravel()
+
+    def top_k(self, query, k=5):
+        """
+        Returns (doc_ids, scores) of the k best documents, best first.
+        Ties are broken by ascending doc id, like a stable descending sort.
+        """
+        return select_top_k(self.get_scores(query), k)
+
+    def top_k_batch(self, queries, k=5, block_size=256, rows_list=None):
+        """
+        top_k for a list of tokenized queries. Queries are scored
+        `block_size` at a time so the dense score block stays bounded.
+        rows_list optionally restricts each query to a sorted array of
+        document rows (None: all documents); restricted queries score only
+        their subset (get_scores_subset).
+        """
+        rows_list = rows_list or [None] * len(queries)
+        results = [None] * len(queries)
+        full = [i for i, rows in enumerate(rows_list) if rows is None]
+        for start in range(0, len(full), block_size):
+            block = full[start:start + block_size]
+            scores = self.get_scores_batch([queries[i] for i in block])
+            for i, row in zip(block, scores):
+                results[i] = select_top_k(row, k)
+        for i, rows in enumerate(rows_list):
+            if rows is not None:
+                rows = np.asarray(rows, dtype=np.int64)
+                positions, scores = select_top_k(self.get_scores_subset(queries[i], rows), k)
+                results[i] = (rows[positions], scores)
+        return results
+
+
+def select_top_k(scores, k):
+    """
+    Indices and values of the k largest scores, highest first, using
+    argpartition (O(N)) rather than a full sort. Equal scores keep ascending
+    index order so the result matches sorted(..., reverse=True)[:k].
+    """
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    if k < n:
+        part = np.argpartition(-scores, k - 1)[:k]
+        kth = scores[part].min()
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -scores[candidates]))
+    doc_ids = candidates[order]
+    return doc_ids, scores[doc_ids]
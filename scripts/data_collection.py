@@ -1,22 +1,74 @@
+# data_collection.py
+"""
+Downloads annual financial statements (income statement, balance sheet and
+cash flow) for a list of tickers and saves one CSV per statement and fiscal
+year under data/raw/<TICKER>/, e.g. data/raw/AAPL/income_statement_2023.csv.
+
+Tickers are fetched concurrently by a bounded thread pool, with retries and
+exponential backoff. A small state file remembers, for each statement, the
+reporting periods seen, the fiscal years requested and the CSVs written. A
+statement is skipped when its periods and the requested years are the same
+as last run and all of its CSVs still exist; a CSV is only rewritten when
+its content changed.
+
+The data source is pluggable: YFinanceSource talks to Yahoo Finance,
+FixtureSource serves in-memory DataFrames so the collector runs offline.
+
+Usage:
+    python data_collection.py                 # tickers from data/companies.json
+    python data_collection.py AAPL MSFT --workers 16
+"""
+
 import os
-import yfinance as yf
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
-# Define the folder where CSV files will be saved
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-save_folder = os.path.join(BASE_DIR,"data","raw")
+RAW_DATA_DIR = os.path.join(BASE_DIR, "data", "raw")
+STATE_FILE = "collection_state.json"
+
+# Statement name (CSV file prefix) -> yfinance.Ticker attribute
+STATEMENTS = {
+    "income_statement": "financials",
+    "balance_sheet": "balance_sheet",
+    "cash_flow": "cashflow"
+}
 
-# Create the folder if it doesn't exist
-os.makedirs(save_folder, exist_ok=True)
 
-# Define the ticker symbol for Apple
-ticker_symbol = "AAPL"
-ticker = yf.Ticker(ticker_symbol)
+class YFinanceSource:
+    """
+    Fetches statements from Yahoo Finance through yfinance.
+    """
+    def __init__(self):
+        import yfinance
+        self._yf = yfinance
+
+    def fetch(self, ticker):
+        """
+        Returns {statement name: DataFrame} with one column per period.
+        """
+        handle = self._yf.Ticker(ticker)
+        return {name: getattr(handle, attribute) for name, attribute in STATEMENTS.items()}
+
+
+class FixtureSource:
+    """
+    Offline stand-in for YFinanceSource serving fixture DataFrames:
+    frames maps ticker -> {statement name: DataFrame}. Unknown tickers
+    raise KeyError, like a failed download.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.calls = 0
+
+    def fetch(self, ticker):
+        self.calls += 1
+        return {name: df.copy() for name, df in self.frames[ticker].items()}
 
-# Download financial statements: income statement, balance sheet, and cash flow
-income_statement = ticker.financials
-balance_sheet = ticker.balance_sheet
-cash_flow = ticker.cashflow
 
 # Function to filter columns by year from a DataFrame with timestamp columns
 def filter_by_year(df: pd.DataFrame, year: int) -> pd.DataFrame:
@@ -26,22 +78,143 @@ def filter_by_year(df: pd.DataFrame, year: int) -> pd.DataFrame:
     filtered_cols = [col for col, dt in zip(df.columns, new_cols) if dt.year == year]
     return df[filtered_cols]
 
-# Filter the statements for 2023 and 2024
-income_2023 = filter_by_year(income_statement, 2023)
-income_2024 = filter_by_year(income_statement, 2024)
+def statement_periods(df):
+    """
+    The reporting periods of a statement as ISO dates, newest first.
+    """
+    return sorted((pd.Timestamp(c).date().isoformat() for c in df.columns), reverse=True)
+
+def fetch_with_retry(source, ticker, retries=3, backoff=1.0):
+    """
+    source.fetch(ticker), retried up to `retries` times with exponential
+    backoff (backoff, 2*backoff, ... seconds, plus jitter).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return source.fetch(ticker)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random() / 2))
+
+def _write_if_changed(path, text):
+    """
+    Writes `text` to path unless the file already holds exactly that.
+    Returns True if the file was written.
+    """
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            if f.read() == text:
+                return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return True
+
+def _up_to_date(entry, periods, years, ticker_dir):
+    """
+    True if the state entry of a statement has the same periods and
+    requested years, and every CSV it lists still exists.
+    """
+    return (isinstance(entry, dict)
+            and entry.get("periods") == periods
+            and entry.get("years") == years
+            and all(os.path.exists(os.path.join(ticker_dir, f)) for f in entry.get("files", [])))
+
+def collect_ticker(source, ticker, raw_dir, previous_state, years=None, retries=3,
+                   backoff=1.0, force=False):
+    """
+    Fetches one ticker and saves its changed statements.
+    previous_state is {statement: {"periods", "years", "files"}} from the
+    last run; up-to-date statements (see _up_to_date) are skipped unless
+    force is set. Returns a summary dict with the new state, written and
+    skipped files, or the error.
+    """
+    result = {"ticker": ticker, "state": dict(previous_state), "written": [], "skipped": []}
+    try:
+        statements = fetch_with_retry(source, ticker, retries, backoff)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    ticker_dir = os.path.join(raw_dir, ticker)
+    os.makedirs(ticker_dir, exist_ok=True)
+    requested_years = sorted(years) if years is not None else None
+    for name, df in statements.items():
+        if df is None or df.empty:
+            result["skipped"].append(name)
+            continue
+        periods = statement_periods(df)
+        if not force and _up_to_date(previous_state.get(name), periods, requested_years, ticker_dir):
+            result["skipped"].append(name)
+            continue
+        files = []
+        for year in sorted({int(p[:4]) for p in periods}):
+            if years is not None and year not in years:
+                continue
+            files.append(f"{name}_{year}.csv")
+            path = os.path.join(ticker_dir, files[-1])
+            if _write_if_changed(path, filter_by_year(df, year).to_csv()):
+                result["written"].append(path)
+        result["state"][name] = {"periods": periods, "years": requested_years, "files": files}
+    return result
+
+def read_state(raw_dir):
+    path = os.path.join(raw_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def collect(tickers, raw_dir=RAW_DATA_DIR, source=None, max_workers=8, retries=3, backoff=1.0,
+            years=None, force=False):
+    """
+    Collects statements for `tickers` into raw_dir/<TICKER>/ using up to
+    max_workers concurrent fetches, and updates the state file.
+    source defaults to YFinanceSource; years optionally limits which fiscal
+    years are saved. Returns one summary dict per ticker, in input order;
+    failed tickers carry an "error" and keep their previous state.
+    """
+    source = source if source is not None else YFinanceSource()
+    os.makedirs(raw_dir, exist_ok=True)
+    state = read_state(raw_dir)
+
+    def run(ticker):
+        return collect_ticker(source, ticker, raw_dir, state.get(ticker, {}), years=years,
+                              retries=retries, backoff=backoff, force=force)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(run, tickers))
+
+    for result in results:
+        if "error" not in result:
+            state[result["ticker"]] = result["state"]
+    _write_if_changed(os.path.join(raw_dir, STATE_FILE), json.dumps(state, indent=2, sort_keys=True))
+    return results
 
-balance_2023 = filter_by_year(balance_sheet, 2023)
-balance_2024 = filter_by_year(balance_sheet, 2024)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("tickers", nargs="*", help="defaults to the tickers in data/companies.json")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--years", type=int, nargs="*", help="fiscal years to save (default: all)")
+    parser.add_argument("--force", action="store_true", help="rewrite statements with unchanged periods")
+    args = parser.parse_args()
 
-cashflow_2023 = filter_by_year(cash_flow, 2023)
-cashflow_2024 = filter_by_year(cash_flow, 2024)
+    tickers = args.tickers
+    if not tickers:
+        with open(os.path.join(BASE_DIR, "data", "companies.json"), "r", encoding="utf-8") as f:
+            tickers = sorted(json.load(f))
 
-# Save DataFrames to CSV files in the specified folder
-income_2023.to_csv(os.path.join(save_folder, "income_statement_2023.csv"))
-income_2024.to_csv(os.path.join(save_folder, "income_statement_2024.csv"))
-balance_2023.to_csv(os.path.join(save_folder, "balance_sheet_2023.csv"))
-balance_2024.to_csv(os.path.join(save_folder, "balance_sheet_2024.csv"))
-cashflow_2023.to_csv(os.path.join(save_folder, "cash_flow_2023.csv"))
-cashflow_2024.to_csv(os.path.join(save_folder, "cash_flow_2024.csv"))
+    results = collect(tickers, max_workers=args.workers, retries=args.retries,
+                      years=set(args.years) if args.years else None, force=args.force)
+    failed = [r for r in results if "error" in r]
+    written = sum(len(r["written"]) for r in results)
+    for r in failed:
+        print(f"{r['ticker']}: {r['error']}")
+    print(f"{len(results) - len(failed)}/{len(results)} tickers collected, "
+          f"{written} files written, in: {RAW_DATA_DIR}")
 
-print("Financial statements saved in:", save_folder)
+if __name__ == "__main__":
+    main()
@@ -4,76 +4,414 @@ Chunks the financial data from the JSON, embeds using a SentenceTransformer,
 and stores the vectors in a FAISS index.
 """
 
+import os
 import json
+import hashlib
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import faiss
+
+from embedding_store import EmbeddingStore, text_hash
+from financial_store import load_records
+
+# Bump whenever chunk_data changes the text or metadata it produces, so that
+# index bundles built with the old chunking refuse to load.
+# 2: chunks carry a stable chunk id and a content hash.
+# 3: chunk text and metadata carry the record's ticker.
+CHUNKING_VERSION = 3
 
 def chunk_data(financial_records, chunk_size=1):
     """
     Example chunking: each record is effectively a chunk. 
     (If your real data are textual paragraphs, adjust logic accordingly.)
-    Returns a list of tuples: (text, metadata).
+    Returns a list of tuples: (text, metadata, chunk_id, content_hash).
+
+    chunk_id identifies the record across rebuilds (ticker, year and
+    parameter, plus an occurrence counter for repeated pairs), so it stays
+    the same when the value is restated; content_hash changes whenever the
+    text does. Together they tell update_bundle what to re-encode.
     """
     chunks = []
+    occurrences = {}
     for record in financial_records:
-        # Example text: "Year 2023, Parameter: Revenue, Value: 123456"
+        # Example text: "Ticker: AAPL, Year 2023, Parameter: Revenue, Value: 123456"
         # Or tailor the text representation to your needs
         text = (f"Year: {record['year']}, "
                 f"Parameter: {record['finance_parameter']}, "
                 f"Value: {record['value']}")
+        if record.get("ticker"):
+            # Figures of different companies must not read the same
+            text = f"Ticker: {record['ticker']}, " + text
         meta = {
             "year": record["year"],
             "finance_parameter": record["finance_parameter"],
-            "value": record["value"]
+            "value": record["value"],
+            "statement": record.get("statement"),
+            "ticker": record.get("ticker")
         }
-        chunks.append((text, meta))
+        key = (record.get("ticker"), record["year"], record["finance_parameter"])
+        occurrences[key] = occurrences.get(key, 0) + 1
+        chunk_id = text_hash(json.dumps([*key, occurrences[key]]))
+        chunks.append((text, meta, chunk_id, text_hash(text)))
     return chunks
 
-def build_faiss_index(chunks, model_name="sentence-transformers/all-MiniLM-L6-v2"):
+# Index types accepted by make_index / build_faiss_index
+INDEX_TYPES = ("flat", "sq8", "sq_fp16", "hnsw", "ivf_flat", "ivf_pq")
+
+# Scalar quantizer (faiss.ScalarQuantizer attribute) of each compressed
+# flat index type
+SCALAR_QUANTIZERS = {
+    "sq8": "QT_8bit",
+    "sq_fp16": "QT_fp16"
+}
+
+# index_config keys that are not make_index parameters
+SEARCH_CONFIG_KEYS = ("search_params", "rescore_factor")
+
+def make_index(dim, index_type="flat", num_vectors=None, nlist=None, hnsw_m=32,
+               ef_construction=40, pq_m=16, pq_nbits=8):
+    """
+    Creates an empty inner-product FAISS index of the given type:
+      flat     -- exact search (IndexFlatIP)
+      sq8      -- exhaustive search over 8-bit scalar-quantized vectors
+                  (IndexScalarQuantizer), a quarter of the flat size
+      sq_fp16  -- the same over float16 vectors, half the flat size
+      hnsw     -- graph search (IndexHNSWFlat), hnsw_m links per node
+      ivf_flat -- nlist inverted lists of full vectors (IndexIVFFlat)
+      ivf_pq   -- nlist inverted lists of product-quantized codes, pq_m
+                  sub-vectors of pq_nbits bits each (IndexIVFPQ)
+    Vectors are expected to be L2-normalized, so inner product is cosine.
+    nlist defaults to ~4*sqrt(num_vectors), capped so each list gets enough
+    training points; pq_nbits is capped likewise for tiny corpora.
+    """
+    import faiss
+
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+    if index_type in SCALAR_QUANTIZERS:
+        quantizer = getattr(faiss.ScalarQuantizer, SCALAR_QUANTIZERS[index_type])
+        return faiss.IndexScalarQuantizer(dim, quantizer, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    if index_type in ("ivf_flat", "ivf_pq"):
+        if nlist is None:
+            n = num_vectors or 1
+            nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        if dim % pq_m != 0:
+            raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dim}")
+        if num_vectors:
+            pq_nbits = max(1, min(pq_nbits, int(np.log2(num_vectors))))
+        return faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index_type {index_type!r}; expected one of {INDEX_TYPES}")
+
+def index_from_embeddings(embeddings, index_type="flat", train_size=50000, seed=0, ids=None,
+                          **index_params):
+    """
+    Normalizes `embeddings` in place, builds an index of `index_type`,
+    trains it on a random sample of at most train_size vectors if it
+    needs training (IVF/PQ) and adds all vectors.
+    With `ids` (e.g. chunk ids) the index returns those ids instead of row
+    numbers and supports add_embeddings/remove_ids: IVF indexes store ids
+    natively, flat and HNSW indexes are wrapped in an IndexIDMap2.
+    """
+    import faiss
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    faiss.normalize_L2(embeddings)
+    index = make_index(embeddings.shape[1], index_type, num_vectors=len(embeddings), **index_params)
+    if not index.is_trained:
+        sample = embeddings
+        if len(embeddings) > train_size:
+            rows = np.random.default_rng(seed).choice(len(embeddings), train_size, replace=False)
+            sample = embeddings[np.sort(rows)]
+        index.train(sample)
+    if ids is None:
+        index.add(embeddings)
+    else:
+        if _ivf(index) is None:
+            index = faiss.IndexIDMap2(index)
+        index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    return index, embeddings
+
+def add_embeddings(index, embeddings, ids):
+    """
+    Normalizes `embeddings` and adds them to an ID-mapped index under `ids`.
+    Returns the normalized embeddings.
+    """
+    import faiss
+
+    embeddings = np.array(embeddings, dtype=np.float32, order="C")
+    faiss.normalize_L2(embeddings)
+    index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    return embeddings
+
+def remove_ids(index, ids):
+    """
+    Removes the vectors stored under `ids` from an ID-mapped index and
+    returns the index. HNSW graphs cannot delete nodes, so an HNSW index is
+    rebuilt from its own stored vectors (nothing is re-encoded); this costs
+    a graph build rather than a deletion.
+    """
+    import faiss
+
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return index
+    base = _base_index(index)
+    if not isinstance(base, faiss.IndexHNSW):
+        index.remove_ids(ids)
+        return index
+    stored_ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(stored_ids, ids)
+    vectors = base.reconstruct_n(0, base.ntotal)[keep]
+    hnsw = make_index(base.d, "hnsw", hnsw_m=base.hnsw.nb_neighbors(1),
+                      ef_construction=base.hnsw.efConstruction)
+    hnsw.hnsw.efSearch = base.hnsw.efSearch
+    rebuilt = faiss.IndexIDMap2(hnsw)
+    rebuilt.add_with_ids(vectors, stored_ids[keep])
+    return rebuilt
+
+def reconstruct_vectors(index, ids):
+    """
+    The stored (L2-normalized) vectors of `ids` in an ID-mapped index,
+    decoded from the index, so they are approximate for quantized types.
+    IVF indexes get a hash-table direct map on first use.
+    """
+    import faiss
+
+    if isinstance(index, RescoredIndex):
+        index = index.index
+    ivf = _ivf(index)
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_batch(ids)
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """
+    Sets default query-time parameters on an index: nprobe (inverted lists
+    visited) for IVF indexes, efSearch (candidate list size) for HNSW.
+    Parameters that do not apply to the index are ignored.
+    """
+    import faiss
+
+    params = faiss.ParameterSpace()
+    if nprobe is not None and _ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None and isinstance(_base_index(index), faiss.IndexHNSW):
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+def search_parameters(index, nprobe=None, ef_search=None, ids=None):
+    """
+    Per-call search parameters for index.search(..., params=...), or None
+    if none apply to this index type.
+    ids restricts the search to the vectors stored under those ids (the
+    labels the index returns, e.g. chunk ids) through an IDSelectorBatch;
+    the index's own nprobe/efSearch defaults still apply.
+    """
+    import faiss
+
+    if isinstance(index, RescoredIndex):
+        index = index.index
+    ivf = _ivf(index)
+    base = _base_index(index)
+    kwargs = {}
+    if ids is not None:
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        kwargs["sel"] = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+    if ivf is not None and (nprobe is not None or kwargs):
+        return faiss.SearchParametersIVF(nprobe=nprobe or ivf.nprobe, **kwargs)
+    if isinstance(base, faiss.IndexHNSW) and (ef_search is not None or kwargs):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or base.hnsw.efSearch, **kwargs)
+    if kwargs:
+        return faiss.SearchParameters(**kwargs)
+    return None
+
+class RescoredIndex:
+    """
+    Two-stage search: a compact first-pass index (e.g. sq8 or ivf_pq) finds
+    a shortlist of k * factor candidates, which are re-scored exactly
+    against full-precision vectors, typically memory-mapped from disk so
+    only the shortlisted rows are read. search() has the signature of
+    faiss's Index.search, so this drops in for the index in hybrid_search.
+
+    vectors holds the L2-normalized float32 vector of each row; `rows`
+    maps the labels the index returns to rows of vectors (e.g.
+    index_bundle.ChunkIdMap.rows), or None when labels are rows.
+    """
+    def __init__(self, index, vectors, rows=None, factor=4):
+        self.index = index
+        self.vectors = vectors
+        self.rows = rows
+        self.factor = factor
+
+    @property
+    def d(self):
+        return self.index.d
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def search(self, queries, k, params=None):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        shortlist = max(k, min(k * self.factor, self.index.ntotal))
+        _, labels = self.index.search(queries, shortlist, params=params)
+        rows = self.rows(labels) if self.rows is not None else labels
+        valid = rows >= 0
+
+        # Exact inner products of each query with its own shortlist
+        candidates = np.asarray(self.vectors[np.where(valid, rows, 0).ravel()], dtype=np.float32)
+        scores = np.einsum("qsd,qd->qs", candidates.reshape(*rows.shape, -1), queries)
+        scores[~valid] = -np.inf
+
+        top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        top_labels = np.where(np.isfinite(top_scores), np.take_along_axis(labels, top, axis=1), -1)
+        return top_scores.astype(np.float32), top_labels
+
+def _base_index(index):
+    """
+    The index behind an IndexIDMap/IndexIDMap2 wrapper, else `index` itself.
+    """
+    import faiss
+
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+def _ivf(index):
+    import faiss
+
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+def build_faiss_index(chunks, model_name="sentence-transformers/all-MiniLM-L6-v2", model=None,
+                      index_type="flat", store=None, **index_params):
     """
     Embeds each chunk with SentenceTransformer, builds a FAISS index,
     and returns (index, embeddings, metadata).
+    Pass an already loaded `model` to avoid loading it a second time.
+    Embeddings are L2-normalized so every index type ranks by cosine
+    similarity; see make_index for index_type and its parameters.
+    The index is keyed by chunk id (see chunk_data), not by position.
+    With an EmbeddingStore, only texts it has not seen are encoded.
     """
-    model = SentenceTransformer(model_name)
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
     
     texts = [c[0] for c in chunks]
     metadata = [c[1] for c in chunks]
     
-    # Embed
-    embeddings = model.encode(texts, convert_to_numpy=True)
-    dim = embeddings.shape[1]  # e.g. 384 for MiniLM-L6-v2
+    # Embed (through the store, if any)
+    if store is not None:
+        embeddings = store.encode(model, texts)
+    else:
+        embeddings = model.encode(texts, convert_to_numpy=True)
     
-    # Build FAISS index
-    # Here we use a simple IndexFlatIP (inner product). For better retrieval 
-    # you might consider normalizing embeddings or using IndexFlatL2, etc.
-    index = faiss.IndexFlatIP(dim)
-    index.add(embeddings)
+    # Build FAISS index over normalized vectors (e.g. 384-d for MiniLM-L6-v2)
+    index, embeddings = index_from_embeddings(
+        embeddings, index_type, ids=[c[2] for c in chunks], **index_params
+    )
     
     return index, embeddings, metadata
 
+def model_fingerprint(model, model_name):
+    """
+    Returns a short hash identifying the embedding model: its name plus the
+    parameter names, shapes and a sample of the weights of each tensor.
+    Hashing weights (rather than a probe embedding) keeps the fingerprint
+    stable across hardware and BLAS builds.
+    A quantized query encoder (retrieval.load_dense_model) reports the
+    fingerprint of the fp32 model it was made from.
+    """
+    source_fingerprint = getattr(model, "source_fingerprint", None)
+    if source_fingerprint is not None:
+        return source_fingerprint
+    h = hashlib.sha256(model_name.encode("utf-8"))
+    state_dict = model.state_dict() if hasattr(model, "state_dict") else {}
+    for name, tensor in state_dict.items():
+        values = tensor.detach().cpu().float().numpy().ravel()[:256]
+        h.update(name.encode("utf-8"))
+        h.update(str(tuple(tensor.shape)).encode("utf-8"))
+        h.update(values.tobytes())
+    return h.hexdigest()[:16]
+
+def build_bundle(chunks, bundle_dir, model, model_name, index_config=None, store_dir=None):
+    """
+    Writes the index bundle for `chunks` to bundle_dir. If a compatible
+    bundle is already there (same versions, model and index config) it is
+    updated incrementally: only new or changed chunks are encoded.
+    Otherwise the bundle is rebuilt from scratch, encoding only the texts
+    missing from the embedding store in store_dir (if given).
+    Returns (manifest, stats) with the added/removed/unchanged chunk counts.
+    """
+    from retrieval import build_bm25_index
+    from index_bundle import write_bundle, update_bundle, BundleVersionError
+
+    index_config = index_config or {"index_type": "flat"}
+    fingerprint = model_fingerprint(model, model_name)
+    store = EmbeddingStore(store_dir, model_name, fingerprint) if store_dir else None
+    if os.path.exists(bundle_dir):
+        try:
+            return update_bundle(bundle_dir, chunks, model, model_name, fingerprint, index_config,
+                                 store=store)
+        except BundleVersionError as e:
+            print(f"Rebuilding {bundle_dir}: {e}")
+
+    build_params = {k: v for k, v in index_config.items() if k not in SEARCH_CONFIG_KEYS}
+    index, embeddings, _ = build_faiss_index(chunks, model_name, model=model, store=store, **build_params)
+    bm25 = build_bm25_index(chunks)
+    # Re-scored bundles keep the full-precision vectors next to the index
+    vectors = embeddings if index_config.get("rescore_factor") else None
+    manifest = write_bundle(bundle_dir, index, chunks, bm25, model_name, fingerprint, index_config,
+                            vectors=vectors)
+    return manifest, {"added": len(chunks), "removed": 0, "unchanged": 0}
+
 def save_index(index, index_path):
     """
     Serializes the FAISS index to disk.
     """
+    import faiss
     faiss.write_index(index, index_path)
 
 def load_index(index_path):
     """
     Loads a FAISS index from disk.
     """
+    import faiss
     return faiss.read_index(index_path)
 
 if __name__ == "__main__":
-    # Example usage
     BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    json_path = os.path.join(BASE_DIR,"data","processed","financial_data.json")
-    index_path = os.path.join(BASE_DIR,"embeddings","financial_data.index")
+    records_dir = os.path.join(BASE_DIR, "data", "processed", "financial_data")
+    bundle_dir = os.path.join(BASE_DIR,"embeddings","financial_bundle")
+    store_dir = os.path.join(BASE_DIR,"embeddings","embedding_store")
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+    # One bundle over every ticker in the store: chunks carry their ticker
+    # and app.py searches the company picked in its sidebar (shards.py
+    # builds one bundle per ticker instead).
+    # Exact search is fine for one ticker; see bench_ann.py to pick an ANN
+    # configuration for larger corpora, e.g.
+    # {"index_type": "hnsw", "hnsw_m": 32, "search_params": {"ef_search": 64}}
+    # or, to cut resident memory 4x, an int8 index whose shortlist of
+    # 4*k is re-scored against float32 vectors memory-mapped from disk:
+    # {"index_type": "sq8", "rescore_factor": 4}
+    index_config = {"index_type": "flat"}
     
-    with open(json_path, "r", encoding="utf-8") as f:
-        financial_records = json.load(f)
+    financial_records = load_records(records_dir)
     
     chunks = chunk_data(financial_records)
-    index, embeddings, metadata = build_faiss_index(chunks)
-    save_index(index, index_path)
-    print(f"FAISS index built and saved to {index_path}")
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name)
+    manifest, stats = build_bundle(chunks, bundle_dir, model, model_name, index_config, store_dir)
+    print(f"Index bundle saved to {bundle_dir}: {stats['added']} chunks encoded, "
+          f"{stats['removed']} removed, {stats['unchanged']} unchanged")
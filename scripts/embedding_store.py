@@ -0,0 +1,158 @@
+# embedding_store.py
+"""
+Disk-backed store of chunk embeddings for the build pipeline, keyed by
+(model, text hash), so rebuilding an index with a different index type or
+chunking only encodes texts the model has never seen.
+
+Layout of a store directory (one subdirectory per model):
+    <model>/meta.json     model name, fingerprint and embedding dimension
+    <model>/vectors.bin   float32 vectors, appended row by row (memory-mapped)
+    <model>/keys.npy      int64 text hash per row: the offset table
+
+encode() options that change the vectors (normalize_embeddings, precision,
+...) are hashed together with the text, as query_cache.CachedEncoder keys
+its entries, so vectors encoded with other options are never returned.
+
+Vectors are only ever appended. keys.npy is rewritten atomically after the
+vectors it points to are on disk, so rows past the end of the key table
+(from an interrupted write) are simply ignored.
+"""
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+
+from query_cache import OUTPUT_NEUTRAL_KWARGS
+
+def text_hash(text):
+    """
+    Non-negative int64 hash of a string (FAISS ids must fit in int64).
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") & 0x7FFFFFFFFFFFFFFF
+
+
+class EmbeddingStore:
+    """
+    Embeddings of one model, looked up by text hash.
+    Pass model_fingerprint (see embedding.model_fingerprint) so vectors of a
+    retrained model with the same name are kept apart.
+    """
+    def __init__(self, store_dir, model_name, model_fingerprint=None):
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        if model_fingerprint:
+            name = f"{name}-{model_fingerprint}"
+        self.path = os.path.join(store_dir, name)
+        self.model_name = model_name
+        self.model_fingerprint = model_fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+        self._keys = np.empty(0, dtype=np.int64)
+        self._rows = {}
+        self._vectors = None
+        os.makedirs(self.path, exist_ok=True)
+
+        meta_path = os.path.join(self.path, "meta.json")
+        keys_path = os.path.join(self.path, "keys.npy")
+        if os.path.exists(meta_path) and os.path.exists(keys_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            self._keys = np.load(keys_path)
+            self._rows = {key: row for row, key in enumerate(self._keys.tolist())}
+            self._map_vectors()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _map_vectors(self):
+        if len(self._keys):
+            self._vectors = np.memmap(
+                os.path.join(self.path, "vectors.bin"), dtype=np.float32, mode="r",
+                shape=(len(self._keys), self.dim)
+            )
+
+    def get(self, hashes):
+        """
+        Returns (vectors, found): a (len(hashes), dim) array of the stored
+        vectors and a mask that is False for hashes not in the store (their
+        rows are zero).
+        """
+        rows = np.array([self._rows.get(h, -1) for h in hashes], dtype=np.int64)
+        found = rows >= 0
+        vectors = np.zeros((len(hashes), self.dim or 0), dtype=np.float32)
+        if found.any():
+            vectors[found] = self._vectors[rows[found]]
+        return vectors, found
+
+    def add(self, hashes, vectors):
+        """
+        Appends vectors for text hashes not already stored.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"model_name": self.model_name,
+                           "model_fingerprint": self.model_fingerprint,
+                           "dim": self.dim}, f)
+        new = {}
+        for h, vector in zip(hashes, vectors):
+            if h not in self._rows:
+                new.setdefault(h, vector)
+        if not new:
+            return
+
+        # Truncate rows a previous interrupted write left behind the key table
+        with open(os.path.join(self.path, "vectors.bin"), "ab") as f:
+            f.truncate(len(self._keys) * self.dim * 4)
+            f.write(np.ascontiguousarray(np.vstack(list(new.values())), dtype=np.float32).tobytes())
+        for h in new:
+            self._rows[h] = len(self._rows)
+        self._keys = np.concatenate([self._keys, np.fromiter(new, dtype=np.int64, count=len(new))])
+        tmp_path = os.path.join(self.path, "keys.tmp.npy")
+        np.save(tmp_path, self._keys)
+        os.replace(tmp_path, os.path.join(self.path, "keys.npy"))
+        self._map_vectors()
+
+    def encode(self, model, texts, **kwargs):
+        """
+        model.encode(texts) through the store: cached vectors are read from
+        disk and only the misses (each distinct text once) reach the model.
+        Returns a float32 array with one row per text.
+        """
+        options = sorted((k, v) for k, v in kwargs.items() if k not in OUTPUT_NEUTRAL_KWARGS)
+        # Default options keep the plain text hash, so existing stores stay valid
+        prefix = f"{options}\0" if options else ""
+        hashes = [text_hash(prefix + t) for t in texts]
+        vectors, found = self.get(hashes)
+        missing = {}
+        for i in np.flatnonzero(~found):
+            missing.setdefault(hashes[i], []).append(i)
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        if not missing:
+            return vectors
+
+        positions = list(missing.values())
+        encoded = np.asarray(
+            model.encode([texts[p[0]] for p in positions], convert_to_numpy=True, **kwargs),
+            dtype=np.float32
+        )
+        if vectors.shape[1] != encoded.shape[1]:
+            vectors = np.zeros((len(texts), encoded.shape[1]), dtype=np.float32)
+        for group, vector in zip(positions, encoded):
+            vectors[group] = vector
+        self.add(list(missing), encoded)
+        return vectors
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,134 @@
+# financial_store.py
+"""
+Typed columnar store for the cleaned financial records written by
+preprocess.py, read lazily by embedding.py, shards.py and the benchmarks.
+
+Layout of a store directory (data/processed/financial_data/):
+    manifest.json         format version and record count
+    year.npy              int32 fiscal year per record
+    value.npy             float64 value per record
+    parameter.npy         int32 code per record into parameters.json
+    parameters.json       string table of finance_parameter names
+    ticker.npy            int32 code per record into tickers.json
+    tickers.json          string table of tickers ("" for records without one)
+    statement.npy         int32 code per record into statements.json
+    statements.json       string table of statement types ("income_statement",
+                          "balance_sheet", "cash_flow"; "" when unknown)
+
+Columns are memory-mapped, so opening a store costs the same for ten
+records or ten million; records are only materialized when accessed.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+# 2: records carry the statement they come from
+STORE_FORMAT_VERSION = 2
+COLUMNS = ("year", "value", "parameter", "ticker", "statement")
+
+
+class FinancialRecords:
+    """
+    Read-only sequence of records backed by columns. records[i] returns the
+    same dict preprocess.load_and_clean_data produces:
+    {"year", "finance_parameter", "value"} plus "ticker" and "statement"
+    when they are known.
+    """
+    def __init__(self, years, values, parameter_codes, parameters, ticker_codes, tickers,
+                 statement_codes, statements):
+        self.years = years
+        self.values = values
+        self.parameter_codes = parameter_codes
+        self.parameters = parameters
+        self.ticker_codes = ticker_codes
+        self.tickers = tickers
+        self.statement_codes = statement_codes
+        self.statements = statements
+
+    def __len__(self):
+        return len(self.years)
+
+    def __getitem__(self, i):
+        record = {
+            "year": int(self.years[i]),
+            "finance_parameter": self.parameters[self.parameter_codes[i]],
+            "value": float(self.values[i])
+        }
+        ticker = self.tickers[self.ticker_codes[i]]
+        if ticker:
+            record["ticker"] = ticker
+        statement = self.statements[self.statement_codes[i]]
+        if statement:
+            record["statement"] = statement
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_records(out_dir, years, values, parameters, tickers, statements=None):
+    """
+    Writes a store from parallel columns (sequences or arrays of equal
+    length; tickers and statements may contain "" or None for records
+    without one; statements=None leaves every record's statement unknown).
+    The store is assembled in a temporary directory and moved into place.
+    Returns the manifest.
+    """
+    tmp_dir = out_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    parameter_table, parameter_codes = np.unique(np.asarray(parameters, dtype=str), return_inverse=True)
+    tickers = np.array(["" if t is None else t for t in tickers], dtype=str)
+    ticker_table, ticker_codes = np.unique(tickers, return_inverse=True)
+    if statements is None:
+        statements = [""] * len(tickers)
+    statements = np.array(["" if s is None else s for s in statements], dtype=str)
+    statement_table, statement_codes = np.unique(statements, return_inverse=True)
+    np.save(os.path.join(tmp_dir, "year.npy"), np.asarray(years, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "value.npy"), np.asarray(values, dtype=np.float64))
+    np.save(os.path.join(tmp_dir, "parameter.npy"), parameter_codes.astype(np.int32))
+    np.save(os.path.join(tmp_dir, "ticker.npy"), ticker_codes.astype(np.int32))
+    np.save(os.path.join(tmp_dir, "statement.npy"), statement_codes.astype(np.int32))
+    with open(os.path.join(tmp_dir, "parameters.json"), "w", encoding="utf-8") as f:
+        json.dump(parameter_table.tolist(), f)
+    with open(os.path.join(tmp_dir, "tickers.json"), "w", encoding="utf-8") as f:
+        json.dump(ticker_table.tolist(), f)
+    with open(os.path.join(tmp_dir, "statements.json"), "w", encoding="utf-8") as f:
+        json.dump(statement_table.tolist(), f)
+
+    manifest = {"format_version": STORE_FORMAT_VERSION, "num_records": len(tickers)}
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return manifest
+
+def load_records(store_dir):
+    """
+    Memory-maps a store written by write_records.
+    """
+    with open(os.path.join(store_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != STORE_FORMAT_VERSION:
+        raise ValueError(
+            f"Record store format {manifest.get('format_version')} != expected "
+            f"{STORE_FORMAT_VERSION}; rerun preprocess.py")
+
+    def column(name):
+        return np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+
+    def table(name):
+        with open(os.path.join(store_dir, f"{name}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    return FinancialRecords(
+        column("year"), column("value"), column("parameter"), table("parameters"),
+        column("ticker"), table("tickers"), column("statement"), table("statements")
+    )
@@ -1,12 +1,14 @@
 # guardrails.py
-
-import re
 """
 Very naive guardrails to filter out harmful queries (input filtering)
 and to detect or adjust misleading/hallucinated outputs (output filtering).
 In practice, you'd want something more robust, possibly a policy-based approach.
 """
 
+import re
+
+from instrumentation import stage
+
 # Simple keywords for demonstration
 HARMFUL_KEYWORDS = ["kill", "attack", "terrorist", "bomb", "hate", "abuse"]
 PROHIBITED_TOPICS = ["violent", "illegal"]
@@ -161,6 +163,92 @@ def reject_harmful_query(query):
             return True
     return False
 
+class GuardrailEngine:
+    """
+    Compiles every keyword set into one combined regex, once, and classifies
+    a query in a single pass over its text.
+
+    Decisions match the functions above: a query is financial if any keyword
+    occurs as a whole word (is_financial_question) and harmful if any harmful
+    keyword or prohibited topic occurs as a substring (reject_harmful_query).
+    Within the pattern longer keywords come first, so "cash flow" is reported
+    as cash_flow rather than the balance-sheet "cash".
+    """
+    HARMFUL = "harmful"
+    FINANCE = "finance"
+
+    def __init__(self, keywords_dict=FINANCE_KEYWORDS, harmful_keywords=HARMFUL_KEYWORDS + PROHIBITED_TOPICS):
+        # Matched keyword -> its category (the first one, if listed twice)
+        self.keyword_categories = {}
+        for category, keywords in keywords_dict.items():
+            for kw in keywords:
+                self.keyword_categories.setdefault(kw.lower(), category)
+        harmful_keywords = [kw.lower() for kw in harmful_keywords]
+
+        def alternation(keywords):
+            return "|".join(re.escape(kw) for kw in sorted(set(keywords), key=lambda kw: (-len(kw), kw)))
+
+        parts = []
+        if harmful_keywords:
+            parts.append(f"(?P<{self.HARMFUL}>{alternation(harmful_keywords)})")
+        if self.keyword_categories:
+            parts.append(rf"\b(?P<{self.FINANCE}>{alternation(self.keyword_categories)})\b")
+        self.pattern = re.compile("|".join(parts)) if parts else None
+
+        # Matches do not overlap, so if a harmful keyword can hide inside a
+        # finance keyword (or the reverse) the harmful scan runs separately.
+        overlapping = any(
+            h in kw or kw in h
+            for h in harmful_keywords for kw in self.keyword_categories
+        )
+        self.harmful_pattern = re.compile(alternation(harmful_keywords)) if overlapping else None
+
+    def classify(self, query):
+        """
+        Returns a dict:
+          category   -- "harmful", else the first finance category matched, else None
+          categories -- every finance category matched, in order of appearance
+          harmful    -- True if the query should be rejected
+          financial  -- True if any finance keyword matched
+        """
+        with stage("guardrail"):
+            return self._classify(query)
+
+    def _classify(self, query):
+        query_lower = query.lower()
+        harmful = False
+        categories = []
+        if self.pattern is not None:
+            for match in self.pattern.finditer(query_lower):
+                group = match.lastgroup
+                if group == self.HARMFUL:
+                    harmful = True
+                    continue
+                category = self.keyword_categories[match.group(group)]
+                if category not in categories:
+                    categories.append(category)
+        if self.harmful_pattern is not None:
+            harmful = self.harmful_pattern.search(query_lower) is not None
+        if harmful:
+            category = self.HARMFUL
+        else:
+            category = categories[0] if categories else None
+        return {
+            "category": category,
+            "categories": categories,
+            "harmful": harmful,
+            "financial": bool(categories)
+        }
+
+    def classify_batch(self, queries):
+        return [self.classify(q) for q in queries]
+
+    def is_financial_question(self, query):
+        return self.classify(query)["financial"]
+
+    def reject_harmful_query(self, query):
+        return self.classify(query)["harmful"]
+
 def filter_misleading_output(text):
     """
     Naive approach to detect if the text is purely hallucinated or contradictory.
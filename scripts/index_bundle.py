@@ -0,0 +1,509 @@
+# index_bundle.py
+"""
+A versioned, on-disk bundle holding everything the app needs to serve queries:
+the FAISS index, the chunk texts, columnar chunk metadata, precomputed BM25
+statistics and a fingerprint of the embedding model.
+
+embedding.py writes the bundle once; the app memory-maps it at startup instead
+of re-reading the JSON, re-chunking and rebuilding BM25 on every rerun.
+
+A bundle directory holds one subdirectory per build (named by its build id)
+and a CURRENT file naming the live one. write_bundle fills a new version
+directory and then swaps CURRENT with os.replace, so a reader sees either
+the old or the new build, and files the app has memory-mapped are never
+rewritten. The previous version is kept for readers still loading it;
+older ones are removed.
+
+Layout of a version directory:
+    manifest.json         versions, model name/fingerprint, sizes, BM25 params,
+                          index type and default search params
+    faiss.index           the FAISS index, keyed by chunk id (read with IO_FLAG_MMAP)
+    chunk_ids.npy         int64 chunk id per row (see embedding.chunk_data)
+    chunk_hashes.npy      int64 content hash per row
+    vectors.npy           float32 L2-normalized vector per row, only for
+                          re-scored indexes (index config "rescore_factor")
+    texts.bin             UTF-8 chunk texts, concatenated
+    text_offsets.npy      int64 offsets into texts.bin (num_chunks + 1)
+    meta_year.npy         int32 year per chunk
+    meta_value.npy        float64 value per chunk
+    meta_parameter.npy    int32 code per chunk into parameters.json
+    parameters.json       string table of finance_parameter names
+    meta_statement.npy    int32 code per chunk into statements.json
+    statements.json       string table of statement types ("" when unknown)
+    meta_ticker.npy       int32 code per chunk into tickers.json
+    tickers.json          string table of tickers ("" when unknown)
+    bm25_vocab.json       BM25 vocabulary (term id -> term)
+    bm25_idf.npy          float64 idf per term id
+    bm25_doc_len.npy      int32 token count per chunk
+    bm25_indptr.npy       CSR row pointers (one row per chunk)
+    bm25_indices.npy      CSR term ids
+    bm25_tf.npy           CSR term frequencies
+
+The BM25 arrays are exactly the statistics SparseBM25 keeps, so loading
+them only derives the weight matrix; nothing is re-tokenized.
+
+With a "rescore_factor" in the index config (e.g. an sq8 index), the loaded
+faiss_index is an embedding.RescoredIndex: the compact index finds a
+shortlist that is re-scored exactly against the memory-mapped vectors.npy.
+
+update_bundle refreshes a bundle in place of a rebuild: chunks whose id and
+content hash are unchanged keep their vectors and BM25 statistics, and only
+new or changed chunks are encoded and counted.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+from bm25 import SparseBM25, TOKENIZATION_VERSION, tokenize
+from query_filters import MetadataPartitions
+from embedding import (CHUNKING_VERSION, RescoredIndex, set_search_params, add_embeddings, remove_ids,
+                       reconstruct_vectors)
+
+# Bump whenever the bundle layout changes.
+# 3: vectors are L2-normalized and the manifest records the index type.
+# 4: the FAISS index is keyed by chunk id; chunk ids and hashes are stored.
+# 5: chunk metadata includes the statement type.
+# 6: chunk metadata includes the ticker.
+# 7: builds are version directories under a CURRENT pointer.
+BUNDLE_FORMAT_VERSION = 7
+
+CURRENT_FILE = "CURRENT"
+KEEP_VERSIONS = 2
+MANIFEST_FILE = "manifest.json"
+FAISS_FILE = "faiss.index"
+BM25_ARRAYS = ("idf", "doc_len", "indptr", "indices", "tf")
+
+
+class BundleVersionError(RuntimeError):
+    """
+    Raised when a bundle was built with a different format, chunking or
+    tokenization version, or embedding model, than the one loading it.
+    """
+
+
+class ChunkTexts:
+    """
+    Read-only sequence of chunk texts backed by a memory-mapped UTF-8 blob.
+    Texts are decoded on access, so nothing is materialized at load time.
+    """
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return bytes(self._blob[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ColumnarMetadata:
+    """
+    Read-only sequence of chunk metadata stored column-wise.
+    metadata[i] returns the same dict chunk_data produced for chunk i.
+    """
+    def __init__(self, years, values, parameter_codes, parameters, statement_codes, statements,
+                 ticker_codes, tickers):
+        self.years = years
+        self.values = values
+        self.parameter_codes = parameter_codes
+        self.parameters = parameters
+        self.statement_codes = statement_codes
+        self.statements = statements
+        self.ticker_codes = ticker_codes
+        self.tickers = tickers
+
+    def __len__(self):
+        return len(self.years)
+
+    def __getitem__(self, i):
+        return {
+            "year": int(self.years[i]),
+            "finance_parameter": self.parameters[self.parameter_codes[i]],
+            "value": float(self.values[i]),
+            "statement": self.statements[self.statement_codes[i]] or None,
+            "ticker": self.tickers[self.ticker_codes[i]] or None
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ChunkIdMap:
+    """
+    Maps the chunk ids returned by the FAISS index back to bundle rows.
+    """
+    def __init__(self, chunk_ids):
+        self.chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        self._order = np.argsort(self.chunk_ids, kind="stable")
+        self._sorted = self.chunk_ids[self._order]
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def rows(self, ids):
+        """
+        Row of each id, as an array shaped like `ids`; FAISS's -1 padding
+        (fewer hits than k) and unknown ids map to -1.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self._sorted) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self._sorted, ids), len(self._sorted) - 1)
+        return np.where(self._sorted[pos] == ids, self._order[pos], -1)
+
+
+class IndexBundle:
+    """
+    Everything loaded from a bundle directory. The attributes line up with
+    the arguments of retrieval.hybrid_search. vectors is None unless the
+    bundle stores full-precision vectors for re-scoring.
+    """
+    def __init__(self, manifest, faiss_index, chunk_texts, metadata, bm25, id_map, chunk_hashes,
+                 vectors=None):
+        self.manifest = manifest
+        self.faiss_index = faiss_index
+        self.chunk_texts = chunk_texts
+        self.metadata = metadata
+        self.bm25 = bm25
+        self.id_map = id_map
+        self.chunk_hashes = chunk_hashes
+        self.vectors = vectors
+        self._partitions = None
+
+    @property
+    def partitions(self):
+        """
+        query_filters.MetadataPartitions of this bundle's metadata, built on
+        first use.
+        """
+        if self._partitions is None:
+            self._partitions = MetadataPartitions(self.metadata)
+        return self._partitions
+
+    @property
+    def version(self):
+        """
+        Identifies this build of the index; changes whenever it is rebuilt.
+        """
+        return self.manifest["build_id"]
+
+    def row_vectors(self, rows):
+        """
+        L2-normalized float32 vectors of the given rows: from vectors.npy
+        when stored, else decoded from the FAISS index.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.vectors is not None:
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+        return reconstruct_vectors(self.faiss_index, self.id_map.chunk_ids[rows])
+
+
+def _write_json(path, obj):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+
+def _read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _load_array(bundle_dir, name):
+    return np.load(os.path.join(bundle_dir, name), mmap_mode="r")
+
+def _map_bytes(path):
+    # mmap refuses empty files (a bundle whose chunks were all removed)
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+def _restore_bm25(bundle_dir, params):
+    """
+    Rebuilds the SparseBM25 index from the stored statistics.
+    """
+    vocab = _read_json(os.path.join(bundle_dir, "bm25_vocab.json"))
+    arrays = [_load_array(bundle_dir, f"bm25_{name}.npy") for name in BM25_ARRAYS]
+    return SparseBM25(vocab, *arrays, k1=params["k1"], b=params["b"], epsilon=params["epsilon"])
+
+def write_bundle(bundle_dir, faiss_index, chunks, bm25, model_name, model_fingerprint,
+                 index_config=None, vectors=None):
+    """
+    Writes a complete bundle for `chunks` (as returned by
+    embedding.chunk_data) to bundle_dir; faiss_index must be keyed by their
+    chunk ids. index_config records how the FAISS index was built, e.g.
+    {"index_type": "ivf_flat", "search_params": {"nprobe": 8}}; its
+    search_params become the index defaults when the bundle is loaded.
+    vectors (the normalized embeddings, one row per chunk) are stored for
+    re-scoring when index_config has a rescore_factor.
+    The bundle is written to a new version directory and CURRENT is then
+    swapped to it, so a reader never sees a half-written bundle and the
+    files of the version being replaced stay in place.
+    """
+    import faiss
+
+    texts = [c[0] for c in chunks]
+    metadata = [c[1] for c in chunks]
+    if faiss_index.ntotal != len(chunks) or bm25.corpus_size != len(chunks):
+        raise ValueError("FAISS index, BM25 index and chunks must have the same length")
+    if (index_config or {}).get("rescore_factor") and (vectors is None or len(vectors) != len(chunks)):
+        raise ValueError("A re-scored index needs one stored vector per chunk")
+
+    build_id = os.urandom(8).hex()
+    os.makedirs(bundle_dir, exist_ok=True)
+    tmp_dir = os.path.join(bundle_dir, build_id + ".tmp")
+    os.makedirs(tmp_dir)
+
+    faiss.write_index(faiss_index, os.path.join(tmp_dir, FAISS_FILE))
+    np.save(os.path.join(tmp_dir, "chunk_ids.npy"), np.array([c[2] for c in chunks], dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "chunk_hashes.npy"), np.array([c[3] for c in chunks], dtype=np.int64))
+    if vectors is not None:
+        np.save(os.path.join(tmp_dir, "vectors.npy"), np.asarray(vectors, dtype=np.float32))
+
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    with open(os.path.join(tmp_dir, "texts.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(tmp_dir, "text_offsets.npy"), offsets)
+
+    parameters = sorted({m["finance_parameter"] for m in metadata})
+    codes = {p: i for i, p in enumerate(parameters)}
+    np.save(os.path.join(tmp_dir, "meta_year.npy"),
+            np.array([m["year"] for m in metadata], dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "meta_value.npy"),
+            np.array([m["value"] for m in metadata], dtype=np.float64))
+    np.save(os.path.join(tmp_dir, "meta_parameter.npy"),
+            np.array([codes[m["finance_parameter"]] for m in metadata], dtype=np.int32))
+    _write_json(os.path.join(tmp_dir, "parameters.json"), parameters)
+    statements = sorted({m.get("statement") or "" for m in metadata})
+    statement_codes = {s: i for i, s in enumerate(statements)}
+    np.save(os.path.join(tmp_dir, "meta_statement.npy"),
+            np.array([statement_codes[m.get("statement") or ""] for m in metadata], dtype=np.int32))
+    _write_json(os.path.join(tmp_dir, "statements.json"), statements)
+    tickers = sorted({m.get("ticker") or "" for m in metadata})
+    ticker_codes = {t: i for i, t in enumerate(tickers)}
+    np.save(os.path.join(tmp_dir, "meta_ticker.npy"),
+            np.array([ticker_codes[m.get("ticker") or ""] for m in metadata], dtype=np.int32))
+    _write_json(os.path.join(tmp_dir, "tickers.json"), tickers)
+
+    _write_json(os.path.join(tmp_dir, "bm25_vocab.json"), bm25.vocab)
+    for name in BM25_ARRAYS:
+        np.save(os.path.join(tmp_dir, f"bm25_{name}.npy"), getattr(bm25, name))
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "chunking_version": CHUNKING_VERSION,
+        "tokenization_version": TOKENIZATION_VERSION,
+        "model_name": model_name,
+        "model_fingerprint": model_fingerprint,
+        "build_id": build_id,
+        "num_chunks": len(chunks),
+        "dim": faiss_index.d,
+        "index": index_config or {"index_type": "flat"},
+        "bm25": {
+            "k1": bm25.k1,
+            "b": bm25.b,
+            "epsilon": bm25.epsilon
+        }
+    }
+    _write_json(os.path.join(tmp_dir, MANIFEST_FILE), manifest)
+
+    os.rename(tmp_dir, os.path.join(bundle_dir, build_id))
+    pointer = os.path.join(bundle_dir, CURRENT_FILE + ".tmp")
+    with open(pointer, "w", encoding="utf-8") as f:
+        f.write(build_id)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer, os.path.join(bundle_dir, CURRENT_FILE))
+    _prune_versions(bundle_dir, build_id)
+    return manifest
+
+def _prune_versions(bundle_dir, current):
+    """
+    Removes all but the KEEP_VERSIONS newest version directories (always
+    keeping `current`), leftovers of interrupted writes and the files of a
+    bundle written before versioning.
+    """
+    versions = []
+    for name in os.listdir(bundle_dir):
+        path = os.path.join(bundle_dir, name)
+        if name == CURRENT_FILE:
+            continue
+        if os.path.isfile(path):
+            os.remove(path)
+        elif name.endswith(".tmp"):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name != current:
+            versions.append((os.path.getmtime(path), path))
+    for _, path in sorted(versions, reverse=True)[KEEP_VERSIONS - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def current_version_dir(bundle_dir):
+    """
+    The version directory CURRENT points to. Raises FileNotFoundError if
+    there is no bundle and BundleVersionError for a bundle written before
+    versioning.
+    """
+    pointer = os.path.join(bundle_dir, CURRENT_FILE)
+    if not os.path.exists(pointer) and os.path.exists(os.path.join(bundle_dir, MANIFEST_FILE)):
+        raise BundleVersionError(
+            f"Bundle {bundle_dir} predates versioned builds; rebuild it with embedding.py")
+    with open(pointer, "r", encoding="utf-8") as f:
+        return os.path.join(bundle_dir, f.read().strip())
+
+def current_build_id(bundle_dir):
+    """
+    Build id of the bundle's current version (its IndexBundle.version),
+    without loading it; changes when write_bundle or update_bundle swaps
+    in a new build.
+    """
+    return os.path.basename(current_version_dir(bundle_dir))
+
+def read_manifest(bundle_dir):
+    return _read_json(os.path.join(current_version_dir(bundle_dir), MANIFEST_FILE))
+
+def check_manifest(manifest, model_name=None, model_fingerprint=None):
+    """
+    Raises BundleVersionError if the manifest does not match the running
+    code (bundle format, chunking or tokenization version) or the given
+    embedding model.
+    """
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise BundleVersionError(
+            f"Bundle format {manifest.get('format_version')} != expected {BUNDLE_FORMAT_VERSION}; "
+            "rebuild it with embedding.py")
+    if manifest.get("chunking_version") != CHUNKING_VERSION:
+        raise BundleVersionError(
+            f"Bundle chunking version {manifest.get('chunking_version')} != expected "
+            f"{CHUNKING_VERSION}; rebuild it with embedding.py")
+    if manifest.get("tokenization_version") != TOKENIZATION_VERSION:
+        raise BundleVersionError(
+            f"Bundle tokenization version {manifest.get('tokenization_version')} != expected "
+            f"{TOKENIZATION_VERSION}; rebuild it with embedding.py")
+    if model_name is not None and manifest["model_name"] != model_name:
+        raise BundleVersionError(
+            f"Bundle was built with {manifest['model_name']}, not {model_name}")
+    if model_fingerprint is not None and manifest["model_fingerprint"] != model_fingerprint:
+        raise BundleVersionError(
+            f"Embedding model fingerprint {model_fingerprint} does not match the bundle "
+            f"({manifest['model_fingerprint']}); rebuild it with embedding.py")
+
+def load_bundle(bundle_dir, model_name=None, model_fingerprint=None, writable=False):
+    """
+    Memory-maps the current version of a bundle written by write_bundle.
+    The manifest is checked before anything else is read, so a stale bundle
+    fails fast with BundleVersionError. Pass writable=True to read the FAISS
+    index into memory so it can be updated (see update_bundle).
+    Bundles with a rescore_factor return a RescoredIndex as faiss_index.
+    """
+    import faiss
+
+    # Resolve CURRENT once: a concurrent write_bundle swaps it
+    bundle_dir = current_version_dir(bundle_dir)
+    manifest = _read_json(os.path.join(bundle_dir, MANIFEST_FILE))
+    check_manifest(manifest, model_name, model_fingerprint)
+
+    io_flags = 0 if writable else faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    faiss_index = faiss.read_index(os.path.join(bundle_dir, FAISS_FILE), io_flags)
+    set_search_params(faiss_index, **manifest["index"].get("search_params", {}))
+    chunk_texts = ChunkTexts(
+        _map_bytes(os.path.join(bundle_dir, "texts.bin")),
+        _load_array(bundle_dir, "text_offsets.npy")
+    )
+    metadata = ColumnarMetadata(
+        _load_array(bundle_dir, "meta_year.npy"),
+        _load_array(bundle_dir, "meta_value.npy"),
+        _load_array(bundle_dir, "meta_parameter.npy"),
+        _read_json(os.path.join(bundle_dir, "parameters.json")),
+        _load_array(bundle_dir, "meta_statement.npy"),
+        _read_json(os.path.join(bundle_dir, "statements.json")),
+        _load_array(bundle_dir, "meta_ticker.npy"),
+        _read_json(os.path.join(bundle_dir, "tickers.json"))
+    )
+    bm25 = _restore_bm25(bundle_dir, manifest["bm25"])
+    id_map = ChunkIdMap(_load_array(bundle_dir, "chunk_ids.npy"))
+    chunk_hashes = _load_array(bundle_dir, "chunk_hashes.npy")
+    vectors = None
+    rescore_factor = manifest["index"].get("rescore_factor")
+    if rescore_factor:
+        vectors = _load_array(bundle_dir, "vectors.npy")
+        faiss_index = RescoredIndex(faiss_index, vectors, id_map.rows, rescore_factor)
+    return IndexBundle(manifest, faiss_index, chunk_texts, metadata, bm25, id_map, chunk_hashes,
+                       vectors)
+
+def update_bundle(bundle_dir, chunks, model, model_name, model_fingerprint, index_config=None,
+                  store=None):
+    """
+    Brings an existing bundle up to date with `chunks` (the full current
+    output of embedding.chunk_data) without rebuilding it:
+      - chunks whose id and content hash are unchanged are kept as they are,
+      - removed or changed chunks are deleted from FAISS and BM25,
+      - new or changed chunks are encoded with `model` (through the
+        embedding_store.EmbeddingStore `store`, if given) and added.
+    Kept rows keep their order and new rows are appended, so the cost is
+    proportional to the number of changed chunks plus rewriting the files.
+    Raises BundleVersionError (as load_bundle does, or if index_config
+    differs from the bundle's) when only a full rebuild will do.
+    Rows are renumbered, so the update is written as a new version (see
+    write_bundle) with a new build_id: caches tied to the old build_id
+    (the app's answer cache and structured lookup) are dropped when a
+    reader picks it up (see current_build_id).
+    Returns (manifest, {"added": n, "removed": n, "unchanged": n}).
+    """
+    bundle = load_bundle(bundle_dir, model_name, model_fingerprint, writable=True)
+    if index_config is not None and index_config != bundle.manifest["index"]:
+        raise BundleVersionError(
+            f"Bundle index config {bundle.manifest['index']} != requested {index_config}; "
+            "rebuild it with embedding.py")
+
+    current = {(c[2], c[3]) for c in chunks}
+    old_keys = list(zip(bundle.id_map.chunk_ids.tolist(), bundle.chunk_hashes.tolist()))
+    removed_rows = [row for row, key in enumerate(old_keys) if key not in current]
+    old = set(old_keys)
+    added = [c for c in chunks if (c[2], c[3]) not in old]
+    if len(current) != len(chunks) or len(old) != len(old_keys):
+        raise ValueError("Chunk ids must be unique")
+    stats = {
+        "added": len(added),
+        "removed": len(removed_rows),
+        "unchanged": len(old_keys) - len(removed_rows)
+    }
+    if not added and not removed_rows:
+        # Nothing changed: keep the build_id so caches tied to it stay valid
+        return bundle.manifest, stats
+
+    faiss_index = bundle.faiss_index
+    if isinstance(faiss_index, RescoredIndex):
+        faiss_index = faiss_index.index
+    faiss_index = remove_ids(faiss_index, bundle.id_map.chunk_ids[removed_rows])
+    bundle.bm25.remove_documents(removed_rows)
+    new_vectors = None
+    if added:
+        texts = [c[0] for c in added]
+        if store is not None:
+            embeddings = store.encode(model, texts)
+        else:
+            embeddings = model.encode(texts, convert_to_numpy=True)
+        new_vectors = add_embeddings(faiss_index, embeddings, [c[2] for c in added])
+        bundle.bm25.add_documents([tokenize(t) for t in texts])
+
+    # Kept rows are identical (same id and text) in the old and new chunks
+    by_key = {(c[2], c[3]): c for c in chunks}
+    removed = set(removed_rows)
+    kept_rows = [row for row in range(len(old_keys)) if row not in removed]
+    rows = [by_key[old_keys[row]] for row in kept_rows] + added
+    vectors = None
+    if bundle.vectors is not None:
+        vectors = np.asarray(bundle.vectors[kept_rows], dtype=np.float32)
+        if new_vectors is not None:
+            vectors = np.vstack([vectors, new_vectors])
+    manifest = write_bundle(bundle_dir, faiss_index, rows, bundle.bm25, model_name,
+                            model_fingerprint, bundle.manifest["index"], vectors=vectors)
+    return manifest, stats
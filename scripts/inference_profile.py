@@ -0,0 +1,133 @@
+# inference_profile.py
+"""
+CPU inference profiles for the three models of the pipeline: the dense
+bi-encoder (retrieval.load_dense_model), the cross-encoder (ReRanker) and
+the T5 generator (SLMResponseGenerator).
+
+A profile selects:
+    quantize           dynamic int8 quantization of the nn.Linear layers
+                       (weights int8, activations quantized on the fly;
+                       CPU only, skipped on GPU)
+    inference_mode     run generation under torch.inference_mode instead
+                       of torch.no_grad
+    intra_op_threads   torch threads inside one op (None: torch default)
+    inter_op_threads   torch threads across independent ops
+    faiss_threads      OpenMP threads FAISS uses for a search
+    fast_tokenizer     T5TokenizerFast (Rust) instead of the sentencepiece
+                       T5Tokenizer
+
+Thread counts are process-wide. torch and FAISS each start one thread per
+core by default, so when they run in the same process (app.py, service.py)
+they oversubscribe the CPU; the cpu_* profiles give torch the cores and run
+FAISS single-threaded, which is the faster choice for small query batches.
+
+Pick a profile with the INFERENCE_PROFILE environment variable (app.py) or
+--profile (service.py); bench_profiles.py reports the latency and accuracy
+differences between profiles on a fixed query set.
+"""
+
+import os
+
+DEFAULT_PROFILE = "fp32"
+
+
+def cpu_threads():
+    """
+    Number of cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class InferenceProfile:
+    def __init__(self, name, quantize=False, inference_mode=False, intra_op_threads=None,
+                 inter_op_threads=None, faiss_threads=None, fast_tokenizer=False):
+        self.name = name
+        self.quantize = quantize
+        self.inference_mode = inference_mode
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.faiss_threads = faiss_threads
+        self.fast_tokenizer = fast_tokenizer
+
+    def __repr__(self):
+        return f"InferenceProfile({self.to_dict()})"
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def model_id(self, model_name):
+        """
+        Cache key for the outputs of a model run under this profile:
+        quantized models give (slightly) different outputs, so their cached
+        embeddings and scores must not mix with those of the fp32 model.
+        """
+        return f"{model_name}@int8" if self.quantize else model_name
+
+    def apply_threads(self):
+        """
+        Applies the thread settings to this process. torch only accepts
+        inter_op_threads before its first parallel op; a later change is
+        ignored (the current value is kept).
+        """
+        import torch
+
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads is not None and torch.get_num_interop_threads() != self.inter_op_threads:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                pass
+        if self.faiss_threads is not None:
+            import faiss
+            faiss.omp_set_num_threads(self.faiss_threads)
+
+    def prepare(self, model, device=None):
+        """
+        Puts a torch module in eval mode and, if the profile quantizes and
+        the model runs on CPU, returns its dynamically quantized copy.
+        """
+        import torch
+
+        model.eval()
+        if not self.quantize or (device is not None and torch.device(device).type != "cpu"):
+            return model
+        from torch.ao.quantization import quantize_dynamic
+        return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def context(self):
+        """
+        The grad-free context to run inference in.
+        """
+        import torch
+
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
+
+PROFILES = {
+    # Full precision with torch's and FAISS's own threading (the previous behaviour)
+    "fp32": InferenceProfile("fp32"),
+    # Full precision, tuned threading and tokenizer: isolates the effect of quantization
+    "cpu_fp32": InferenceProfile(
+        "cpu_fp32", inference_mode=True, intra_op_threads=cpu_threads(), inter_op_threads=1,
+        faiss_threads=1, fast_tokenizer=True
+    ),
+    "cpu_int8": InferenceProfile(
+        "cpu_int8", quantize=True, inference_mode=True, intra_op_threads=cpu_threads(),
+        inter_op_threads=1, faiss_threads=1, fast_tokenizer=True
+    ),
+}
+
+def get_profile(profile=None):
+    """
+    Resolves a profile name (or None: $INFERENCE_PROFILE, else fp32) to an
+    InferenceProfile; InferenceProfile instances are returned as is.
+    """
+    if isinstance(profile, InferenceProfile):
+        return profile
+    name = profile or os.environ.get("INFERENCE_PROFILE", DEFAULT_PROFILE)
+    if name not in PROFILES:
+        raise ValueError(f"Unknown inference profile {name!r}; choose one of {sorted(PROFILES)}")
+    return PROFILES[name]
@@ -0,0 +1,408 @@
+# instrumentation.py
+"""
+Per-stage latency instrumentation and per-query traces for the QA pipeline.
+
+Stages (the names passed to stage()):
+    guardrail       GuardrailEngine.classify
+    filters         resolving the query's metadata filters (query_filters)
+    bm25            BM25 scoring and top-k
+    query_encoding  the bi-encoder (behind the query-embedding cache)
+    faiss           the FAISS search
+    merge           merging BM25 and dense results into result dicts
+    cross_encoder   cross-encoder scoring of the pairs missing from its cache
+    tokenization    prompt tokenization / assembly and padding
+    generation      the T5 encoder pass and generate()
+    decode          detokenizing and trimming the answers
+
+Every stage() records its duration in a rolling histogram (METRICS) and on
+the traces active in the current context. A trace (trace()) covers one
+request; it is held in a contextvar, so concurrent asyncio requests each
+keep their own. Work done for a micro-batch (service.MicroBatcher) runs
+under use_traces(...) with the traces of every request in the batch, so
+each of them records the batch's stage times and counts.
+
+Counters: candidates per retrieval stage (record_candidates) and cache
+hits/misses per cache (record_cache). METRICS.export_text() renders all
+histograms (p50/p95/p99 over the last `window` observations, plus
+all-time sum and count) and counters in the Prometheus text format.
+
+SlowRequestProfiler is an opt-in hook that profiles traced requests and
+keeps the profile of those slower than a threshold: "cprofile" (a .prof
+file for pstats/snakeviz; only the thread that started the trace) or
+"sample" (a stack sampler over every thread, written as folded stacks for
+flamegraph.pl/speedscope). One request is profiled at a time. It is
+configured by SLOW_REQUEST_MS, SLOW_REQUEST_PROFILER and SLOW_REQUEST_DIR
+(see profiler_from_env) or service.py's --slow-ms.
+"""
+
+import os
+import sys
+import time
+import cProfile
+import threading
+from collections import deque, Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+STAGES = ("guardrail", "filters", "bm25", "query_encoding", "faiss", "merge",
+          "cross_encoder", "tokenization", "generation", "decode")
+QUANTILES = (0.5, 0.95, 0.99)
+NAMESPACE = "financerag"
+
+METRIC_HELP = {
+    "stage_seconds": ("summary", "Time spent in one pipeline stage (per call; per batch when batched)."),
+    "request_seconds": ("summary", "End-to-end time of a traced request."),
+    "candidates": ("summary", "Candidates per query produced by a retrieval stage."),
+    "cache_lookups_total": ("counter", "Cache lookups by cache and result."),
+    "slow_requests_total": ("counter", "Traced requests slower than the profiling threshold.")
+}
+
+# Traces that stage timings and counts are recorded on
+_active_traces = ContextVar("active_traces", default=())
+
+
+class RollingHistogram:
+    """
+    The last `window` observations (for quantiles) and all-time count/sum.
+    """
+    def __init__(self, window=1024):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, quantiles=QUANTILES):
+        """
+        {q: value} by nearest rank over the window (empty if no values).
+        """
+        values = sorted(self.values)
+        if not values:
+            return {}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in quantiles}
+
+
+class Metrics:
+    """
+    Thread-safe registry of rolling histograms and counters, keyed by
+    metric name and label values. Also keeps the most recent traces.
+    """
+    def __init__(self, window=1024, recent_traces=50):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.recent_traces = deque(maxlen=recent_traces)
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = RollingHistogram(self.window)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_trace(self, trace):
+        with self._lock:
+            self.recent_traces.append(trace)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.recent_traces.clear()
+
+    def snapshot(self):
+        """
+        JSON-friendly view: {"histograms": [...], "counters": [...]}.
+        """
+        with self._lock:
+            histograms = [
+                {"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                 **{f"p{int(q * 100)}": v for q, v in h.quantiles().items()}}
+                for (name, labels), h in sorted(self.histograms.items())
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+        return {"histograms": histograms, "counters": counters}
+
+    def stage_summary(self):
+        """
+        {stage: {"count", "p50_ms", "p95_ms", "p99_ms"}} for the stage histograms.
+        """
+        summary = {}
+        with self._lock:
+            for (name, labels), h in self.histograms.items():
+                if name == "stage_seconds":
+                    row = {"count": h.count}
+                    row.update({f"p{int(q * 100)}_ms": v * 1000 for q, v in h.quantiles().items()})
+                    summary[dict(labels)["stage"]] = row
+        return summary
+
+    def export_text(self, namespace=NAMESPACE):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            names = sorted({name for (name, _), _ in histograms} | {name for (name, _), _ in counters})
+            for name in names:
+                metric = f"{namespace}_{name}"
+                kind, text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {metric} {text}")
+                lines.append(f"# TYPE {metric} {kind}")
+                for (h_name, labels), h in histograms:
+                    if h_name != name:
+                        continue
+                    for q, value in h.quantiles().items():
+                        lines.append(f"{metric}{label_text(labels, [('quantile', q)])} {value:.6g}")
+                    lines.append(f"{metric}_sum{label_text(labels)} {h.sum:.6g}")
+                    lines.append(f"{metric}_count{label_text(labels)} {h.count}")
+                for (c_name, labels), value in counters:
+                    if c_name == name:
+                        lines.append(f"{metric}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = Metrics()
+
+
+class Trace:
+    """
+    Timings and counts of one request: seconds per stage (summed over
+    repeated calls), counts (candidates, cache hits/misses, batch sizes)
+    and, once finished, the total seconds and any slow-request profile.
+    """
+    def __init__(self, name="request", query=None):
+        self.name = name
+        self.query = query
+        self.started = time.time()
+        self.stages = {}
+        self.counts = Counter()
+        self.seconds = None
+        self.profile_path = None
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "query": self.query,
+            "started": self.started,
+            "total_ms": self.seconds * 1000 if self.seconds is not None else None,
+            "stages_ms": {stage: seconds * 1000 for stage, seconds in self.stages.items()},
+            "counts": dict(self.counts),
+            "profile": self.profile_path
+        }
+
+
+def current_traces():
+    """
+    The traces active in this context (to hand to use_traces in another
+    thread).
+    """
+    return _active_traces.get()
+
+@contextmanager
+def use_traces(traces):
+    """
+    Records the stages run inside the block on `traces` (e.g. in a worker
+    thread, which does not inherit the caller's context).
+    """
+    token = _active_traces.set(tuple(traces))
+    try:
+        yield
+    finally:
+        _active_traces.reset(token)
+
+@contextmanager
+def stage(name, metrics=METRICS):
+    """
+    Times the block as pipeline stage `name`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("stage_seconds", seconds, stage=name)
+        for t in _active_traces.get():
+            t.add_stage(name, seconds)
+
+def record_candidates(stage_name, counts, metrics=METRICS):
+    """
+    Candidate counts of a retrieval stage, one per query of the batch.
+    """
+    total = 0
+    for n in counts:
+        metrics.observe("candidates", n, stage=stage_name)
+        total += n
+    for t in _active_traces.get():
+        t.add_count(f"{stage_name}_candidates", total)
+
+def record_cache(cache, hit, amount=1, metrics=METRICS):
+    """
+    Counts `amount` hits (hit=True) or misses of cache `cache`.
+    """
+    result = "hit" if hit else "miss"
+    metrics.inc("cache_lookups_total", amount, cache=cache, result=result)
+    for t in _active_traces.get():
+        t.add_count(f"{cache}_cache_{result}", amount)
+
+@contextmanager
+def trace(name="request", query=None, profiler=None, metrics=METRICS):
+    """
+    Traces one request: yields a Trace that collects the stages run inside
+    the block. With a SlowRequestProfiler, the request is profiled and the
+    profile kept if it was slower than the profiler's threshold.
+    """
+    t = Trace(name, query)
+    token = _active_traces.set(_active_traces.get() + (t,))
+    session = profiler.start() if profiler is not None else None
+    start = time.perf_counter()
+    try:
+        yield t
+    finally:
+        t.seconds = time.perf_counter() - start
+        _active_traces.reset(token)
+        if session is not None:
+            t.profile_path = profiler.stop(session, t)
+        metrics.observe("request_seconds", t.seconds, route=name)
+        metrics.add_trace(t)
+
+
+class _StackSampler:
+    """
+    Samples the stacks of every other thread every `interval` seconds and
+    counts them as folded stacks ("outer;inner;leaf").
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class SlowRequestProfiler:
+    """
+    Profiles traced requests (see trace()) and writes the profile of those
+    slower than threshold_ms to out_dir. mode is "cprofile" or "sample".
+    Requests that start while another is being profiled are not profiled.
+    """
+    def __init__(self, threshold_ms, out_dir, mode="cprofile", interval_ms=5, metrics=METRICS):
+        if mode not in ("cprofile", "sample"):
+            raise ValueError(f"Unknown profiler mode {mode!r}; choose 'cprofile' or 'sample'")
+        self.threshold = threshold_ms / 1000
+        self.out_dir = out_dir
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.metrics = metrics
+        self._busy = threading.Lock()
+
+    def start(self):
+        if not self._busy.acquire(blocking=False):
+            return None
+        if self.mode == "sample":
+            session = _StackSampler(self.interval)
+            session.start()
+            return session
+        session = cProfile.Profile()
+        try:
+            session.enable()
+        except ValueError:
+            # Another profiler is active in this process
+            self._busy.release()
+            return None
+        return session
+
+    def stop(self, session, t):
+        """
+        Ends the profile of trace `t`; returns the file it was written to,
+        or None when the request was fast enough.
+        """
+        try:
+            if self.mode == "sample":
+                session.stop()
+            else:
+                session.disable()
+            if t.seconds < self.threshold:
+                return None
+            self.metrics.inc("slow_requests_total", route=t.name)
+            os.makedirs(self.out_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(t.started))
+            base = os.path.join(self.out_dir, f"{t.name}-{stamp}-{t.seconds * 1000:.0f}ms")
+            if self.mode == "sample":
+                path = base + ".folded"
+                with open(path, "w", encoding="utf-8") as f:
+                    for stack, n in session.stacks.most_common():
+                        f.write(f"{stack} {n}\n")
+            else:
+                path = base + ".prof"
+                session.dump_stats(path)
+            return path
+        finally:
+            self._busy.release()
+
+def profiler_from_env():
+    """
+    SlowRequestProfiler from $SLOW_REQUEST_MS (unset: profiling off),
+    $SLOW_REQUEST_PROFILER (cprofile or sample, default cprofile) and
+    $SLOW_REQUEST_DIR (default profiles/ at the repository root).
+    """
+    threshold = os.environ.get("SLOW_REQUEST_MS")
+    if not threshold:
+        return None
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    return SlowRequestProfiler(
+        float(threshold),
+        os.environ.get("SLOW_REQUEST_DIR", os.path.join(base_dir, "profiles")),
+        os.environ.get("SLOW_REQUEST_PROFILER", "cprofile")
+    )
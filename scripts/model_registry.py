@@ -0,0 +1,254 @@
+# model_registry.py
+"""
+Process-wide registry of the pipeline's three models: the dense bi-encoder
+(retrieval.load_dense_model), the cross-encoder (ReRanker) and the T5
+generator (SLMResponseGenerator).
+
+Each (kind, model name, inference profile, load options) is loaded once per
+process, however many Streamlit reruns or callers ask for it. preload()
+loads models on a background thread, so a UI can render before a slow
+model is ready; get() blocks until the model is loaded and warmed up.
+Warm-up is one small inference call, so the first user request does not
+pay for lazy initialization (kernel selection, allocator growth).
+
+torch, transformers and sentence-transformers are only imported by the
+loaders, and faiss only when an index is loaded or searched, not when
+this module (or app.py) is imported.
+
+A model that failed to load is retried by the next load()/get() after a
+backoff (RETRY_SECONDS, doubling per consecutive failure up to
+MAX_RETRY_SECONDS); until then get() re-raises its error at once.
+
+stats() reports per model: status, load and warm-up seconds, the size of its
+weights (int8 weights count one byte) and the growth of the process RSS
+while it loaded. Loads are serialized, so the RSS delta is attributed to one
+model at a time; other threads allocating meanwhile are counted too.
+"""
+
+import os
+import time
+import threading
+
+RETRY_SECONDS = 5.0
+MAX_RETRY_SECONDS = 300.0
+
+WARMUP_QUERY = "What is the total revenue for 2023?"
+WARMUP_DOC = {"text": "Year: 2023, Parameter: Total Revenue, Value: 383285000000.0",
+              "metadata": {"year": 2023, "finance_parameter": "Total Revenue", "value": 383285000000.0},
+              "re_rank_score": 1.0}
+
+
+def _nbytes(value):
+    import torch
+
+    if torch.is_tensor(value):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        # Quantized linear layers keep (int8 weight, bias) as packed params
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+def model_megabytes(module):
+    """
+    Size of a torch module's weights (its state_dict) in MB.
+    """
+    return sum(_nbytes(v) for v in module.state_dict().values()) / 2**20
+
+def _rss_bytes():
+    """
+    Resident set size of this process, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _load_dense(name, profile, **options):
+    from retrieval import load_dense_model
+    return load_dense_model(name, profile=profile, **options)
+
+def _load_reranker(name, profile, **options):
+    from re_ranking import ReRanker
+    return ReRanker(name, profile=profile, **options)
+
+def _load_generator(name, profile, **options):
+    from slm_generation import SLMResponseGenerator
+    return SLMResponseGenerator(name, profile=profile, **options)
+
+def _warm_dense(encoder):
+    # The model itself, not the CachedEncoder: warm-up must not fill the query cache
+    encoder.model.encode([WARMUP_QUERY], convert_to_numpy=True)
+
+def _warm_reranker(reranker):
+    reranker.cross_encoder.predict([(WARMUP_QUERY, WARMUP_DOC["text"])])
+
+def _warm_generator(generator):
+    generator.generate_batch([WARMUP_QUERY], [[WARMUP_DOC]])
+
+# kind -> (loader, warm-up, the torch module holding the weights)
+LOADERS = {
+    "dense": (_load_dense, _warm_dense, lambda encoder: encoder.model),
+    "reranker": (_load_reranker, _warm_reranker, lambda reranker: reranker.cross_encoder),
+    "generator": (_load_generator, _warm_generator, lambda generator: generator.model),
+}
+
+
+class ModelEntry:
+    """
+    One registered model and its load statistics. status goes pending ->
+    loading -> warming -> ready (or failed). failures counts the failed
+    loads before this one; a failed entry may be retried from retry_at
+    (time.monotonic()).
+    """
+    def __init__(self, kind, name, profile, options, failures=0):
+        self.kind = kind
+        self.name = name
+        self.profile = profile
+        self.options = options
+        self.status = "pending"
+        self.model = None
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.weights_mb = None
+        self.rss_mb = None
+        self.failures = failures
+        self.retry_at = None
+        self._done = threading.Event()
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the model is loaded and warmed up; returns it. Raises
+        the loading error if it failed, TimeoutError if it is not done.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.kind} model {self.name} is still {self.status}")
+        if self.error is not None:
+            raise self.error
+        return self.model
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "profile": self.profile.name,
+            "status": self.status,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "weights_mb": self.weights_mb,
+            "rss_mb": self.rss_mb,
+            "error": None if self.error is None else f"{type(self.error).__name__}: {self.error}",
+            "failures": self.failures + (self.status == "failed")
+        }
+
+
+class ModelRegistry:
+    def __init__(self, warmup=True):
+        self.warmup = warmup
+        self._entries = {}
+        self._lock = threading.Lock()
+        # One model loads at a time, so RSS growth is attributed to it
+        self._load_lock = threading.Lock()
+
+    def _key(self, kind, name, profile, options):
+        return (kind, name, profile.name, tuple(sorted(options.items())))
+
+    def _register(self, kind, name, profile, options):
+        """
+        (entry, created): the existing entry for these arguments, or a new
+        pending one. A failed entry is replaced once its backoff has passed.
+        """
+        from inference_profile import get_profile
+
+        if kind not in LOADERS:
+            raise ValueError(f"Unknown model kind {kind!r}; choose one of {list(LOADERS)}")
+        profile = get_profile(profile)
+        key = self._key(kind, name, profile, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            failures = 0
+            if entry is not None:
+                if entry.status != "failed" or time.monotonic() < entry.retry_at:
+                    return entry, False
+                failures = entry.failures + 1
+            entry = self._entries[key] = ModelEntry(kind, name, profile, options, failures)
+            return entry, True
+
+    def load(self, kind, name, profile=None, **options):
+        """
+        Registers and loads a model, unless it already is (or is loading);
+        returns its ModelEntry. options are passed to the loader (e.g.
+        cache_size).
+        """
+        entry, created = self._register(kind, name, profile, options)
+        if created:
+            self._load(entry)
+        return entry
+
+    def preload(self, specs, profile=None):
+        """
+        Starts loading the models in `specs` ((kind, name, options) tuples)
+        one after the other on a daemon thread and returns their entries at
+        once; get()/wait() block until a model is ready.
+        """
+        entries, pending = [], []
+        for kind, name, options in specs:
+            entry, created = self._register(kind, name, profile, options)
+            entries.append(entry)
+            if created:
+                pending.append(entry)
+        if pending:
+            threading.Thread(target=lambda: [self._load(e) for e in pending], name="model-preload",
+                             daemon=True).start()
+        return entries
+
+    def get(self, kind, name, profile=None, timeout=None, **options):
+        """
+        The loaded (and warmed-up) model; loads it now if nothing has yet.
+        """
+        return self.load(kind, name, profile, **options).wait(timeout)
+
+    def _load(self, entry):
+        loader, warm, module = LOADERS[entry.kind]
+        try:
+            with self._load_lock:
+                entry.status = "loading"
+                rss = _rss_bytes()
+                start = time.perf_counter()
+                model = loader(entry.name, entry.profile, **entry.options)
+                entry.load_seconds = time.perf_counter() - start
+                if rss is not None:
+                    entry.rss_mb = (_rss_bytes() - rss) / 2**20
+                entry.weights_mb = model_megabytes(module(model))
+            if self.warmup:
+                entry.status = "warming"
+                start = time.perf_counter()
+                with entry.profile.context():
+                    warm(model)
+                entry.warmup_seconds = time.perf_counter() - start
+            entry.model = model
+            entry.status = "ready"
+        except Exception as e:
+            entry.error = e
+            entry.retry_at = time.monotonic() + min(RETRY_SECONDS * 2 ** entry.failures, MAX_RETRY_SECONDS)
+            entry.status = "failed"
+        finally:
+            entry._done.set()
+
+    def stats(self):
+        """
+        to_dict() of every registered model, in registration order.
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+        return [entry.to_dict() for entry in entries]
+
+
+# The registry of this process (module state survives Streamlit reruns)
+REGISTRY = ModelRegistry()
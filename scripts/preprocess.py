@@ -2,27 +2,39 @@
 """
 Reads raw CSV financial data from Yahoo Finance (e.g. income statements,
 balance sheets, cash flow statements for 2023/2024), cleans/structures them,
-and outputs a well-structured JSON with fields like:
-   { "year": <int>, "finance_parameter": <str>, "value": <float> }
+and outputs a typed columnar store (see financial_store.py) of records like:
+   { "year": <int>, "finance_parameter": <str>, "value": <float>,
+     "ticker": <str>, "statement": <str> }
+JSON output of the same records is available with --json.
+
+CSV files are parsed in parallel across a process pool and cleaned with
+vectorized pandas operations; there is no per-row Python loop.
 """
 
 import pandas as pd
 import os
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from financial_store import write_records
 
-def load_and_clean_data(raw_data_dir):
+RECORD_COLUMNS = ["ticker", "statement", "year", "finance_parameter", "value"]
+
+def list_csv_files(raw_data_dir, ticker=None):
     """
-    Loads CSV files from raw_data_dir, cleans and structures them,
-    returns a list of records (dict).
+    (path, year, ticker, statement) for every CSV under raw_data_dir, in
+    sorted order. Each subdirectory of raw_data_dir is read as the data of
+    one ticker (e.g. data/raw/MSFT/...), and the statement is the file name
+    without its year ("cash_flow_2023.csv" -> "cash_flow").
+    Files whose name has no year are skipped.
     """
-    all_records = []
-    
-    # Example: Suppose your 6 CSVs have columns: [Parameter, Value] or similar
-    # Adjust column names to match your actual CSV structure
-    for filename in os.listdir(raw_data_dir):
-        if filename.endswith(".csv"):
-            filepath = os.path.join(raw_data_dir, filename)
-            
+    files = []
+    for filename in sorted(os.listdir(raw_data_dir)):
+        path = os.path.join(raw_data_dir, filename)
+        if os.path.isdir(path):
+            files.extend(list_csv_files(path, ticker=filename))
+        elif filename.endswith(".csv"):
             # Derive the year from filename (e.g. "income_statement_2023.csv")
             # This is a naive approach; adapt to your naming convention
             # e.g. split on underscore and use last token before ".csv"
@@ -32,26 +44,80 @@ def load_and_clean_data(raw_data_dir):
             for part in parts:
                 if part.isdigit():
                     year = int(part)  # pick up 2023 or 2024
-            
-            df = pd.read_csv(filepath)
-            # Example: rename columns to a standard set
-            df.columns = ["finance_parameter", "value"]
-            
-            # Clean up data—drop NAs, convert numeric types, etc.
-            df.dropna(inplace=True)
-            df["value"] = pd.to_numeric(df["value"], errors="coerce")
-            df.dropna(inplace=True)
-            
-            # Build list of {year, finance_parameter, value} dicts
-            for _, row in df.iterrows():
-                record = {
-                    "year": year,
-                    "finance_parameter": row["finance_parameter"],
-                    "value": row["value"]
-                }
-                all_records.append(record)
-    
-    return all_records
+            if year is not None:
+                statement = "_".join(p for p in parts if not p.isdigit()) or None
+                files.append((path, year, ticker, statement))
+    return files
+
+def clean_csv(path, year, ticker=None, statement=None):
+    """
+    Reads one CSV of [Parameter, Value] rows into a frame with
+    RECORD_COLUMNS, dropping rows with a missing or non-numeric value.
+    """
+    df = pd.read_csv(path)
+    # Example: rename columns to a standard set
+    df.columns = ["finance_parameter", "value"]
+
+    # Clean up data—drop NAs, convert numeric types, etc.
+    df = df.dropna()
+    df["value"] = pd.to_numeric(df["value"], errors="coerce")
+    df = df.dropna()
+    df["year"] = year
+    df["ticker"] = ticker
+    df["statement"] = statement
+    return df[RECORD_COLUMNS]
+
+def _clean_csv_args(args):
+    return clean_csv(*args)
+
+def load_frame(raw_data_dir, max_workers=None):
+    """
+    All cleaned records under raw_data_dir as one DataFrame, in file order.
+    Files are parsed across a process pool of max_workers processes
+    (default: one per CPU); max_workers=1 parses them in this process.
+    """
+    files = list_csv_files(raw_data_dir)
+    if max_workers == 1 or len(files) < 2:
+        frames = [clean_csv(*f) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            frames = list(pool.map(_clean_csv_args, files, chunksize=16))
+    if not frames:
+        return pd.DataFrame(columns=RECORD_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def frame_to_records(frame):
+    """
+    The list of record dicts for a frame from load_frame; records without a
+    ticker or statement have no "ticker" or "statement" field.
+    """
+    records = frame.loc[:, ["year", "finance_parameter", "value"]].to_dict("records")
+    for record, ticker, statement in zip(records, frame["ticker"].tolist(), frame["statement"].tolist()):
+        if isinstance(ticker, str):
+            record["ticker"] = ticker
+        if isinstance(statement, str):
+            record["statement"] = statement
+    return records
+
+def load_and_clean_data(raw_data_dir, ticker=None, max_workers=1):
+    """
+    Loads CSV files from raw_data_dir, cleans and structures them,
+    returns a list of records (dict).
+    Each subdirectory of raw_data_dir is read as the data of one ticker
+    (e.g. data/raw/MSFT/...), and its records get a "ticker" field.
+    """
+    frame = load_frame(raw_data_dir, max_workers=max_workers)
+    if ticker is not None:
+        frame["ticker"] = ticker
+    return frame_to_records(frame)
+
+def save_store(frame, out_dir):
+    """
+    Saves a frame from load_frame as a columnar store (financial_store.py).
+    """
+    return write_records(out_dir, frame["year"].to_numpy(), frame["value"].to_numpy(),
+                         frame["finance_parameter"].to_numpy(), frame["ticker"].to_numpy(),
+                         frame["statement"].to_numpy())
 
 def save_to_json(records, out_path):
     """
@@ -61,10 +127,19 @@ def save_to_json(records, out_path):
         json.dump(records, f, indent=2)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean raw CSVs into the processed record store.")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPUs)")
+    parser.add_argument("--json", action="store_true", help="also write financial_data.json")
+    args = parser.parse_args()
+
     BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     raw_data_dir = os.path.join(BASE_DIR, "data","raw")  # adapt to your path
+    out_store = os.path.join(BASE_DIR, "data","processed","financial_data")
     out_json = os.path.join(BASE_DIR, "data","processed","financial_data.json")
-    
-    records = load_and_clean_data(raw_data_dir)
-    save_to_json(records, out_json)
-    print(f"Data successfully cleaned and saved to {out_json}")
+
+    frame = load_frame(raw_data_dir, max_workers=args.workers)
+    save_store(frame, out_store)
+    print(f"Data successfully cleaned and saved to {out_store}")
+    if args.json:
+        save_to_json(frame_to_records(frame), out_json)
+        print(f"JSON export saved to {out_json}")
@@ -0,0 +1,177 @@
+# query_cache.py
+"""
+A bounded cache of query embeddings in front of the dense encoder.
+
+Users ask the same few questions over and over with small differences in
+case and spacing, so queries are normalized before lookup and the cache is
+keyed on (model identity, normalized query). The in-memory tier is an LRU
+with hit/miss counters; an optional SQLite file adds an on-disk tier so a
+warm cache survives process restarts.
+"""
+
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+from instrumentation import record_cache
+
+WHITESPACE = re.compile(r"\s+")
+
+# encode() arguments that do not change the embedding values
+OUTPUT_NEUTRAL_KWARGS = {"batch_size", "show_progress_bar", "convert_to_numpy", "device"}
+
+def normalize_query(query):
+    """
+    Canonical form of a query for cache lookups: Unicode-normalized,
+    lowercased, whitespace collapsed and trailing punctuation dropped.
+    """
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = WHITESPACE.sub(" ", query).strip()
+    return query.rstrip("?!. ")
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of embeddings keyed by (model_id, normalized query).
+    If disk_path is given, entries are also written to a SQLite file and
+    memory misses fall back to it before counting as a miss.
+    """
+    def __init__(self, max_size=1024, disk_path=None):
+        self.max_size = max_size
+        self.disk_path = disk_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if disk_path is not None:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model_id TEXT, query TEXT, embedding BLOB, "
+                "PRIMARY KEY (model_id, query))"
+            )
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, model_id, query):
+        """
+        Returns the cached embedding for `query`, or None on a miss.
+        """
+        key = (model_id, normalize_query(query))
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                record_cache("query_embedding", True)
+                return embedding
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model_id = ? AND query = ?",
+                    key
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._store(key, embedding)
+                    self.disk_hits += 1
+                    record_cache("query_embedding", True)
+                    return embedding
+            self.misses += 1
+            record_cache("query_embedding", False)
+            return None
+
+    def put(self, model_id, query, embedding):
+        key = (model_id, normalize_query(query))
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._store(key, embedding)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                    (key[0], key[1], embedding.tobytes())
+                )
+                self._db.commit()
+
+    def _store(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Empties the in-memory tier and resets the counters.
+        The on-disk tier is kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+
+class CachedEncoder:
+    """
+    Wraps a SentenceTransformer so encode() goes through a QueryEmbeddingCache.
+    Only cache misses reach the model, in one batched encode call.
+    Any other attribute is delegated to the wrapped model.
+    """
+    def __init__(self, model, model_name, cache=None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache if cache is not None else QueryEmbeddingCache()
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def _model_id(self, kwargs):
+        options = sorted((k, v) for k, v in kwargs.items() if k not in OUTPUT_NEUTRAL_KWARGS)
+        return self.model_name if not options else f"{self.model_name}|{options}"
+
+    def encode(self, sentences, convert_to_numpy=True, **kwargs):
+        """
+        Same contract as SentenceTransformer.encode for numpy output:
+        a 2-D array for a list of sentences, a 1-D array for a single string.
+        """
+        single = isinstance(sentences, str)
+        queries = [sentences] if single else list(sentences)
+        model_id = self._model_id(kwargs)
+
+        embeddings = [self.cache.get(model_id, q) for q in queries]
+        # Misses that normalize to the same query are encoded once
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(normalize_query(queries[i]), []).append(i)
+        if missing:
+            positions = list(missing.values())
+            encoded = self.model.encode(
+                [queries[p[0]] for p in positions], convert_to_numpy=True, **kwargs
+            )
+            for group, embedding in zip(positions, encoded):
+                self.cache.put(model_id, queries[group[0]], embedding)
+                for i in group:
+                    embeddings[i] = np.asarray(embedding, dtype=np.float32)
+
+        if not embeddings:
+            return np.empty((0, 0), dtype=np.float32)
+        result = np.vstack(embeddings)
+        return result[0] if single else result
@@ -0,0 +1,201 @@
+# query_filters.py
+"""
+Metadata filters extracted from a query and pushed down into retrieval.
+
+"cash flow 2023" names a year and a statement: instead of searching every
+chunk and leaving the cross-encoder and T5 to discard rows from the wrong
+year, hybrid_search restricts BM25 scoring and the FAISS search to the rows
+that match. Four kinds of filter are extracted:
+    ticker       tickers the bundle has data for, named in upper case as a
+                 whole word ("AAPL", "$AAPL")
+    year         four-digit years the bundle has data for
+    statement    income_statement / balance_sheet / cash_flow, from phrases
+                 such as "balance sheet" or "cash flow"
+    family       parameter families ("revenue", "debt", ...) named by the
+                 query, matched against the words of the parameter names
+
+MetadataPartitions precomputes the rows of every year, statement and family
+once per bundle, so resolving a query's filters is a few set operations.
+Values within one kind of filter are OR-ed (2023 or 2024), kinds are AND-ed.
+When the combination matches nothing, the least certain filter is dropped
+(statement, then year) rather than returning no results; a ticker filter
+is never dropped. pin() fixes filters the caller chose (a company picked in
+the UI) on top of the ones in the query.
+
+The family filter is soft: it is guessed from single words ("cash spent on
+repurchases" names "cash" but asks for "Repurchase Of Capital Stock"), so
+it does not restrict the rows. Its rows are returned separately and
+hybrid_search boosts them instead.
+"""
+
+import copy
+import numpy as np
+
+from structured_lookup import YEAR_PATTERN, normalize_phrase, stem_word, find_tickers
+
+# Phrases naming a statement type (keys match preprocess's statement names
+# and the sections of finance_keywords.FINANCE_KEYWORDS)
+STATEMENT_PHRASES = {
+    "income_statement": ["income statement", "income statements", "profit and loss", "p l",
+                         "statement of operations"],
+    "balance_sheet": ["balance sheet", "balance sheets", "statement of financial position"],
+    "cash_flow": ["cash flow", "cash flows", "cashflow", "cashflows"]
+}
+
+# Parameter families and the words that name them, in a query or in a
+# parameter name (compared after plural folding)
+PARAMETER_FAMILIES = {
+    "revenue": ["revenue", "sales", "turnover"],
+    "income": ["income", "profit", "earnings", "ebit", "ebitda"],
+    "expense": ["expense", "cost", "expenditure"],
+    "cash": ["cash"],
+    "debt": ["debt", "borrowing", "lease"],
+    "assets": ["asset", "receivable", "inventory", "goodwill", "ppe"],
+    "liabilities": ["liability", "payable"],
+    "equity": ["equity", "stock", "capital"],
+    "shares": ["share", "eps", "dividend"],
+    "tax": ["tax"]
+}
+
+# Filters that restrict the rows; the family filter only boosts them
+HARD_FILTERS = ("ticker", "year", "statement")
+
+# Order in which filters are dropped when their combination is empty
+RELAXATION_ORDER = ("statement", "year")
+
+def _words(text):
+    return [stem_word(w) for w in normalize_phrase(text).split()]
+
+def parameter_families(parameter):
+    """
+    The families a parameter name belongs to ("Cost Of Revenue" ->
+    {"expense", "revenue"}).
+    """
+    words = set(_words(parameter))
+    return {family for family, names in PARAMETER_FAMILIES.items() if words.intersection(names)}
+
+def extract_filters(query, tickers=()):
+    """
+    {"ticker": {...}, "year": {...}, "statement": {...}, "family": {...}}
+    with the filters the query names, tickers out of `tickers`; kinds it
+    does not name are left out. Statement phrases are removed before
+    families are matched, so "income statement" does not also ask for the
+    income family.
+    """
+    filters = {}
+    named_tickers = find_tickers(query, tickers)
+    if named_tickers:
+        filters["ticker"] = named_tickers
+    years = {int(y) for y in YEAR_PATTERN.findall(query)}
+    if years:
+        filters["year"] = years
+
+    text = " " + " ".join(_words(YEAR_PATTERN.sub(" ", query))) + " "
+    statements = set()
+    for statement, phrases in STATEMENT_PHRASES.items():
+        for phrase in phrases:
+            phrase = " " + " ".join(_words(phrase)) + " "
+            if phrase in text:
+                statements.add(statement)
+                text = text.replace(phrase, " ")
+    if statements:
+        filters["statement"] = statements
+
+    words = text.split()
+    families = {family for family, names in PARAMETER_FAMILIES.items()
+                if set(words).intersection(names)}
+    if families:
+        filters["family"] = families
+    return filters
+
+
+class MetadataPartitions:
+    """
+    Sorted row arrays per ticker, year, statement and parameter family of a
+    bundle's chunk metadata (index_bundle.ColumnarMetadata).
+    """
+    def __init__(self, metadata):
+        self.num_rows = len(metadata)
+        self.pinned = {}
+        years = np.asarray(metadata.years)
+        self.partitions = {"ticker": {}, "year": {}, "statement": {}, "family": {}}
+        ticker_codes = np.asarray(metadata.ticker_codes)
+        for code, ticker in enumerate(metadata.tickers):
+            if ticker:
+                self.partitions["ticker"][ticker] = np.flatnonzero(ticker_codes == code)
+        for year in np.unique(years):
+            self.partitions["year"][int(year)] = np.flatnonzero(years == year)
+
+        statement_codes = np.asarray(metadata.statement_codes)
+        for code, statement in enumerate(metadata.statements):
+            if statement:
+                self.partitions["statement"][statement] = np.flatnonzero(statement_codes == code)
+
+        parameter_codes = np.asarray(metadata.parameter_codes)
+        family_codes = {}
+        for code, parameter in enumerate(metadata.parameters):
+            for family in parameter_families(parameter):
+                family_codes.setdefault(family, []).append(code)
+        for family, codes in family_codes.items():
+            self.partitions["family"][family] = np.flatnonzero(np.isin(parameter_codes, codes))
+
+    def _rows(self, filters):
+        rows = None
+        for kind, values in filters.items():
+            parts = [self.partitions[kind][v] for v in values if v in self.partitions[kind]]
+            if not parts:
+                continue
+            matched = np.unique(np.concatenate(parts))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return rows
+
+    def resolve(self, filters):
+        """
+        Sorted rows matching the hard `filters` (from extract_filters; the
+        family filter is ignored), or None when no filter applies to this
+        bundle. Filter values the bundle has no rows for (a year it does
+        not cover) are ignored.
+        """
+        filters = {kind: values for kind, values in filters.items() if kind in HARD_FILTERS}
+        rows = self._rows(filters)
+        for kind in RELAXATION_ORDER:
+            if rows is None or len(rows):
+                break
+            filters.pop(kind, None)
+            rows = self._rows(filters)
+        if rows is None or len(rows) == 0 or len(rows) == self.num_rows:
+            return None
+        return rows
+
+    @property
+    def tickers(self):
+        return sorted(self.partitions["ticker"])
+
+    def pin(self, **filters):
+        """
+        A copy whose rows_for_query always applies `filters` (e.g.
+        ticker={"AAPL"}), overriding the same kinds named in the query.
+        The partitions themselves are shared.
+        """
+        pinned = copy.copy(self)
+        pinned.pinned = {**self.pinned, **filters}
+        return pinned
+
+    def family_rows(self, filters):
+        """
+        Sorted rows of the parameter families in `filters`, or None when
+        it names none the bundle has.
+        """
+        return self._rows({"family": filters.get("family", ())})
+
+    def query_rows(self, query):
+        """
+        (rows, family_rows) for a query: the rows its hard filters (and the
+        pinned ones) restrict it to, as resolve returns them, and the rows
+        of the families it names, to boost (family_rows).
+        """
+        filters = {**extract_filters(query, self.partitions["ticker"]), **self.pinned}
+        return self.resolve(filters), self.family_rows(filters)
+
+    def rows_for_query(self, query):
+        return self.query_rows(query)[0]
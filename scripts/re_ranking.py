@@ -4,14 +4,90 @@ Re-ranks retrieved candidates using a cross-encoder or similar model
 to refine the ordering based on semantic matching of (query, candidate_text).
 """
 
-from sentence_transformers import CrossEncoder
+import threading
+from collections import OrderedDict
+
+from embedding_store import text_hash
+from query_cache import normalize_query
+from inference_profile import get_profile
+from instrumentation import stage, record_cache, record_candidates
+
+class ScoreCache:
+    """
+    LRU cache of cross-encoder scores keyed by (normalized query, doc text
+    hash, model). The reranker is shared across threads, so it is locked.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, key):
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache("rerank", score is not None)
+        return score
+
+    def put(self, key, score):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._scores),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
 
 class ReRanker:
-    def __init__(self, model_name="cross-encoder/ms-marco-MiniLM-L-6-v2"):
+    def __init__(self, model_name="cross-encoder/ms-marco-MiniLM-L-6-v2", cache_size=4096, batch_size=64,
+                 profile=None, cross_encoder=None):
         """
         A common cross-encoder for re-ranking is the MS-Marco cross-encoder model.
+        Scores are cached per (normalized query, doc text, model), so repeated
+        candidates are not re-scored; set cache_size=0 to disable the cache.
+        profile is an inference profile or its name (see inference_profile.py).
+        cross_encoder is an already loaded model with predict(pairs, batch_size)
+        (e.g. bench_pipeline's offline stub), used as is instead of loading
+        model_name; model_name then only names it in the cache keys.
         """
-        self.cross_encoder = CrossEncoder(model_name)
+        self.profile = get_profile(profile)
+        self.profile.apply_threads()
+        self.model_name = model_name
+        self.batch_size = batch_size
+        if cross_encoder is None:
+            from sentence_transformers import CrossEncoder
+            cross_encoder = CrossEncoder(model_name)
+            cross_encoder = self.profile.prepare(cross_encoder, cross_encoder.device)
+        self.cross_encoder = cross_encoder
+        self.score_cache = ScoreCache(cache_size) if cache_size else None
+
+    def _cache_key(self, query, doc):
+        # The score depends only on the text; doc_ids are renumbered by
+        # index_bundle.update_bundle and repeat across shards
+        return (normalize_query(query), text_hash(doc["text"]), self.profile.model_id(self.model_name))
     
     def rerank(self, query, retrieved_docs):
         """
@@ -20,16 +96,49 @@ class ReRanker:
         
         We compute cross-encoder score for each doc, then re-sort.
         """
-        pairs = [(query, doc["text"]) for doc in retrieved_docs]
-        scores = self.cross_encoder.predict(pairs)
-        
-        # Attach cross-encoder scores
-        for i, doc in enumerate(retrieved_docs):
-            doc["re_rank_score"] = float(scores[i])
-        
-        # Sort by cross-encoder score desc
-        reranked = sorted(retrieved_docs, key=lambda d: d["re_rank_score"], reverse=True)
-        return reranked
+        return self.rerank_batch([query], [retrieved_docs])[0]
+
+    def rerank_batch(self, queries, retrieved_docs_list, batch_size=None):
+        """
+        rerank for many queries at once. The (query, doc) pairs of all queries
+        that miss the score cache go through a single predict call, in
+        batches of `batch_size`. Returns one re-ranked list per query.
+        """
+        keys = [[self._cache_key(q, doc) for doc in docs]
+                for q, docs in zip(queries, retrieved_docs_list)]
+
+        # Collect uncached pairs across all queries, each distinct pair once
+        scores = {}
+        pending = {}
+        for q, docs, doc_keys in zip(queries, retrieved_docs_list, keys):
+            for doc, key in zip(docs, doc_keys):
+                if key in scores or key in pending:
+                    continue
+                cached = self.score_cache.get(key) if self.score_cache is not None else None
+                if cached is None:
+                    pending[key] = (q, doc["text"])
+                else:
+                    scores[key] = cached
+
+        record_candidates("cross_encoder", [len(pending)])
+        if pending:
+            with stage("cross_encoder"):
+                predicted = self.cross_encoder.predict(
+                    list(pending.values()), batch_size=batch_size or self.batch_size
+                )
+            for key, score in zip(pending, predicted):
+                scores[key] = float(score)
+                if self.score_cache is not None:
+                    self.score_cache.put(key, scores[key])
+
+        results = []
+        for docs, doc_keys in zip(retrieved_docs_list, keys):
+            # Attach cross-encoder scores
+            for doc, key in zip(docs, doc_keys):
+                doc["re_rank_score"] = scores[key]
+            # Sort by cross-encoder score desc
+            results.append(sorted(docs, key=lambda d: d["re_rank_score"], reverse=True))
+        return results
 
 if __name__ == "__main__":
     # Example usage
@@ -4,52 +4,154 @@ Implements hybrid search using BM25 for sparse retrieval plus FAISS for dense re
 Then merges the results to pick the most relevant chunks for a query.
 """
 
+import os
 import json
-import faiss
 import numpy as np
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer
+
+from bm25 import SparseBM25, tokenize
+from embedding import search_parameters, model_fingerprint
+from query_cache import CachedEncoder, QueryEmbeddingCache
+from inference_profile import get_profile
+from instrumentation import stage, record_candidates
+
+# Score multiplier for results in a parameter family the query names
+# (query_filters.MetadataPartitions.family_rows)
+FAMILY_BOOST = 1.2
 
 def load_metadata(json_path):
     with open(json_path, "r", encoding="utf-8") as f:
         return json.load(f)
 
+def load_dense_model(model_name="sentence-transformers/all-MiniLM-L6-v2",
+                     cache_size=1024, cache_path=None, profile=None):
+    """
+    Loads the dense encoder behind a query-embedding cache (see query_cache.py).
+    Pass cache_path to keep the cache on disk across restarts.
+    profile is an inference profile or its name (see inference_profile.py).
+    """
+    from sentence_transformers import SentenceTransformer
+
+    profile = get_profile(profile)
+    profile.apply_threads()
+    model = SentenceTransformer(model_name)
+    cache = QueryEmbeddingCache(max_size=cache_size, disk_path=cache_path)
+    encoder = CachedEncoder(profile.prepare(model, model.device), profile.model_id(model_name), cache)
+    if profile.quantize:
+        # Documents were encoded with the fp32 weights: bundles check against those
+        encoder.source_fingerprint = model_fingerprint(model, model_name)
+    return encoder
+
 def build_bm25_index(chunks):
     """
-    Builds a BM25 index using rank_bm25 library.
+    Builds a sparse BM25 index (see bm25.py) over the chunk texts.
     """
-    tokenized_corpus = [c[0].split() for c in chunks]  # naive tokenization
-    bm25 = BM25Okapi(tokenized_corpus)
+    tokenized_corpus = [tokenize(c[0]) for c in chunks]
+    bm25 = SparseBM25.from_corpus(tokenized_corpus)
     return bm25
 
-def hybrid_search(query, bm25, chunk_texts, faiss_index, metadata, dense_model, top_k=5):
+def hybrid_search(query, bm25, chunk_texts, faiss_index, metadata, dense_model, top_k=5,
+                  search_params=None, id_map=None, partitions=None):
     """
     1) BM25 retrieval
     2) Dense retrieval via FAISS
     3) Merge results (naive approach)
+    search_params optionally overrides ANN settings for this call,
+    e.g. {"nprobe": 16} or {"ef_search": 64} (see embedding.search_parameters).
+    id_map translates the chunk ids the FAISS index returns into rows of
+    chunk_texts/metadata (index_bundle.ChunkIdMap, e.g. bundle.id_map).
+    With partitions (query_filters.MetadataPartitions, e.g.
+    bundle.partitions), ticker/year/statement filters named in the query
+    restrict both BM25 and FAISS to the matching rows, and results in a
+    parameter family it names are boosted by FAMILY_BOOST.
     """
-    # Sparse retrieval
-    tokenized_query = query.split()
-    bm25_scores = bm25.get_scores(tokenized_query)
-    # Sort chunks by BM25 score desc
-    bm25_ranked = sorted(
-        list(zip(range(len(chunk_texts)), bm25_scores)),
-        key=lambda x: x[1],
-        reverse=True
-    )
-    top_bm25 = bm25_ranked[:top_k]
+    return hybrid_search_batch(
+        [query], bm25, chunk_texts, faiss_index, metadata, dense_model, top_k=top_k,
+        search_params=search_params, id_map=id_map, partitions=partitions
+    )[0]
+
+def hybrid_search_batch(queries, bm25, chunk_texts, faiss_index, metadata, dense_model,
+                        top_k=5, batch_size=64, search_params=None, id_map=None, partitions=None):
+    """
+    hybrid_search for many queries at once: one batched encoder call, one
+    multi-row FAISS search and one sparse BM25 product for all unfiltered
+    queries; filtered queries score only their rows in BM25 and search FAISS
+    with an ID selector, one search per distinct filter.
+    Returns one result list per query, in the same order as `queries`.
+    """
+    import faiss
+
+    rows_list = None
+    family_rows_list = [None] * len(queries)
+    if partitions is not None:
+        with stage("filters"):
+            rows_list, family_rows_list = map(list, zip(*[partitions.query_rows(q) for q in queries]))
+
+    # Sparse retrieval: one sparse product, then argpartition top-k per query
+    with stage("bm25"):
+        bm25_top = bm25.top_k_batch([tokenize(q) for q in queries], top_k, rows_list=rows_list)
+    record_candidates("bm25", [len(ids) for ids, _ in bm25_top])
     
     # Dense retrieval
-    query_emb = dense_model.encode([query], convert_to_numpy=True)
-    # search in FAISS
-    # For an inner-product index, we might want to L2 normalize 
-    # the embeddings if we used IP. Adjust as needed.
-    # faiss.normalize_L2(query_emb)  # if relevant
-    distances, indices = faiss_index.search(query_emb, top_k)  # returns (scores, idx)
-    
-    # Convert results to list of (doc_id, score)
-    dense_results = [(idx, float(dist)) for idx, dist in zip(indices[0], distances[0])]
+    with stage("query_encoding"):
+        query_embs = dense_model.encode(list(queries), convert_to_numpy=True, batch_size=batch_size)
+    with stage("faiss"):
+        # The index holds L2-normalized vectors (see embedding.build_faiss_index),
+        # so normalize the queries too: inner product is then cosine in [-1, 1]
+        query_embs = np.array(query_embs, dtype=np.float32, order="C")
+        faiss.normalize_L2(query_embs)
+        distances, indices = _dense_search(faiss_index, query_embs, top_k, search_params, id_map, rows_list)
+        if id_map is not None:
+            indices = id_map.rows(indices)
+    record_candidates("faiss", [int(np.count_nonzero(row >= 0)) for row in indices])
     
+    results = []
+    with stage("merge"):
+        for (bm25_ids, bm25_scores), row_ids, row_dists, family_rows in zip(
+                bm25_top, indices, distances, family_rows_list):
+            top_bm25 = list(zip(bm25_ids.tolist(), bm25_scores))
+            # Convert results to list of (doc_id, score)
+            # (-1 pads the row when the index holds fewer than top_k vectors)
+            dense_results = [(idx, float(dist)) for idx, dist in zip(row_ids, row_dists) if idx >= 0]
+            results.append(_merge_results(top_bm25, dense_results, chunk_texts, metadata, top_k,
+                                          family_rows))
+    record_candidates("merge", [len(docs) for docs in results])
+    return results
+
+def _dense_search(faiss_index, query_embs, top_k, search_params, id_map, rows_list):
+    """
+    FAISS search of each query embedding, restricted to rows_list[i] when
+    given. Queries with the same rows share one search call.
+    """
+    search_params = search_params or {}
+    if rows_list is None or all(rows is None for rows in rows_list):
+        params = search_parameters(faiss_index, **search_params)
+        return faiss_index.search(query_embs, top_k, params=params)  # returns (scores, idx)
+
+    distances = np.full((len(query_embs), top_k), -np.inf, dtype=np.float32)
+    indices = np.full((len(query_embs), top_k), -1, dtype=np.int64)
+    groups = {}
+    for i, rows in enumerate(rows_list):
+        key = None if rows is None else rows.tobytes()
+        groups.setdefault(key, (rows, []))[1].append(i)
+    for rows, members in groups.values():
+        ids = None
+        if rows is not None:
+            # The index returns (and selects by) chunk ids when there is an id_map
+            ids = id_map.chunk_ids[rows] if id_map is not None else rows
+        params = search_parameters(faiss_index, ids=ids, **search_params)
+        distances[members], indices[members] = faiss_index.search(query_embs[members], top_k, params=params)
+    return distances, indices
+
+def _in_rows(doc_id, rows):
+    # rows is sorted (MetadataPartitions arrays)
+    pos = np.searchsorted(rows, doc_id)
+    return pos < len(rows) and rows[pos] == doc_id
+
+def _merge_results(top_bm25, dense_results, chunk_texts, metadata, top_k, family_rows=None):
+    """
+    Merges BM25 and dense (doc_id, score) lists into the final result dicts.
+    Positive scores of docs in family_rows are multiplied by FAMILY_BOOST.
+    """
     # Naive merge: just pick top_k from each, or unify them, re-sort by combined score
     # For demonstration, we'll place them in one list with a simple weighting
     # BM25 might be in range ~[0, X], FAISS in ~[0,1] if using IP.
@@ -62,6 +164,9 @@ def hybrid_search(query, bm25, chunk_texts, faiss_index, metadata, dense_model,
     # Put dense results
     for doc_id, score in dense_results:
         combined.append((doc_id, score * 100, "dense"))  # scale up for naive combination
+    if family_rows is not None:
+        combined = [(doc_id, score * FAMILY_BOOST if score > 0 and _in_rows(doc_id, family_rows) else score,
+                     source) for doc_id, score, source in combined]
     
     # Sort combined by score desc
     combined_sorted = sorted(combined, key=lambda x: x[1], reverse=True)
@@ -89,36 +194,23 @@ def hybrid_search(query, bm25, chunk_texts, faiss_index, metadata, dense_model,
 
 if __name__ == "__main__":
     # Example usage
-    # The chunk_texts and metadata come from embedding.py in the same order
-    # so store them in a separate file or handle them similarly
-    # For demonstration, re-construct them quickly below:
-    
+    # The chunk texts, metadata, BM25 statistics and FAISS index all come
+    # from the bundle written by embedding.py, in the same order.
+    from index_bundle import load_bundle
+
     BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    json_path = os.path.join(BASE_DIR,"data","processed","financial_data.json")
-    index_path = os.path.join(BASE_DIR,"embeddings","financial_data.index")
+    bundle_dir = os.path.join(BASE_DIR,"embeddings","financial_bundle")
     model_name = "sentence-transformers/all-MiniLM-L6-v2"
     
-    # Load data
-    financial_records = load_metadata(json_path)
-    
-    # Reconstruct the same chunks as in embedding.py 
-    from embedding import chunk_data
-    chunks = chunk_data(financial_records)
-    chunk_texts = [c[0] for c in chunks]
-    metadata = [c[1] for c in chunks]
-    
-    # Build BM25 index
-    bm25 = build_bm25_index(chunks)
-    
-    # Load FAISS index
-    faiss_index = faiss.read_index(index_path)
+    bundle = load_bundle(bundle_dir, model_name)
     
-    # Load dense model
-    dense_model = SentenceTransformer(model_name)
+    # Load dense model (behind the query-embedding cache)
+    dense_model = load_dense_model(model_name)
     
     # Query
     query = "What is the total revenue for 2023?"
-    results = hybrid_search(query, bm25, chunk_texts, faiss_index, metadata, dense_model)
+    results = hybrid_search(query, bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                            bundle.metadata, dense_model, id_map=bundle.id_map)
     
     for r in results:
         print(r)
@@ -0,0 +1,421 @@
+# service.py
+"""
+Asyncio HTTP/JSON service for the QA pipeline:
+guardrails -> structured lookup -> hybrid_search -> ReRanker -> generator.
+
+Concurrent requests are micro-batched per model stage: each stage has a
+MicroBatcher that collects requests for up to max_wait_ms (or max_batch
+items) and runs them as one batch (hybrid_search_batch, rerank_batch,
+generate_batch). Every stage runs in its own worker thread, so while one batch is being
+generated the next one is already being retrieved and re-ranked. A request
+waits at most max_wait_ms per stage for its batch to fill.
+
+Endpoints:
+    POST /answer   {"query": "..."} -> {"answer", "answered_by", "documents", "trace"}
+    GET  /health   batch statistics per stage, generator cache statistics,
+                   p50/p95/p99 per pipeline stage
+    GET  /metrics  stage latency histograms and cache/candidate counters in
+                   the Prometheus text format (see instrumentation.py)
+    GET  /traces   the most recent request traces
+
+Every request is traced (instrumentation.trace): its response carries the
+time spent per pipeline stage. Stages that ran in a micro-batch are
+recorded on every request of the batch, with the batch size under
+"<stage>_batch_size". --slow-ms profiles requests slower than the given
+time (stack sampling across the worker threads, see SlowRequestProfiler).
+
+Only the standard library is used for the server (no web framework).
+
+Usage:
+    python service.py --port 8000 --max-batch 16 --max-wait-ms 5 --profile cpu_int8
+    python service.py --slow-ms 500 --slow-dir profiles
+    python service.py --shards ../embeddings/shards
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from retrieval import hybrid_search_batch
+from inference_profile import PROFILES
+from instrumentation import METRICS, SlowRequestProfiler, trace, current_traces, use_traces
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+MAX_BODY_BYTES = 1 << 20
+
+
+class MicroBatcher:
+    """
+    Groups concurrent calls into batches for `fn`, which maps a list of
+    items to a list of results (same length and order).
+    A batch is run as soon as max_batch items are waiting or max_wait_ms
+    has passed since its first item arrived. Batches run one at a time on a
+    dedicated worker thread, so `fn` may block (model inference).
+    """
+    def __init__(self, fn, max_batch=16, max_wait_ms=5, name=None):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.name = name or getattr(fn, "__name__", "batcher")
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+
+    async def submit(self, item):
+        """
+        Queues `item` and waits for its result.
+        """
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, current_traces()))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _, _ in batch]
+            # Stages run for the batch are recorded on the traces of all its requests
+            traces = [t for _, _, item_traces in batch for t in item_traces]
+            for t in traces:
+                t.add_count(f"{self.name}_batch_size", len(items))
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self._call, traces, items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+            self.batches += 1
+            self.items += len(items)
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _call(self, traces, items):
+        with use_traces(traces):
+            return self.fn(items)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "busy_seconds": self.busy_seconds,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000
+        }
+
+
+class QAService:
+    """
+    The app.py pipeline with one MicroBatcher per model stage.
+    `bundle` is an index_bundle.IndexBundle, `generator` anything with
+    generate_batch(queries, docs_list) (e.g. CachedResponseGenerator);
+    `lookup` (StructuredLookup) is optional. With `shards` (a
+    shards.ShardedIndex) retrieval goes to the shards the query names
+    instead of `bundle`, which may then be None. With `bundle_dir` the
+    service switches to the bundle's new build once update_bundle (or a
+    rebuild) swaps it in, checking at most every reload_seconds.
+    """
+    def __init__(self, bundle, dense_model, reranker, generator, guardrails, lookup=None,
+                 top_k=5, max_batch=16, max_wait_ms=5, profiler=None, shards=None,
+                 bundle_dir=None, reload_seconds=5.0):
+        self.bundle = bundle
+        self.bundle_dir = bundle_dir
+        self.reload_seconds = reload_seconds
+        self._checked_at = time.monotonic()
+        self.shards = shards
+        self.dense_model = dense_model
+        self.reranker = reranker
+        self.generator = generator
+        self.guardrails = guardrails
+        self.lookup = lookup
+        self.top_k = top_k
+        self.profiler = profiler
+        self.retrieval = MicroBatcher(self._retrieve_batch, max_batch, max_wait_ms, "retrieval")
+        self.rerank = MicroBatcher(self._rerank_batch, max_batch, max_wait_ms, "rerank")
+        self.generation = MicroBatcher(self._generate_batch, max_batch, max_wait_ms, "generation")
+
+    def reload_bundle(self):
+        """
+        Loads the bundle's current build if it is not the one being served.
+        The structured lookup is rebuilt and the answer cache, keyed on the
+        old build, is dropped. Returns True if the bundle changed.
+        """
+        from index_bundle import current_build_id, load_bundle
+        from structured_lookup import StructuredLookup
+
+        self._checked_at = time.monotonic()
+        if self.bundle_dir is None or current_build_id(self.bundle_dir) == self.bundle.version:
+            return False
+        manifest = self.bundle.manifest
+        bundle = load_bundle(self.bundle_dir, manifest["model_name"], manifest["model_fingerprint"])
+        if self.lookup is not None:
+            self.lookup = StructuredLookup(bundle.metadata)
+        cache = getattr(self.generator, "cache", None)
+        if cache is not None:
+            cache.set_index_version(bundle.version)
+        # Batches already running keep the bundle they started with
+        self.bundle = bundle
+        return True
+
+    def _retrieve_batch(self, queries):
+        if self.shards is not None:
+            return [self.shards.search(q, self.dense_model, top_k=self.top_k) for q in queries]
+        bundle = self.bundle
+        return hybrid_search_batch(
+            queries, bundle.bm25, bundle.chunk_texts, bundle.faiss_index, bundle.metadata,
+            self.dense_model, top_k=self.top_k, id_map=bundle.id_map,
+            partitions=bundle.partitions
+        )
+
+    def _rerank_batch(self, items):
+        return self.reranker.rerank_batch([q for q, _ in items], [docs for _, docs in items])
+
+    def _generate_batch(self, items):
+        answers = self.generator.generate_batch([q for q, _ in items], [docs for _, docs in items])
+        cache_hits = getattr(self.generator, "last_cache_hits", None) or [False] * len(answers)
+        return list(zip(answers, cache_hits))
+
+    async def answer(self, query):
+        """
+        Runs one query through the pipeline. Returns (status, response dict);
+        successful responses include the request's trace.
+        """
+        with trace("answer", query, self.profiler) as query_trace:
+            status, response = await self._answer(query)
+        if status == 200:
+            response["trace"] = query_trace.to_dict()
+        return status, response
+
+    async def _answer(self, query):
+        if self.bundle_dir is not None and time.monotonic() - self._checked_at >= self.reload_seconds:
+            self.reload_bundle()
+        verdict = self.guardrails.classify(query)
+        if verdict["harmful"]:
+            return 400, {"error": "This query cannot be answered."}
+        if not verdict["financial"]:
+            return 400, {"error": "Please ask a finance question."}
+
+        if self.lookup is not None:
+            cell = self.lookup.resolve(query)
+            if cell is not None:
+                return 200, {
+                    "answer": f"{cell['finance_parameter']} ({cell['year']}): {cell['value']}",
+                    "answered_by": "structured lookup",
+                    "documents": [cell]
+                }
+
+        docs = await self.retrieval.submit(query)
+        docs = await self.rerank.submit((query, docs))
+        if not docs:
+            return 200, {"answer": None, "answered_by": "retrieval", "documents": []}
+        answer, cache_hit = await self.generation.submit((query, docs))
+        return 200, {
+            "answer": answer,
+            "answered_by": "answer cache" if cache_hit else "retrieval + generation",
+            "documents": docs
+        }
+
+    def stats(self):
+        stats = {b.name: b.stats() for b in (self.retrieval, self.rerank, self.generation)}
+        if hasattr(self.generator, "stats"):
+            # Prompt assembly and encoder cache (SLMResponseGenerator.stats)
+            stats["generator"] = self.generator.stats()
+        stats["latency"] = METRICS.stage_summary()
+        return stats
+
+
+def _json_default(obj):
+    # numpy scalars (doc ids, scores) in the result dicts
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+async def _read_request(reader):
+    """
+    Parses one HTTP/1.1 request. Returns (method, path, headers, body),
+    or None when the client closed the connection.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError("Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+def _write_response(writer, status, payload, keep_alive):
+    # str payloads are sent as text (the /metrics exposition format)
+    if isinstance(payload, str):
+        body = payload.encode("utf-8")
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        body = json.dumps(payload, default=_json_default).encode("utf-8")
+        content_type = "application/json"
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+async def handle_connection(service, reader, writer):
+    """
+    Serves requests on one connection until the client closes it
+    (HTTP/1.1 keep-alive) or asks to close it.
+    """
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                _write_response(writer, 400, {"error": "Malformed request"}, False)
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+
+            if method == "GET" and path == "/health":
+                status, payload = 200, {"status": "ok", "stages": service.stats()}
+            elif method == "GET" and path == "/metrics":
+                status, payload = 200, METRICS.export_text()
+            elif method == "GET" and path == "/traces":
+                status, payload = 200, {"traces": [t.to_dict() for t in list(METRICS.recent_traces)]}
+            elif method == "POST" and path == "/answer":
+                try:
+                    query = json.loads(body)["query"].strip()
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    status, payload = 400, {"error": 'Expected a JSON body {"query": "..."}'}
+                else:
+                    try:
+                        status, payload = await service.answer(query)
+                    except Exception as e:
+                        status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+            else:
+                status, payload = 404, {"error": f"No route for {method} {path}"}
+
+            _write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(service, host="127.0.0.1", port=8000):
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(service, r, w), host, port
+    )
+    print(f"Serving on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def build_service(max_batch=16, max_wait_ms=5, profile=None, profiler=None, shard_root=None):
+    """
+    Loads the same models and index bundle as app.py, all three models
+    under the given inference profile (see inference_profile.py).
+    profiler is an optional instrumentation.SlowRequestProfiler.
+    With shard_root (built by shards.py) the service answers over every
+    company's shard instead; the structured lookup, which reads one
+    bundle's metadata, is then off.
+    """
+    from embedding import model_fingerprint
+    from index_bundle import load_bundle
+    from retrieval import load_dense_model
+    from re_ranking import ReRanker
+    from slm_generation import SLMResponseGenerator
+    from answer_cache import SemanticAnswerCache, CachedResponseGenerator
+    from shards import ShardedIndex
+    from structured_lookup import StructuredLookup
+    from guardrails import GuardrailEngine
+    from finance_keywords import FINANCE_KEYWORDS
+
+    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    bundle_dir = os.path.join(BASE_DIR, "embeddings", "financial_bundle")
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+
+    dense_model = load_dense_model(
+        model_name, cache_path=os.path.join(BASE_DIR, "embeddings", "query_embeddings.sqlite"),
+        profile=profile
+    )
+    fingerprint = model_fingerprint(dense_model, model_name)
+    if shard_root is not None:
+        bundle, lookup = None, None
+        shards = ShardedIndex(shard_root, model_name, fingerprint)
+        index_version = shards.version
+    else:
+        bundle = load_bundle(bundle_dir, model_name, fingerprint)
+        lookup = StructuredLookup(bundle.metadata, FINANCE_KEYWORDS)
+        shards = None
+        index_version = bundle.version
+    generator = CachedResponseGenerator(
+        SLMResponseGenerator(model_name="google/flan-t5-base", profile=profile),
+        dense_model,
+        SemanticAnswerCache(index_version=index_version)
+    )
+    return QAService(
+        bundle, dense_model, ReRanker(profile=profile), generator, GuardrailEngine(FINANCE_KEYWORDS),
+        lookup, max_batch=max_batch, max_wait_ms=max_wait_ms, profiler=profiler, shards=shards,
+        bundle_dir=bundle_dir if shard_root is None else None
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Financial QA HTTP service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=16, help="items per model batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5,
+                        help="longest a request waits for its batch to fill, per stage")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=None,
+                        help="inference profile (default: $INFERENCE_PROFILE or fp32)")
+    parser.add_argument("--slow-ms", type=float, default=None,
+                        help="profile requests slower than this (default: no profiling)")
+    parser.add_argument("--slow-dir", default="profiles", help="where slow-request profiles are written")
+    parser.add_argument("--slow-profiler", choices=["sample", "cprofile"], default="sample",
+                        help="stack sampling covers the batch worker threads; cProfile only the event loop")
+    parser.add_argument("--shards", default=None,
+                        help="shard root built by shards.py (default: the single bundle app.py uses)")
+    args = parser.parse_args()
+
+    profiler = None
+    if args.slow_ms is not None:
+        profiler = SlowRequestProfiler(args.slow_ms, args.slow_dir, args.slow_profiler)
+    service = build_service(args.max_batch, args.max_wait_ms, args.profile, profiler, args.shards)
+    asyncio.run(serve(service, args.host, args.port))
@@ -0,0 +1,217 @@
+# shards.py
+"""
+Multi-company storage: one index bundle (FAISS + BM25 + texts + metadata)
+per ticker, plus a router that sends each query only to the shards of the
+companies it names.
+
+Layout of a shard root:
+    catalog.json          tickers, company names and chunk counts
+    <TICKER>/             an index bundle (see index_bundle.py)
+
+Shards are loaded lazily on first use and kept in an LRU of at most
+`max_loaded` bundles, so memory scales with the tickers being queried rather
+than with the total number of tickers. A query that names no company fans
+out to every shard and the per-shard results are merged into a global top-k.
+Shard scores are not comparable (each BM25 has its own corpus statistics),
+so the per-shard results are merged on the cosine between the query and
+each result's vector, which every shard embeds with the same bi-encoder.
+A fan-out wider than the LRU loads the shards it misses without caching
+them, so it does not evict the working set.
+
+service.py serves a shard root with --shards.
+"""
+
+import os
+import re
+import json
+from collections import OrderedDict
+import numpy as np
+
+from embedding import chunk_data, build_bundle
+from financial_store import load_records
+from index_bundle import load_bundle, read_manifest
+from retrieval import hybrid_search
+
+CATALOG_FILE = "catalog.json"
+CATALOG_FORMAT_VERSION = 1
+DEFAULT_TICKER = "AAPL"
+
+def group_by_ticker(financial_records, default_ticker=DEFAULT_TICKER):
+    """
+    Splits records into {ticker: [records]}; records without a "ticker"
+    field (single-company data) belong to default_ticker.
+    """
+    groups = {}
+    for record in financial_records:
+        groups.setdefault(record.get("ticker", default_ticker), []).append(record)
+    return groups
+
+def read_catalog(shard_root):
+    with open(os.path.join(shard_root, CATALOG_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def build_shards(financial_records, shard_root, model, model_name, company_names=None,
+                 index_config=None, store_dir=None):
+    """
+    Writes (or incrementally updates, see embedding.build_bundle) one bundle
+    per ticker under shard_root, then the catalog.
+    company_names maps a ticker to the names the router should recognize
+    (e.g. {"AAPL": ["Apple", "Apple Inc"]}); index_config and store_dir
+    are passed to build_bundle as in embedding.py.
+    """
+    company_names = company_names or {}
+    os.makedirs(shard_root, exist_ok=True)
+
+    catalog = {"format_version": CATALOG_FORMAT_VERSION, "shards": {}}
+    for ticker, records in sorted(group_by_ticker(financial_records).items()):
+        chunks = chunk_data(records)
+        build_bundle(chunks, os.path.join(shard_root, ticker), model, model_name, index_config,
+                     store_dir)
+        catalog["shards"][ticker] = {
+            "names": company_names.get(ticker, []),
+            "num_chunks": len(chunks)
+        }
+
+    with open(os.path.join(shard_root, CATALOG_FILE), "w", encoding="utf-8") as f:
+        json.dump(catalog, f, indent=2)
+    return catalog
+
+
+class QueryRouter:
+    """
+    Finds the tickers a query refers to. Tickers must appear in upper case as
+    a whole word ("AAPL", "$AAPL") so short tickers like "ON" or "ALL" do not
+    fire on ordinary words; company names match case-insensitively as whole
+    words. Both are compiled into one pattern each.
+    """
+    def __init__(self, catalog):
+        self.tickers = set(catalog["shards"])
+        self.names = {}
+        for ticker, info in catalog["shards"].items():
+            for name in info.get("names", []):
+                self.names.setdefault(name.lower(), ticker)
+
+        def alternation(words):
+            return "|".join(re.escape(w) for w in sorted(words, key=lambda w: (-len(w), w)))
+
+        self.ticker_pattern = re.compile(rf"(?<![\w.])\$?({alternation(self.tickers)})\b") if self.tickers else None
+        self.name_pattern = re.compile(rf"\b({alternation(self.names)})\b") if self.names else None
+
+    def route(self, query):
+        """
+        Tickers named in the query, in order of appearance; [] if none.
+        """
+        found = []
+        matches = []
+        if self.ticker_pattern is not None:
+            matches += [(m.start(), m.group(1)) for m in self.ticker_pattern.finditer(query)]
+        if self.name_pattern is not None:
+            matches += [(m.start(), self.names[m.group(1)]) for m in self.name_pattern.finditer(query.lower())]
+        for _, ticker in sorted(matches):
+            if ticker not in found:
+                found.append(ticker)
+        return found
+
+
+class ShardedIndex:
+    """
+    Lazily loaded per-ticker bundles behind a QueryRouter.
+    """
+    def __init__(self, shard_root, model_name=None, model_fingerprint=None, max_loaded=32):
+        self.shard_root = shard_root
+        self.model_name = model_name
+        self.model_fingerprint = model_fingerprint
+        self.max_loaded = max_loaded
+        self.catalog = read_catalog(shard_root)
+        self.router = QueryRouter(self.catalog)
+        self._loaded = OrderedDict()
+
+    @property
+    def tickers(self):
+        return list(self.catalog["shards"])
+
+    @property
+    def version(self):
+        """
+        Identifies this build of the shards (the build ids of all of them),
+        as IndexBundle.version does for one bundle.
+        """
+        return ",".join(
+            f"{ticker}:{read_manifest(os.path.join(self.shard_root, ticker))['build_id']}"
+            for ticker in sorted(self.tickers)
+        )
+
+    def shard(self, ticker, cache=True):
+        """
+        The bundle for `ticker`, loading it (and evicting the least recently
+        used shard) if needed. With cache=False a shard that is not loaded
+        is loaded for this call only.
+        """
+        bundle = self._loaded.get(ticker)
+        if bundle is None:
+            if ticker not in self.catalog["shards"]:
+                raise KeyError(f"No shard for ticker {ticker}")
+            bundle = load_bundle(
+                os.path.join(self.shard_root, ticker), self.model_name, self.model_fingerprint
+            )
+            if not cache:
+                return bundle
+            self._loaded[ticker] = bundle
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+        self._loaded.move_to_end(ticker)
+        return bundle
+
+    def route(self, query):
+        """
+        Tickers to search for `query`: the ones it names, else all of them.
+        """
+        return self.router.route(query) or self.tickers
+
+    def search(self, query, dense_model, top_k=5, tickers=None):
+        """
+        hybrid_search over the routed shards, merged into one global top-k
+        by "dense_score", the cosine between the query and the result's
+        vector. Each result carries the "ticker" of its shard; doc_id and
+        score are local to it.
+        """
+        tickers = tickers or self.route(query)
+        query_emb = np.asarray(dense_model.encode([query], convert_to_numpy=True)[0], dtype=np.float32)
+        query_emb /= max(np.linalg.norm(query_emb), 1e-12)
+        # Shards beyond the LRU's capacity are searched without being cached
+        cache = len(tickers) <= self.max_loaded
+        results = []
+        for ticker in tickers:
+            bundle = self.shard(ticker, cache=cache)
+            docs = hybrid_search(
+                query, bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                bundle.metadata, dense_model, top_k=top_k, id_map=bundle.id_map,
+                partitions=bundle.partitions
+            )
+            vectors = bundle.row_vectors([doc["doc_id"] for doc in docs])
+            for doc, dense_score in zip(docs, vectors @ query_emb):
+                doc["ticker"] = ticker
+                doc["dense_score"] = float(dense_score)
+            results.extend(docs)
+        return sorted(results, key=lambda d: d["dense_score"], reverse=True)[:top_k]
+
+
+if __name__ == "__main__":
+    from sentence_transformers import SentenceTransformer
+
+    BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    records_dir = os.path.join(BASE_DIR, "data", "processed", "financial_data")
+    companies_path = os.path.join(BASE_DIR, "data", "companies.json")
+    shard_root = os.path.join(BASE_DIR, "embeddings", "shards")
+    store_dir = os.path.join(BASE_DIR, "embeddings", "embedding_store")
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+
+    financial_records = load_records(records_dir)
+    with open(companies_path, "r", encoding="utf-8") as f:
+        company_names = json.load(f)
+
+    catalog = build_shards(
+        financial_records, shard_root, SentenceTransformer(model_name), model_name, company_names,
+        store_dir=store_dir
+    )
+    print(f"Built {len(catalog['shards'])} shards in {shard_root}")
@@ -1,78 +1,462 @@
+import re
+import time
+import threading
+from collections import OrderedDict
 import torch
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+from transformers import (T5Tokenizer, T5TokenizerFast, T5ForConditionalGeneration, TextIteratorStreamer,
+                          StoppingCriteria, StoppingCriteriaList)
+from transformers.modeling_outputs import BaseModelOutput
+
+from inference_profile import get_profile
+from structured_lookup import COMPARISON_WORDS, normalize_phrase
+from instrumentation import stage, record_cache, current_traces, use_traces
+
+# Decoding budget per query class (see classify_query): beam count, new
+# tokens, where to stop, and how many prompt tokens of context to include.
+# Point answers are one value and comparisons one statement, so both stop
+# at the end of the first sentence; summaries (a sentence per year) stop at
+# the model's end-of-sequence token ("eos"). T5's sentencepiece vocabulary
+# has no newline token, so a stop at the end of a line would never fire.
+GENERATION_BUDGETS = {
+    "point": {"num_beams": 1, "max_new_tokens": 48, "stop": "sentence", "context_tokens": 160},
+    "comparison": {"num_beams": 2, "max_new_tokens": 96, "stop": "sentence", "context_tokens": 320},
+    "summary": {"num_beams": 4, "max_new_tokens": 160, "stop": "eos", "context_tokens": 320},
+}
+
+# A sentence ends at ., ! or ? followed by whitespace, so decimals
+# ("383285000000.0") do not end it. Stops without a pattern ("eos") end
+# at the end-of-sequence token only.
+STOP_PATTERNS = {
+    "sentence": re.compile(r"[.!?](?=\s)|\n"),
+}
+
+# Prompt templates as (text before the question, text between question and
+# context, text after the context). Every piece starts and ends at a word
+# boundary, so the pieces can be tokenized once and their ids concatenated.
+PROMPT_TEMPLATES = {
+    # Modify the prompt to avoid unnecessary output and directly ask for the numeric value and parameter
+    "point": (
+        "You are a helpful assistant that answers questions concisely based on the provided context.\n\n"
+        "Question: ",
+        "\n\nContext:\n",
+        "\n\n"
+        "Instructions:\n"
+        "1. Return the **Value** and **Parameter** from the document with the highest re-rank score that best answers the question.\n"
+        "2. **Do not include any other context, details, or metadata. Just provide the numeric value and parameter.**\n"
+    ),
+    "summary": (
+        "You are a helpful assistant that produces a descriptive summary based on provided context. "
+        "The context contains data with a 'value', 'parameter', and 'year'. "
+        "Your task is to aggregate and summarize the values and parameters by year. "
+        "For each year, produce a clear, complete sentence that states the total or summarized value along with its parameter. "
+        "Make sure that the summary is coherent and only includes the aggregated results as per the available years. \n\n"
+        "Question: ",
+        "\n\n"
+        "Context:\n",
+        "\n\n"
+        "Instructions:\n"
+        "1. Parse the provided context to identify all entries with their respective value, parameter, and year.\n"
+        "2. Aggregate the values and parameters for each year if multiple entries exist.\n"
+        "3. For each year, write a full sentence that describes the aggregated result in a natural, clear language.\n"
+        "4. Do not include any extra information besides these sentences.\n"
+    ),
+}
+
+def template_name(query_class):
+    # Summaries and comparisons both need several values: summary template
+    return "point" if query_class == "point" else "summary"
+
+def whitespace_joins(segments):
+    """
+    True if every join between consecutive non-empty segments has
+    whitespace on one side, so tokenizing the segments one by one gives
+    the same pieces as tokenizing them joined.
+    """
+    segments = [segment for segment in segments if segment]
+    return all(left[-1].isspace() or right[0].isspace() for left, right in zip(segments, segments[1:]))
+
+def classify_query(query):
+    """
+    "summary" for queries spanning several years, "comparison" for queries
+    comparing values, otherwise "point" (a single value lookup).
+    Comparison words are the ones structured_lookup uses; none of them
+    occurs in a parameter name ("Change In Inventory" is a point query).
+    """
+    q = query.lower()
+    if ((any(word in q for word in ['two', '2', 'multiple', 'over']) and 'years' in q) or ('2023' in q and '2024' in q)):
+        return "summary"
+    if COMPARISON_WORDS.intersection(normalize_phrase(q).split()):
+        return "comparison"
+    return "point"
+
+def trim_answer(text, stop="eos"):
+    """
+    The answer up to its stop point: for stop="sentence" the end of the
+    first sentence, for "eos" all of it.
+    """
+    text = text.strip()
+    if stop not in STOP_PATTERNS:
+        return text
+    match = STOP_PATTERNS[stop].search(text)
+    if match is None:
+        return text
+    end = match.start() + (0 if text[match.start()] == "\n" else 1)
+    return text[:end].strip()
+
+
+class EncoderOutputCache:
+    """
+    LRU cache of T5 encoder states keyed by (template, question, context),
+    so regenerating an answer for the same prompt (a retry, a stream after
+    a batch, other decoding settings) skips the encoder pass. The
+    generator is shared across threads, so the cache is locked.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache("encoder", state is not None)
+        return state
+
+    def put(self, key, state):
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def add_encode_time(self, seconds):
+        with self._lock:
+            self.encode_seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return self._stats()
+
+    def _stats(self):
+        lookups = self.hits + self.misses
+        # Time saved: hits times the mean encoder time of a miss
+        seconds_per_encode = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            "size": len(self._states),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": self.hits * seconds_per_encode
+        }
+
+
+class StopOnPattern(StoppingCriteria):
+    """
+    Stops each sequence once its generated text reaches the stop pattern
+    (e.g. the end of the first sentence).
+    """
+    def __init__(self, tokenizer, stop):
+        self.tokenizer = tokenizer
+        self.pattern = STOP_PATTERNS[stop]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids, skip_special_tokens=True)
+        return torch.tensor([bool(self.pattern.search(t.strip())) for t in texts],
+                            dtype=torch.bool, device=input_ids.device)
+
 
 class SLMResponseGenerator:
-    def __init__(self, model_name="google/flan-t5-base"):
+    def __init__(self, model_name="google/flan-t5-base", profile=None, encoder_cache_size=64):
         """
         Initializes a T5-Small model and tokenizer.
         You can switch to other open-source models, e.g. 't5-base', 'facebook/bart-base', etc.
+        profile is an inference profile or its name (see inference_profile.py).
+        Encoder states of the last encoder_cache_size prompts are cached
+        (0 disables the cache).
         """
-        self.tokenizer = T5Tokenizer.from_pretrained(model_name)
+        self.profile = get_profile(profile)
+        self.profile.apply_threads()
+        tokenizer_class = T5TokenizerFast if self.profile.fast_tokenizer else T5Tokenizer
+        self.tokenizer = tokenizer_class.from_pretrained(model_name)
         self.model = T5ForConditionalGeneration.from_pretrained(model_name)
 
         # Decide whether to use GPU or CPU
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
+        self.model = self.profile.prepare(self.model.to(self.device), self.device)
+
+        self.encoder_cache = EncoderOutputCache(encoder_cache_size) if encoder_cache_size else None
+        self._piece_ids = {}
+        self._checked_templates = set()
+        self.assemble_ids = True
+        # Guards _piece_ids, _checked_templates and assemble_ids
+        self._lock = threading.Lock()
+
+    def _tokenize(self, texts):
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    def _context_lines(self, retrieved_docs, max_tokens):
+        """
+        (lines, token ids per line) of the retrieved documents in re-rank
+        order, as many as fit in max_tokens prompt tokens (at least one).
+        """
+        lines = [f"Document {i+1} [Re-rank Score: {doc['re_rank_score']}]: {doc['text']}\n"
+                 for i, doc in enumerate(retrieved_docs)]
+        if not lines:
+            return [], []
+        line_ids = self._tokenize(lines)
+        used = len(line_ids[0])
+        count = 1
+        for ids in line_ids[1:]:
+            if used + len(ids) > max_tokens:
+                break
+            used += len(ids)
+            count += 1
+        return lines[:count], line_ids[:count]
+
+    def context_docs(self, query, retrieved_docs, query_class=None):
+        """
+        The retrieved documents that build_prompt puts in the prompt for
+        this query (the leading ones that fit its class's context budget).
+        """
+        query_class = query_class or classify_query(query)
+        lines, _ = self._context_lines(retrieved_docs, GENERATION_BUDGETS[query_class]["context_tokens"])
+        return retrieved_docs[:len(lines)]
+
+    def build_context(self, retrieved_docs, max_tokens=320):
+        """
+        Context string of the retrieved documents in re-rank order, as many
+        as fit in max_tokens prompt tokens (always at least one).
+        """
+        return "".join(self._context_lines(retrieved_docs, max_tokens)[0])
+
+    def build_prompt(self, query, retrieved_docs, query_class=None):
+        """
+        Builds the prompt for a query: a precise numeric answer for point
+        lookups, a per-year summary for summaries and comparisons. The
+        context is trimmed to the class's token budget.
+        """
+        query_class = query_class or classify_query(query)
+        # Combine top documents into a context string
+        context = self.build_context(retrieved_docs, GENERATION_BUDGETS[query_class]["context_tokens"])
+        before, between, after = PROMPT_TEMPLATES[template_name(query_class)]
+        return before + query + between + context + after
+
+    def encode_prompt(self, query, retrieved_docs, query_class=None):
+        """
+        Token ids of build_prompt(...) and its encoder cache key. The ids are
+        assembled from the cached ids of the template pieces, the question
+        and the context lines, so only the question and the context are
+        tokenized. Ids are only assembled when every join between the
+        segments falls on whitespace, where sentencepiece splits anyway;
+        other prompts are tokenized in full. The first prompt of each
+        template is also tokenized in full; if the ids differ, prompts are
+        tokenized in full from then on.
+        """
+        query_class = query_class or classify_query(query)
+        template = template_name(query_class)
+        lines, line_ids = self._context_lines(retrieved_docs, GENERATION_BUDGETS[query_class]["context_tokens"])
+        context = "".join(lines)
+        key = (template, query, context)
+        pieces = PROMPT_TEMPLATES[template]
+        prompt = pieces[0] + query + pieces[1] + context + pieces[2]
+
+        segments = [pieces[0], query, pieces[1], *lines, pieces[2]]
+        if not self.assemble_ids or not whitespace_joins(segments):
+            return self.tokenizer([prompt])["input_ids"][0], key
+        with self._lock:
+            missing = [piece for piece in pieces if piece not in self._piece_ids]
+        piece_ids = dict(zip(missing, self._tokenize(missing))) if missing else {}
+        with self._lock:
+            self._piece_ids.update(piece_ids)
+            piece_ids = {piece: self._piece_ids[piece] for piece in pieces}
+            check = template not in self._checked_templates
+            self._checked_templates.add(template)
+        ids = list(piece_ids[pieces[0]])
+        ids += self._tokenize([query])[0]
+        ids += piece_ids[pieces[1]]
+        for line in line_ids:
+            ids += line
+        ids += piece_ids[pieces[2]]
+        ids.append(self.tokenizer.eos_token_id)
+
+        if check:
+            full_ids = self.tokenizer([prompt])["input_ids"][0]
+            if list(full_ids) != ids:
+                with self._lock:
+                    self.assemble_ids = False
+                return full_ids, key
+        return ids, key
+
+    def _encode(self, input_ids, keys):
+        """
+        Encoder states for a batch of prompt ids, from the encoder cache
+        where possible; the misses are encoded in one pass. Returns the
+        generate() arguments (encoder_outputs, attention_mask).
+        """
+        cache = self.encoder_cache
+        states = [cache.get(key) if cache is not None else None for key in keys]
+        missing = [i for i, state in enumerate(states) if state is None]
+        if missing:
+            with stage("tokenization"):
+                inputs = self.tokenizer.pad(
+                    {"input_ids": [input_ids[i] for i in missing]}, return_tensors="pt"
+                ).to(self.device)
+            start = time.perf_counter()
+            with stage("generation"), self.profile.context():
+                hidden = self.model.get_encoder()(
+                    input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+                ).last_hidden_state
+            for j, i in enumerate(missing):
+                states[i] = hidden[j, :len(input_ids[i])].clone()
+                if cache is not None:
+                    cache.put(keys[i], states[i])
+            if cache is not None:
+                cache.add_encode_time(time.perf_counter() - start)
+
+        # Right-pad the states into one batch, masking the padding
+        length = max(len(state) for state in states)
+        hidden = states[0].new_zeros((len(states), length, states[0].shape[-1]))
+        attention_mask = torch.zeros((len(states), length), dtype=torch.long, device=self.device)
+        for i, state in enumerate(states):
+            hidden[i, :len(state)] = state
+            attention_mask[i, :len(state)] = 1
+        return BaseModelOutput(last_hidden_state=hidden), attention_mask
+
+    def stats(self):
+        with self._lock:
+            assemble_ids, template_pieces = self.assemble_ids, len(self._piece_ids)
+        return {
+            "assemble_ids": assemble_ids,
+            "template_pieces": template_pieces,
+            "encoder_cache": self.encoder_cache.stats() if self.encoder_cache is not None else None
+        }
 
     def generate_response(self, query, retrieved_docs, max_length=512):
         """
         Generate either a short summary or a precise numeric answer
         depending on the query.
         """
-        # Combine top documents into a context string
-        context = ""
-        for i, doc in enumerate(retrieved_docs[:3]):
-            context += f"Document {i+1} [Re-rank Score: {doc['re_rank_score']}]: {doc['text']}\n"
-
-        # Modify the prompt to avoid unnecessary output and directly ask for the numeric value and parameter
-        prompt = (
-            f"You are a helpful assistant that answers questions concisely based on the provided context.\n\n"
-            f"Question: {query}\n\n"
-            f"Context:\n{context}\n\n"
-            "Instructions:\n"
-            "1. Return the **Value** and **Parameter** from the document with the highest re-rank score that best answers the question.\n"
-            "2. **Do not include any other context, details, or metadata. Just provide the numeric value and parameter.**\n"
-        )
-
-
-        if ((any(word in query.lower() for word in ['two', '2', 'multiple', 'over']) and 'years' in query.lower()) or ('2023' in query.lower() and '2024' in query.lower())):
-            prompt = (
-                "You are a helpful assistant that produces a descriptive summary based on provided context. "
-                "The context contains data with a 'value', 'parameter', and 'year'. "
-                "Your task is to aggregate and summarize the values and parameters by year. "
-                "For each year, produce a clear, complete sentence that states the total or summarized value along with its parameter. "
-                "Make sure that the summary is coherent and only includes the aggregated results as per the available years. \n\n"
-                f"Question: {query}\n\n"
-                "Context:\n"
-                f"{context}\n\n"
-                "Instructions:\n"
-                "1. Parse the provided context to identify all entries with their respective value, parameter, and year.\n"
-                "2. Aggregate the values and parameters for each year if multiple entries exist.\n"
-                "3. For each year, write a full sentence that describes the aggregated result in a natural, clear language.\n"
-                "4. Do not include any extra information besides these sentences.\n"
-                )
+        return self.generate_batch([query], [retrieved_docs], max_length=max_length)[0]
 
+    def _generate_kwargs(self, query_class, max_length):
+        budget = GENERATION_BUDGETS[query_class]
+        kwargs = {
+            "max_new_tokens": min(budget["max_new_tokens"], max_length),
+            "num_beams": budget["num_beams"]
+        }
+        if budget["stop"] in STOP_PATTERNS:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([StopOnPattern(self.tokenizer, budget["stop"])])
+        if budget["num_beams"] > 1:
+            kwargs["early_stopping"] = True
+        return kwargs
 
+    def generate_batch(self, queries, retrieved_docs_list, max_length=512, batch_size=8):
+        """
+        generate_response for many queries: each query is classified
+        (classify_query) and decoded with its class's budget. Prompts are
+        encoded once (encode_prompt), grouped by class, sorted by length and cut into
+        batches of `batch_size`, so each padded batch holds prompts of
+        similar length (little padding waste) and one decoding budget.
+        Each batch is one encoder pass over the prompts missing from the
+        encoder cache and one generate call with an attention mask.
+        Returns the answers in the order of `queries`.
+        """
+        classes = [classify_query(q) for q in queries]
+        with stage("tokenization"):
+            encoded = [self.encode_prompt(q, docs, c) for q, docs, c in zip(queries, retrieved_docs_list, classes)]
+        input_ids = [ids for ids, _ in encoded]
+
+        answers = [None] * len(queries)
+        for query_class in GENERATION_BUDGETS:
+            order = sorted((i for i, c in enumerate(classes) if c == query_class),
+                           key=lambda i: len(input_ids[i]))
+            stop = GENERATION_BUDGETS[query_class]["stop"]
+            for start in range(0, len(order), batch_size):
+                bucket = order[start:start + batch_size]
+                encoder_outputs, attention_mask = self._encode(
+                    [input_ids[i] for i in bucket], [encoded[i][1] for i in bucket]
+                )
+                with stage("generation"), self.profile.context():
+                    outputs = self.model.generate(
+                        encoder_outputs=encoder_outputs,
+                        attention_mask=attention_mask,
+                        **self._generate_kwargs(query_class, max_length)
+                    )
 
-        # Debugging - Check the generated prompt
-        # print(prompt)
+                # Decode the output, and clean it to return only relevant content
+                with stage("decode"):
+                    for i, text in zip(bucket, self.tokenizer.batch_decode(outputs, skip_special_tokens=True)):
+                        # Only return the first sentence of point and comparison answers
+                        answers[i] = trim_answer(text, stop)
+        return answers
+
+    def generate_stream(self, query, retrieved_docs, max_length=512):
+        """
+        Streaming variant of generate_response: yields the answer text piece
+        by piece while the model is still decoding, stopping where
+        generate_response stops (first sentence, or end of sequence).
+        Streamers need a single hypothesis, so this decodes greedily
+        (num_beams=1) and may word answers differently from beam search.
+        """
+        query_class = classify_query(query)
+        stop = GENERATION_BUDGETS[query_class]["stop"]
+        with stage("tokenization"):
+            input_ids, key = self.encode_prompt(query, retrieved_docs, query_class)
+        encoder_outputs, attention_mask = self._encode([input_ids], [key])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generate_kwargs = self._generate_kwargs(query_class, max_length)
+        generate_kwargs["num_beams"] = 1
+        generate_kwargs.pop("early_stopping", None)
+        errors = []
+        # The generation thread does not inherit this context's traces
+        traces = current_traces()
 
-        # Ensure the prompt is processed as intended
-        input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(self.device)
-        outputs = self.model.generate(
-            input_ids,
-            max_length=max_length,
-            num_beams=4,
-            early_stopping=True
-        )
+        def run():
+            try:
+                with use_traces(traces), stage("generation"), self.profile.context():
+                    self.model.generate(
+                        encoder_outputs=encoder_outputs,
+                        attention_mask=attention_mask,
+                        streamer=streamer,
+                        **generate_kwargs
+                    )
+            except Exception as e:
+                # Unblock the consumer; the error is re-raised below
+                errors.append(e)
+                streamer.text_queue.put(streamer.stop_signal)
 
-        # Decode the output, and clean it to return only relevant content
-        answer = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-    
-        # Strip unwanted characters and ensure it contains only the value and parameter
-        answer = answer.strip().split('\n')[0]  # Only return the first line with the answer
-        print(answer)
-        return answer
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        text = ""
+        sent = 0
+        for piece in streamer:
+            text += piece
+            # Same cleanup as generate_batch: no leading whitespace, cut at the stop
+            answer = trim_answer(text, stop)
+            stopped = stop in STOP_PATTERNS and STOP_PATTERNS[stop].search(text.strip()) is not None
+            if len(answer) > sent:
+                yield answer[sent:]
+                sent = len(answer)
+            if stopped:
+                # Drain the rest so the generation thread can finish
+                for _ in streamer:
+                    pass
+                break
+        thread.join()
+        if errors:
+            raise errors[0]
 
 
 
@@ -0,0 +1,226 @@
+# structured_lookup.py
+"""
+Deterministic fast path for point queries such as "Total Revenue 2023".
+
+Builds an in-memory index over the (ticker, year, finance_parameter)
+metadata that embedding.chunk_data produces. A query that names exactly one
+year and one parameter, of one company, is answered straight from the index,
+skipping BM25, dense search, re-ranking and generation. The company is the
+ticker the query names in upper case ("AAPL revenue 2023"), the one the
+caller passes, or the only one the index holds.
+
+Parameter names are matched as whole phrases of the query; common finance
+terms from finance_keywords.FINANCE_KEYWORDS ("revenue", "debt", ...) are
+mapped to parameter names when they fit exactly one, and near-miss spellings
+of a parameter name are accepted with difflib. Anything ambiguous falls
+through to the full pipeline rather than risking a wrong answer.
+"""
+
+import re
+import difflib
+
+from finance_keywords import FINANCE_KEYWORDS
+
+YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}\b")
+NON_ALNUM = re.compile(r"[^a-z0-9]+")
+# An upper-case word, optionally $-prefixed ("AAPL", "$BRK.B")
+TICKER_PATTERN = re.compile(r"(?<![\w.])\$?([A-Z][A-Z0-9.]*[A-Z0-9]|[A-Z])\b")
+
+# Words that compare or relate values ("higher than", "grew", "percentage
+# of"). No parameter name contains one, so they also mark comparison
+# queries for slm_generation.classify_query.
+COMPARISON_WORDS = {
+    "compare", "compared", "compares", "comparison", "versus", "vs", "difference", "differ",
+    "than", "higher", "lower", "grow", "grew", "grows", "growth", "increase", "increased",
+    "increases", "decrease", "decreased", "decreases", "percentage", "percent", "ratio",
+    "margin", "between"
+}
+
+# Words that ask for more than one cell (trends, comparisons, ratios,
+# explanations); such queries go through the full pipeline.
+NON_POINT_WORDS = {
+    "trend", "trends", "summarize", "summary", "why", "explain", "over"
+} | COMPARISON_WORDS
+
+# Words that change what a parameter measures ("Gross Profit" is not "profit",
+# "Net Short Term Debt Issuance" is not "short term debt"): a keyword is only
+# aliased to a parameter whose qualifiers it names itself.
+QUALIFIER_WORDS = {
+    "gross", "net", "non", "current", "short", "long", "other", "change", "changes",
+    "issuance", "payments", "tangible", "normalized", "basic", "diluted", "deferred",
+    "interest", "income", "expense", "revenue", "cost"
+}
+
+def stem_word(word):
+    """
+    Crude plural folding so "expenditures" matches "expenditure".
+    """
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def find_tickers(query, tickers):
+    """
+    The tickers out of `tickers` that the query names in upper case as a
+    whole word, so short tickers like "ON" or "ALL" do not fire on
+    ordinary words.
+    """
+    return {word for word in TICKER_PATTERN.findall(query) if word in tickers}
+
+def normalize_phrase(text):
+    """
+    Lowercase words separated by single spaces ("Net PPE" -> "net ppe").
+    """
+    return NON_ALNUM.sub(" ", text.lower()).strip()
+
+
+class StructuredLookup:
+    """
+    Index of (ticker, year, parameter) -> cell, plus a phrase table mapping
+    parameter names and aliases to canonical parameter names. Chunks
+    without a ticker are filed under None.
+    """
+    def __init__(self, metadata, keywords_dict=FINANCE_KEYWORDS, fuzzy_cutoff=0.9):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.cells = {}
+        ambiguous = set()
+        for doc_id, meta in enumerate(metadata):
+            key = (meta.get("ticker"), int(meta["year"]), meta["finance_parameter"])
+            if key in self.cells:
+                ambiguous.add(key)
+            self.cells[key] = (doc_id, meta)
+        # A (ticker, year, parameter) triple with several values is not a single cell
+        for key in ambiguous:
+            del self.cells[key]
+        self.tickers = {ticker for ticker, _, _ in self.cells}
+
+        parameters = sorted({parameter for _, _, parameter in self.cells})
+        self.phrases = {normalize_phrase(p): p for p in parameters}
+        for alias, parameter in self._keyword_aliases(keywords_dict).items():
+            self.phrases.setdefault(alias, parameter)
+        self.max_phrase_words = max((len(p.split()) for p in self.phrases), default=0)
+
+    def _keyword_aliases(self, keywords_dict):
+        """
+        Maps finance keywords to parameters: "total <keyword>" if that
+        parameter exists, otherwise the only parameter whose name contains
+        every word of the keyword (up to plurals) and no qualifier the keyword
+        lacks. Keywords that fit several parameters get no alias.
+        """
+        names = {phrase: {stem_word(w) for w in phrase.split()} for phrase in self.phrases}
+        aliases = {}
+        for keywords in keywords_dict.values():
+            for keyword in keywords:
+                alias = normalize_phrase(keyword)
+                if not alias or alias in self.phrases:
+                    continue
+                if "total " + alias in self.phrases:
+                    aliases[alias] = self.phrases["total " + alias]
+                    continue
+                words = {stem_word(w) for w in alias.split()}
+                candidates = {
+                    self.phrases[phrase] for phrase, name_words in names.items()
+                    if words <= name_words and not (name_words - words) & QUALIFIER_WORDS
+                }
+                if len(candidates) == 1:
+                    aliases[alias] = candidates.pop()
+        return aliases
+
+    def _find_parameters(self, words):
+        """
+        Every parameter whose name or alias appears in `words`, longest
+        phrase first; the words of a matched phrase are masked so its
+        sub-phrases ("revenue" in "cost of revenue") are not counted again,
+        while other phrases still are. Falls back to fuzzy matching of the
+        query's n-grams when nothing matches exactly.
+        """
+        found = {}
+        used = [False] * len(words)
+        for n in range(min(self.max_phrase_words, len(words)), 0, -1):
+            for start in range(len(words) - n + 1):
+                if any(used[start:start + n]):
+                    continue
+                parameter = self.phrases.get(" ".join(words[start:start + n]))
+                if parameter is not None:
+                    found.setdefault(parameter, n)
+                    used[start:start + n] = [True] * n
+        if found:
+            return found
+        names = list(self.phrases)
+        for n in range(min(self.max_phrase_words, len(words)), 1, -1):
+            for start in range(len(words) - n + 1):
+                if any(used[start:start + n]):
+                    continue
+                match = difflib.get_close_matches(
+                    " ".join(words[start:start + n]), names, n=1, cutoff=self.fuzzy_cutoff
+                )
+                if match:
+                    found.setdefault(self.phrases[match[0]], n)
+                    used[start:start + n] = [True] * n
+        return found
+
+    def _ticker(self, query, ticker):
+        """
+        (the company the query is about, the query without its tickers);
+        the company is None when it is not clear.
+        """
+        named = find_tickers(query, self.tickers)
+        query = TICKER_PATTERN.sub(lambda m: " " if m.group(1) in named else m.group(0), query)
+        if ticker is not None:
+            return (ticker if named <= {ticker} else None), query
+        if len(named) == 1:
+            return named.pop(), query
+        if not named and len(self.tickers) == 1:
+            return next(iter(self.tickers)), query
+        return None, query
+
+    def resolve(self, query, ticker=None):
+        """
+        Returns the single cell a point query asks for, as a dict with
+        ticker, year, finance_parameter, value, doc_id and text, or None
+        when the query does not name exactly one year and one parameter of
+        one company. `ticker` is the company the caller has chosen (e.g. in
+        a UI); a query naming another one is not a point query.
+        """
+        years = {int(y) for y in YEAR_PATTERN.findall(query)}
+        if len(years) != 1:
+            return None
+        ticker, query = self._ticker(query, ticker)
+        if ticker is None and None not in self.tickers:
+            return None
+        words = normalize_phrase(YEAR_PATTERN.sub(" ", query)).split()
+        if NON_POINT_WORDS.intersection(words):
+            return None
+
+        parameters = self._find_parameters(words)
+        if len(parameters) != 1:
+            return None
+        year = years.pop()
+        cell = self.cells.get((ticker, year, next(iter(parameters))))
+        if cell is None:
+            return None
+        doc_id, meta = cell
+        text = (f"Year: {year}, "
+                f"Parameter: {meta['finance_parameter']}, "
+                f"Value: {meta['value']}")
+        if ticker:
+            text = f"Ticker: {ticker}, " + text
+        return {
+            "ticker": ticker,
+            "year": year,
+            "finance_parameter": meta["finance_parameter"],
+            "value": meta["value"],
+            "doc_id": doc_id,
+            "text": text
+        }
+
+    def answer(self, query, ticker=None):
+        """
+        The formatted answer for a point query, or None.
+        """
+        cell = self.resolve(query, ticker)
+        if cell is None:
+            return None
+        return f"{cell['finance_parameter']} ({cell['year']}): {cell['value']}"
@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+
+import pytest
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# The pipeline modules import each other as top-level modules from scripts/
+sys.path.insert(0, os.path.join(BASE_DIR, "scripts"))
+
+
+@pytest.fixture(scope="session")
+def financial_records():
+    with open(os.path.join(BASE_DIR, "data", "processed", "financial_data.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="session")
+def two_ticker_bundle(tmp_path_factory, financial_records):
+    """
+    A flat bundle over the same filings under AAPL and, with every value
+    doubled, MSFT.
+    """
+    from embedding import build_bundle, chunk_data
+    from index_bundle import load_bundle
+    from stubs import HashingEncoder
+
+    records = ([dict(r, ticker="AAPL") for r in financial_records]
+               + [dict(r, ticker="MSFT", value=r["value"] * 2) for r in financial_records])
+    bundle_dir = str(tmp_path_factory.mktemp("bundle") / "bundle")
+    build_bundle(chunk_data(records), bundle_dir, HashingEncoder(), "stub-hashing")
+    return load_bundle(bundle_dir)
@@ -0,0 +1,44 @@
+"""
+Offline stand-ins for the models, shared by the tests.
+"""
+
+import zlib
+
+import numpy as np
+
+from bm25 import tokenize
+
+
+class HashingEncoder:
+    """
+    SentenceTransformer stand-in: signed feature hashing of the unigrams
+    and bigrams of a text, L2-normalized.
+    """
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def encode(self, sentences, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            terms = tokenize(text)
+            for feature in terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                embeddings[i, h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+class OverlapCrossEncoder:
+    """
+    CrossEncoder stand-in: the share of query words found in the text.
+    Counts the pairs it scores.
+    """
+    def __init__(self):
+        self.pairs = 0
+
+    def predict(self, pairs, batch_size=None, **kwargs):
+        self.pairs += len(pairs)
+        return np.array([len(set(tokenize(q)) & set(tokenize(t))) / max(len(set(tokenize(q))), 1)
+                         for q, t in pairs], dtype=np.float32)
@@ -0,0 +1,81 @@
+import threading
+
+import numpy as np
+
+from answer_cache import CachedResponseGenerator, SemanticAnswerCache
+from slm_generation import SLMResponseGenerator
+
+
+class WordTokenizer:
+    """One token per whitespace-separated word."""
+    def __call__(self, texts, add_special_tokens=True):
+        return {"input_ids": [[hash(w) % 1000 for w in text.split()] for text in texts]}
+
+
+class ConstantEncoder:
+    def encode(self, texts, convert_to_numpy=True):
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+class RecordingGenerator(SLMResponseGenerator):
+    """The real context selection, without a model."""
+    def __init__(self):
+        self.tokenizer = WordTokenizer()
+        self.calls = 0
+
+    def generate_batch(self, queries, retrieved_docs_list, **kwargs):
+        self.calls += len(queries)
+        return [f"answer {self.calls}" for _ in queries]
+
+
+def docs(ids):
+    return [{"doc_id": i, "text": f"Year: 2023, Parameter: Total Revenue, Value: {i}", "re_rank_score": 1.0}
+            for i in ids]
+
+
+def test_cache_keys_on_every_doc_in_the_context():
+    generator = RecordingGenerator()
+    cached = CachedResponseGenerator(generator, ConstantEncoder(), SemanticAnswerCache())
+    query = "What is the Total Revenue for 2023?"
+    assert len(generator.context_docs(query, docs(range(5)))) == 5
+
+    cached.generate_batch([query], [docs([0, 1, 2, 3, 4])])
+    cached.generate_batch([query], [docs([0, 1, 2, 3, 4])])
+    assert cached.last_cache_hits == [True]
+    # Same top 3, different 4th and 5th document: a different prompt
+    cached.generate_batch([query], [docs([0, 1, 2, 7, 8])])
+    assert cached.last_cache_hits == [False]
+    assert generator.calls == 2
+
+
+def test_other_year_is_not_served_the_cached_answer():
+    generator = RecordingGenerator()
+    cached = CachedResponseGenerator(generator, ConstantEncoder(), SemanticAnswerCache())
+    retrieved = docs([0, 1, 2])
+    cached.generate_batch(["net income 2023"], [retrieved])
+    cached.generate_batch(["Net income 2023?"], [retrieved])
+    assert cached.last_cache_hits == [True]
+    # Same docs, embedding above the threshold, but another year
+    cached.generate_batch(["net income 2024"], [retrieved])
+    assert cached.last_cache_hits == [False]
+
+
+def test_concurrent_use_keeps_the_cache_consistent():
+    cache = SemanticAnswerCache(max_size=8)
+
+    def worker(seed):
+        rng = np.random.default_rng(seed)
+        for i in range(500):
+            key = (frozenset([(None, (seed * 7 + i) % 13)]), ())
+            embedding = rng.standard_normal(4)
+            if cache.lookup(embedding, key) is None:
+                cache.store(embedding, key, "answer")
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 8 * 500
+    assert len(cache) <= 8 + 1
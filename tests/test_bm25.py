@@ -0,0 +1,21 @@
+from bm25 import SparseBM25
+
+
+def test_empty_corpus_scores_nothing():
+    bm25 = SparseBM25.from_corpus([])
+    assert bm25.corpus_size == 0
+    assert len(bm25.get_scores(["revenue"])) == 0
+    doc_ids, scores = bm25.top_k(["revenue"])
+    assert len(doc_ids) == 0 and len(scores) == 0
+    assert [len(ids) for ids, _ in bm25.top_k_batch([["revenue"], ["income"]], rows_list=[None, []])] == [0, 0]
+
+
+def test_remove_every_document_then_add():
+    bm25 = SparseBM25.from_corpus([["total", "revenue"], ["net", "income"]])
+    bm25.remove_documents([0, 1])
+    assert bm25.corpus_size == 0 and bm25.vocab == []
+    assert len(bm25.top_k(["revenue"])[0]) == 0
+
+    bm25.add_documents([["total", "revenue"], ["net", "income"], ["net", "sales"]])
+    rebuilt = SparseBM25.from_corpus([["total", "revenue"], ["net", "income"], ["net", "sales"]])
+    assert bm25.top_k(["net", "income"])[0].tolist() == rebuilt.top_k(["net", "income"])[0].tolist()
@@ -0,0 +1,39 @@
+import os
+
+import pandas as pd
+import pytest
+
+from data_collection import FixtureSource, STATEMENTS, collect
+
+
+@pytest.fixture
+def source():
+    columns = pd.to_datetime(["2024-09-30", "2023-09-30"])
+    frame = pd.DataFrame([[391.0, 383.3], [93.7, 97.0]], index=["Total Revenue", "Net Income"],
+                         columns=columns)
+    return FixtureSource({"AAPL": {name: frame for name in STATEMENTS}})
+
+
+def test_unchanged_statements_are_skipped(tmp_path, source):
+    collect(["AAPL"], str(tmp_path), source, backoff=0, years={2023})
+    result, = collect(["AAPL"], str(tmp_path), source, backoff=0, years={2023})
+    assert result["written"] == []
+    assert sorted(result["skipped"]) == sorted(STATEMENTS)
+
+
+def test_new_years_are_fetched(tmp_path, source):
+    collect(["AAPL"], str(tmp_path), source, backoff=0, years={2023})
+    result, = collect(["AAPL"], str(tmp_path), source, backoff=0, years={2023, 2024})
+    assert result["skipped"] == []
+    assert sorted(os.path.basename(p) for p in result["written"]) == sorted(
+        f"{name}_2024.csv" for name in STATEMENTS
+    )
+
+
+def test_missing_csv_is_rewritten(tmp_path, source):
+    collect(["AAPL"], str(tmp_path), source, backoff=0)
+    missing = tmp_path / "AAPL" / "balance_sheet_2024.csv"
+    missing.unlink()
+    result, = collect(["AAPL"], str(tmp_path), source, backoff=0)
+    assert result["written"] == [str(missing)]
+    assert "balance_sheet" not in result["skipped"]
@@ -0,0 +1,32 @@
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from stubs import HashingEncoder
+
+
+class ScalingEncoder(HashingEncoder):
+    """Unit vectors with normalize_embeddings=True, three times longer otherwise."""
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def encode(self, sentences, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        self.calls += 1
+        embeddings = super().encode(sentences)
+        return embeddings if normalize_embeddings else embeddings * 3
+
+
+def test_options_that_change_vectors_are_part_of_the_key(tmp_path):
+    model = ScalingEncoder()
+    store = EmbeddingStore(str(tmp_path), "stub")
+    texts = ["Year: 2023, Parameter: Total Revenue", "Year: 2024, Parameter: Net Income"]
+    raw = store.encode(model, texts)
+    unit = store.encode(model, texts, normalize_embeddings=True)
+    assert np.allclose(np.linalg.norm(raw, axis=1), 3) and np.allclose(np.linalg.norm(unit, axis=1), 1)
+    assert model.calls == 2
+
+    # Options that do not change the vectors share the entries, also after reopening
+    reopened = EmbeddingStore(str(tmp_path), "stub")
+    assert np.allclose(reopened.encode(model, texts, batch_size=8), raw)
+    assert np.allclose(reopened.encode(model, texts, normalize_embeddings=True), unit)
+    assert model.calls == 2
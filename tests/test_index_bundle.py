@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from embedding import build_bundle, chunk_data
+from index_bundle import CURRENT_FILE, KEEP_VERSIONS, MANIFEST_FILE, BundleVersionError, load_bundle
+from stubs import HashingEncoder
+
+
+def build(records, bundle_dir):
+    return build_bundle(chunk_data(records), bundle_dir, HashingEncoder(), "stub-hashing")
+
+
+def test_rebuild_keeps_the_loaded_version_readable(tmp_path, financial_records):
+    bundle_dir = str(tmp_path / "bundle")
+    records = financial_records[:20]
+    build(records, bundle_dir)
+    old = load_bundle(bundle_dir)
+    old_texts = list(old.chunk_texts)
+
+    for scale in (2, 3, 4):
+        manifest, stats = build([dict(r, value=r["value"] * scale) for r in records], bundle_dir)
+        assert stats["added"] > 0
+        new = load_bundle(bundle_dir)
+        assert new.version == manifest["build_id"] != old.version
+        versions = [name for name in os.listdir(bundle_dir) if name != CURRENT_FILE]
+        assert len(versions) == KEEP_VERSIONS and manifest["build_id"] in versions
+
+    # The first build's files were pruned from disk but stay mapped
+    assert list(old.chunk_texts) == old_texts
+    assert old.faiss_index.ntotal == len(old_texts)
+
+
+def test_unversioned_bundle_is_rebuilt(tmp_path, financial_records):
+    bundle_dir = tmp_path / "bundle"
+    bundle_dir.mkdir()
+    (bundle_dir / MANIFEST_FILE).write_text("{}")
+    with pytest.raises(BundleVersionError):
+        load_bundle(str(bundle_dir))
+    manifest, _ = build(financial_records[:5], str(bundle_dir))
+    assert sorted(os.listdir(bundle_dir)) == sorted([CURRENT_FILE, manifest["build_id"]])
+
+
+def test_missing_bundle(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_bundle(str(tmp_path / "missing"))
+
+
+def test_service_reloads_an_updated_bundle(tmp_path, financial_records):
+    from answer_cache import SemanticAnswerCache
+    from service import QAService
+    from structured_lookup import StructuredLookup
+
+    class Generator:
+        cache = None
+
+    bundle_dir = str(tmp_path / "bundle")
+    records = financial_records[:20]
+    build(records, bundle_dir)
+    bundle = load_bundle(bundle_dir)
+    generator = Generator()
+    generator.cache = SemanticAnswerCache(index_version=bundle.version)
+    generator.cache.store([1.0, 0.0], "key", "stale answer")
+    service = QAService(bundle, None, None, generator, None, StructuredLookup(bundle.metadata),
+                        bundle_dir=bundle_dir)
+    assert not service.reload_bundle()
+
+    build([dict(r, value=r["value"] + 1) for r in records[:5]] + records[5:], bundle_dir)
+    assert service.reload_bundle()
+    assert service.bundle.version != bundle.version
+    assert len(generator.cache) == 0 and generator.cache.index_version == service.bundle.version
+    cell = service.lookup.resolve(f"What is the {records[0]['finance_parameter']} for {records[0]['year']}?")
+    assert cell["value"] == records[0]["value"] + 1
+
+
+def test_bundle_with_every_chunk_removed(tmp_path, financial_records):
+    from retrieval import hybrid_search_batch
+
+    bundle_dir = str(tmp_path / "bundle")
+    build(financial_records[:5], bundle_dir)
+    _, stats = build([], bundle_dir)
+    assert stats["removed"] == 5
+    bundle = load_bundle(bundle_dir)
+    assert len(bundle.chunk_texts) == 0
+    assert hybrid_search_batch(["total revenue 2023"], bundle.bm25, bundle.chunk_texts, bundle.faiss_index,
+                               bundle.metadata, HashingEncoder(), id_map=bundle.id_map,
+                               partitions=bundle.partitions) == [[]]
@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import model_registry
+from model_registry import ModelRegistry
+
+
+@pytest.fixture
+def flaky_kind(monkeypatch):
+    """A "flaky" model kind whose first load fails."""
+    calls = []
+
+    def load(name, profile):
+        calls.append(name)
+        if len(calls) == 1:
+            raise OSError("download interrupted")
+        return torch.nn.Linear(2, 2)
+
+    monkeypatch.setitem(model_registry.LOADERS, "flaky", (load, lambda model: None, lambda model: model))
+    return calls
+
+
+def test_failed_load_is_retried_after_backoff(flaky_kind):
+    registry = ModelRegistry(warmup=False)
+    with pytest.raises(OSError):
+        registry.get("flaky", "m")
+    # Within the backoff the error is re-raised without loading again
+    with pytest.raises(OSError):
+        registry.get("flaky", "m")
+    assert len(flaky_kind) == 1
+
+    # Backoff over
+    registry.load("flaky", "m").retry_at = 0.0
+    model = registry.get("flaky", "m")
+    assert isinstance(model, torch.nn.Linear)
+    assert len(flaky_kind) == 2
+    assert registry.stats()[0]["status"] == "ready" and registry.stats()[0]["failures"] == 1
@@ -0,0 +1,51 @@
+from query_filters import extract_filters, find_tickers
+from retrieval import hybrid_search
+from stubs import HashingEncoder
+
+
+def test_tickers_must_be_upper_case_words():
+    assert find_tickers("AAPL vs $MSFT, all on margin", {"AAPL", "MSFT", "ALL", "ON"}) == {"AAPL", "MSFT"}
+    assert extract_filters("AAPL revenue 2023", {"AAPL"})["ticker"] == {"AAPL"}
+
+
+def test_chunks_carry_their_ticker(two_ticker_bundle):
+    tickers = {m["ticker"] for m in two_ticker_bundle.metadata}
+    assert tickers == {"AAPL", "MSFT"}
+    assert all(text.startswith("Ticker: ") for text in two_ticker_bundle.chunk_texts)
+
+
+def search(bundle, query, partitions):
+    return hybrid_search(query, bundle.bm25, bundle.chunk_texts, bundle.faiss_index, bundle.metadata,
+                         HashingEncoder(), top_k=10, id_map=bundle.id_map, partitions=partitions)
+
+
+def test_query_ticker_restricts_retrieval(two_ticker_bundle):
+    docs = search(two_ticker_bundle, "MSFT total revenue 2023", two_ticker_bundle.partitions)
+    assert {d["metadata"]["ticker"] for d in docs} == {"MSFT"}
+
+
+def test_pinned_ticker_restricts_retrieval(two_ticker_bundle):
+    partitions = two_ticker_bundle.partitions.pin(ticker={"AAPL"})
+    docs = search(two_ticker_bundle, "total revenue 2023", partitions)
+    assert {d["metadata"]["ticker"] for d in docs} == {"AAPL"}
+    assert two_ticker_bundle.partitions.pinned == {}
+
+
+def test_family_filter_does_not_hide_other_families(two_ticker_bundle):
+    # "cash" classifies the query under the cash family; the answer is an equity row
+    query = "AAPL cash spent on repurchase in 2023"
+    assert extract_filters(query, {"AAPL"})["family"] == {"cash"}
+    docs = search(two_ticker_bundle, query, two_ticker_bundle.partitions)
+    assert ("Repurchase Of Capital Stock", 2023, "AAPL") in {
+        (d["metadata"]["finance_parameter"], d["metadata"]["year"], d["metadata"]["ticker"]) for d in docs
+    }
+
+
+def test_family_rows_are_boosted(two_ticker_bundle):
+    partitions = two_ticker_bundle.partitions
+    rows, family_rows = partitions.query_rows("MSFT free cash 2024")
+    # The family does not restrict the rows, it is returned separately
+    assert rows.tolist() == partitions.resolve({"ticker": {"MSFT"}, "year": {2024}}).tolist()
+    assert family_rows.tolist() == partitions.partitions["family"]["cash"].tolist()
+    docs = search(two_ticker_bundle, "MSFT free cash 2024", partitions)
+    assert "Cash" in docs[0]["metadata"]["finance_parameter"]
@@ -0,0 +1,41 @@
+import threading
+
+from re_ranking import ReRanker
+from stubs import OverlapCrossEncoder
+
+
+def doc(doc_id, text):
+    return {"doc_id": doc_id, "text": text, "metadata": {}}
+
+
+def test_scores_follow_the_text_not_the_row():
+    cross_encoder = OverlapCrossEncoder()
+    reranker = ReRanker("stub", cross_encoder=cross_encoder)
+    query = "total revenue 2023"
+    first = reranker.rerank(query, [doc(7, "Year: 2023, Parameter: Total Revenue, Value: 1.0")])
+    # update_bundle renumbered the rows: row 7 now holds another chunk
+    second = reranker.rerank(query, [doc(7, "Year: 2023, Parameter: Net Income, Value: 2.0")])
+    assert first[0]["re_rank_score"] != second[0]["re_rank_score"]
+    # The same text under a new row is a cache hit
+    reranker.rerank(query, [doc(3, "Year: 2023, Parameter: Total Revenue, Value: 1.0")])
+    assert cross_encoder.pairs == 2
+
+
+def test_concurrent_reranking():
+    reranker = ReRanker("stub", cache_size=16, cross_encoder=OverlapCrossEncoder())
+    errors = []
+
+    def worker(seed):
+        try:
+            for i in range(300):
+                reranker.rerank(f"query {(seed + i) % 40}", [doc(j, f"text {j}") for j in range(4)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(reranker.score_cache) <= 16
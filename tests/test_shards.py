@@ -0,0 +1,39 @@
+import pytest
+
+from shards import ShardedIndex, build_shards
+from stubs import HashingEncoder
+
+
+@pytest.fixture(scope="module")
+def shard_root(tmp_path_factory, financial_records):
+    root = str(tmp_path_factory.mktemp("shards"))
+    # AAPL (first in the catalog) has no revenue rows; MSFT has them all
+    revenue = [r for r in financial_records if r["finance_parameter"] == "Total Revenue"]
+    others = [r for r in financial_records if r["finance_parameter"] != "Total Revenue"]
+    records = others + [dict(r, ticker="MSFT") for r in revenue + others[:20]]
+    build_shards(records, root, HashingEncoder(), "stub-hashing",
+                 {"AAPL": ["Apple"], "MSFT": ["Microsoft"]})
+    return root
+
+
+def test_named_company_searches_only_its_shard(shard_root):
+    index = ShardedIndex(shard_root)
+    docs = index.search("Apple net income 2023", HashingEncoder(), top_k=5)
+    assert docs and {d["ticker"] for d in docs} == {"AAPL"}
+    assert list(index._loaded) == ["AAPL"]
+
+
+def test_fan_out_ranks_the_best_shard_first(shard_root):
+    index = ShardedIndex(shard_root)
+    docs = index.search("Total Revenue 2023", HashingEncoder(), top_k=3)
+    assert docs[0]["ticker"] == "MSFT"
+    assert docs[0]["metadata"]["finance_parameter"] == "Total Revenue"
+    scores = [d["dense_score"] for d in docs]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_fan_out_wider_than_lru_keeps_working_set(shard_root):
+    index = ShardedIndex(shard_root, max_loaded=1)
+    index.shard("MSFT")
+    index.search("total revenue 2023", HashingEncoder(), top_k=5)
+    assert list(index._loaded) == ["MSFT"]
@@ -0,0 +1,120 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+torch = pytest.importorskip("torch")
+spm = pytest.importorskip("sentencepiece")
+from sentencepiece import sentencepiece_model_pb2
+from transformers import LogitsProcessor, LogitsProcessorList, T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+from slm_generation import GENERATION_BUDGETS, SLMResponseGenerator, whitespace_joins
+
+CORPUS = [
+    "Net income was higher in 2024 than in 2023. Total revenue rose to 391 billion.",
+    "Year: 2023, Parameter: Total Revenue, Value: 383285000000.0",
+    "For 2023 the total revenue was 383 billion.\nFor 2024 it was 391 billion.",
+    "Compare net income vs operating income. Summarize the cost of revenue.",
+]
+ANSWER = "Net income was higher in 2024 than in 2023. Total revenue rose to 391 billion."
+
+
+@pytest.fixture(scope="module")
+def generator(tmp_path_factory):
+    """
+    SLMResponseGenerator over a T5 tokenizer built from a sentencepiece
+    model trained here (normalized like flan-t5's: newlines become spaces)
+    and a tiny random T5.
+    """
+    model_file = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(CORPUS * 50), model_writer=model_file, vocab_size=120,
+        pad_id=0, eos_id=1, unk_id=2, bos_id=-1, hard_vocab_limit=False, minloglevel=2
+    )
+    proto = sentencepiece_model_pb2.ModelProto()
+    proto.ParseFromString(model_file.getvalue())
+    tokenizer = T5Tokenizer(vocab=[(p.piece, p.score) for p in proto.pieces], extra_ids=0,
+                            _spm_precompiled_charsmap=proto.normalizer_spec.precompiled_charsmap)
+    config = T5Config(vocab_size=len(tokenizer), d_model=32, d_ff=64, num_layers=2, num_heads=2, d_kv=16,
+                      decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    model_dir = str(tmp_path_factory.mktemp("t5"))
+    tokenizer.save_pretrained(model_dir)
+    T5ForConditionalGeneration(config).save_pretrained(model_dir)
+    return SLMResponseGenerator(model_dir, profile="fp32", encoder_cache_size=0)
+
+
+class ForceTokens(LogitsProcessor):
+    """Makes the model emit `ids` (then pad), counting the decoding steps."""
+    def __init__(self, ids):
+        self.ids = ids
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        self.steps += 1
+        step = input_ids.shape[1] - 1
+        forced = torch.full_like(scores, -float("inf"))
+        forced[:, self.ids[step] if step < len(self.ids) else 0] = 0
+        return forced
+
+
+def decode_steps(generator, monkeypatch, query, answer_ids):
+    force = ForceTokens(answer_ids)
+    generate = generator.model.generate
+    monkeypatch.setattr(generator.model, "generate",
+                        lambda **kwargs: generate(logits_processor=LogitsProcessorList([force]), **kwargs))
+    docs = [{"text": "Year: 2023, Parameter: Total Revenue, Value: 383285000000.0", "re_rank_score": 1.0}]
+    return generator.generate_batch([query], [docs])[0], force.steps
+
+
+def test_tokenizer_has_no_newline(generator):
+    ids = generator.tokenizer("a.\nb")["input_ids"]
+    assert "\n" not in generator.tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def test_comparison_stops_after_the_first_sentence(generator, monkeypatch):
+    # The forced answer never ends: only the sentence stop can end it early
+    ids = generator.tokenizer(ANSWER, add_special_tokens=False)["input_ids"] * 20
+    answer, steps = decode_steps(generator, monkeypatch, "Was net income higher than revenue in 2024?", ids)
+    assert answer == "Net income was higher in 2024 than in 2023."
+    assert steps < GENERATION_BUDGETS["comparison"]["max_new_tokens"] // 2
+
+
+def test_summary_stops_at_end_of_sequence(generator, monkeypatch):
+    ids = generator.tokenizer(ANSWER)["input_ids"]
+    answer, steps = decode_steps(generator, monkeypatch, "Summarize total revenue over two years", ids)
+    assert answer == ANSWER
+    assert steps <= len(ids) + 1
+
+
+PROMPTS = [
+    ("What was the total revenue in 2023?", CORPUS[1:3]),
+    ("Summarize total revenue over two years", CORPUS[:3]),
+    ("Was net income higher than revenue in 2024?", CORPUS[2:]),
+    ("revenue", []),
+]
+
+
+def prompt_docs(texts):
+    return [{"text": text, "re_rank_score": 1.0} for text in texts]
+
+
+def test_whitespace_joins():
+    assert whitespace_joins(["Question: ", "revenue", "\n\nContext:\n"])
+    assert whitespace_joins(["a ", "", "b"])
+    assert not whitespace_joins(["Question:", "revenue"])
+
+
+def test_assembled_ids_match_full_tokenization(generator):
+    for query, texts in PROMPTS * 2:
+        ids, _ = generator.encode_prompt(query, prompt_docs(texts))
+        full = generator.tokenizer([generator.build_prompt(query, prompt_docs(texts))])["input_ids"][0]
+        assert list(ids) == list(full)
+    assert generator.stats()["assemble_ids"]
+
+
+def test_encode_prompt_is_thread_safe(generator):
+    expected = [list(generator.encode_prompt(query, prompt_docs(texts))[0]) for query, texts in PROMPTS]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: list(generator.encode_prompt(PROMPTS[i % 4][0], prompt_docs(PROMPTS[i % 4][1]))[0]),
+                                range(200)))
+    assert results == [expected[i % 4] for i in range(200)]
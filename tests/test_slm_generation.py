@@ -0,0 +1,29 @@
+import pytest
+
+from slm_generation import classify_query
+
+
+@pytest.fixture(scope="module")
+def parameters(financial_records):
+    return sorted({record["finance_parameter"] for record in financial_records})
+
+
+def test_every_parameter_point_query_is_point(parameters):
+    # Includes "Change In Inventory", "Changes In Cash", "Net Other Investing Changes"
+    assert any(p.startswith("Change") for p in parameters)
+    for parameter in parameters:
+        assert classify_query(f"What is the {parameter} for 2023?") == "point", parameter
+
+
+@pytest.mark.parametrize("query", [
+    "Compare net income vs operating income in 2024",
+    "How much did total revenue grow in 2024?",
+    "Was operating income higher than net income in 2023?",
+    "What is the difference between total debt and cash in 2024?",
+])
+def test_comparisons(query):
+    assert classify_query(query) == "comparison"
+
+
+def test_several_years_are_summaries():
+    assert classify_query("Summarize the change in inventory for 2023 and 2024") == "summary"
@@ -0,0 +1,61 @@
+import pytest
+
+from structured_lookup import StructuredLookup
+
+
+@pytest.fixture(scope="module")
+def lookup(financial_records):
+    return StructuredLookup(financial_records)
+
+
+@pytest.mark.parametrize("query, parameter", [
+    ("Total Revenue 2023", "Total Revenue"),
+    ("What is the Net Income for 2024?", "Net Income"),
+    ("cost of revenue 2023", "Cost Of Revenue"),
+    ("What is the Change In Inventory for 2023?", "Change In Inventory"),
+])
+def test_point_queries_resolve(lookup, query, parameter):
+    cell = lookup.resolve(query)
+    assert cell is not None
+    assert cell["finance_parameter"] == parameter
+
+
+@pytest.mark.parametrize("query", [
+    "Is revenue higher than cost of revenue in 2023?",
+    "What percentage of revenue was net income in 2023?",
+    "Did revenue grow in 2023?",
+    "gross profit margin 2023",
+    "total debt and net income 2024",
+])
+def test_non_point_queries_fall_through(lookup, query):
+    assert lookup.resolve(query) is None
+
+
+def test_two_parameters_are_not_a_point_query(lookup):
+    # Neither name is a sub-phrase of the other: both must be counted
+    assert lookup._find_parameters("total debt and net income".split()).keys() == {"Total Debt", "Net Income"}
+
+
+@pytest.fixture(scope="module")
+def two_ticker_lookup(two_ticker_bundle):
+    return StructuredLookup(two_ticker_bundle.metadata)
+
+
+def test_ticker_in_query_picks_the_company(two_ticker_lookup, lookup):
+    aapl = two_ticker_lookup.resolve("AAPL Total Revenue 2023")
+    msft = two_ticker_lookup.resolve("What is the Total Revenue of $MSFT for 2023?")
+    assert (aapl["ticker"], msft["ticker"]) == ("AAPL", "MSFT")
+    assert aapl["value"] == lookup.resolve("Total Revenue 2023")["value"]
+    assert msft["value"] == 2 * aapl["value"]
+    assert msft["text"].startswith("Ticker: MSFT, ")
+
+
+def test_chosen_ticker_picks_the_company(two_ticker_lookup):
+    assert two_ticker_lookup.resolve("Total Revenue 2023", ticker="MSFT")["ticker"] == "MSFT"
+    # A query about another company than the chosen one is not a point query
+    assert two_ticker_lookup.resolve("AAPL Total Revenue 2023", ticker="MSFT") is None
+
+
+def test_no_company_with_several_falls_through(two_ticker_lookup):
+    assert two_ticker_lookup.resolve("Total Revenue 2023") is None
+    assert two_ticker_lookup.resolve("AAPL and MSFT Total Revenue 2023") is None